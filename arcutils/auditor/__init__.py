@@ -1 +1,4 @@
+from .controls import bulk_changeset, set_rules, suspended  # noqa
+from .query import AuditedManager, AuditedQuerySet  # noqa
+
 default_app_config = 'arcutils.auditor.apps.DefaultAppConfig'
@@ -0,0 +1,18 @@
+"""Benchmarks for the overhead of signal-based auditing.
+
+Run with::
+
+    python -m arcutils.auditor.benchmarks [--iterations N] [--output FILE]
+
+or via ``runcommand benchmark_auditor``. Results are emitted as JSON so
+they can be compared between releases.
+
+"""
+default_app_config = 'arcutils.auditor.benchmarks.apps.BenchmarksAppConfig'
+
+
+FIELD_COUNTS = (1, 10, 50)
+
+
+def get_field_names(num_fields):
+    return ['field_{0}'.format(i) for i in range(num_fields)]
@@ -0,0 +1,7 @@
+from django.apps import AppConfig
+
+
+class BenchmarksAppConfig(AppConfig):
+
+    name = 'arcutils.auditor.benchmarks'
+    label = 'auditor_benchmarks'
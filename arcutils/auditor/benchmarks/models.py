@@ -0,0 +1,26 @@
+"""Models used by the auditor benchmarks.
+
+For each field count in ``FIELD_COUNTS``, there's an audited model named
+``Audited{n}`` and an otherwise identical unaudited model named
+``Unaudited{n}`` to serve as a baseline.
+
+"""
+from django.db import models
+
+from . import get_field_names
+
+
+def make_model(name, num_fields):
+    attrs = {'__module__': __name__}
+    for field_name in get_field_names(num_fields):
+        attrs[field_name] = models.CharField(max_length=32, default='')
+    return type(name, (models.Model,), attrs)
+
+
+Audited1 = make_model('Audited1', 1)
+Audited10 = make_model('Audited10', 10)
+Audited50 = make_model('Audited50', 50)
+
+Unaudited1 = make_model('Unaudited1', 1)
+Unaudited10 = make_model('Unaudited10', 10)
+Unaudited50 = make_model('Unaudited50', 50)
@@ -0,0 +1,240 @@
+import argparse
+import json
+import platform
+import sqlite3
+import sys
+import time
+from contextlib import contextmanager
+
+import django
+from django.conf import settings
+
+from . import FIELD_COUNTS, get_field_names
+
+
+def configure():
+    """Configure Django to run the benchmarks on in-memory SQLite."""
+    settings.configure(
+        DEBUG=False,
+        USE_TZ=True,
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            }
+        },
+        INSTALLED_APPS=(
+            'django.contrib.auth',
+            'django.contrib.contenttypes',
+            'arcutils.auditor.benchmarks',
+            'arcutils.auditor',
+        ),
+        AUDITOR={
+            'models': [
+                {
+                    'name': 'auditor_benchmarks.Audited{0}'.format(n),
+                    'fields': get_field_names(n),
+                }
+                for n in FIELD_COUNTS
+            ],
+        },
+    )
+    django.setup()
+
+    # AuditLog uses the PostgreSQL JSONField, which wraps values in
+    # psycopg2's Json adapter (or a subclass of it, depending on the
+    # version of Django). SQLite doesn't know what to do with that, so
+    # it's converted to a JSON string here.
+    from django.contrib.postgres.fields import jsonb
+    from psycopg2.extras import Json
+    for adapter_type in {Json, getattr(jsonb, 'JsonAdapter', Json)}:
+        sqlite3.register_adapter(adapter_type, lambda value: value.dumps(value.adapted))
+
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def in_request(user, func, *args):
+    """Call ``func`` in a request context with auditing enabled."""
+    from django.test import RequestFactory
+    from arcutils.auditor.middleware import AuditorMiddleware
+    from arcutils.threadlocals import ThreadLocalMiddleware
+
+    request = RequestFactory().get('/')
+    request.user = user
+    handler = ThreadLocalMiddleware(AuditorMiddleware(lambda request: func(*args)))
+    return handler(request)
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def count_queries(func, *args):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    with CaptureQueriesContext(connection) as context:
+        func(*args)
+    return len(context.captured_queries)
+
+
+def get_model(prefix, num_fields):
+    from django.apps import apps
+    return apps.get_model('auditor_benchmarks', '{0}{1}'.format(prefix, num_fields))
+
+
+def create_instances(model, iterations):
+    field_names = get_field_names(len(model._meta.local_fields) - 1)
+    model.objects.bulk_create(
+        model(**{name: 'initial' for name in field_names}) for _ in range(iterations))
+    return list(model.objects.all())
+
+
+def delete_instances(model):
+    from arcutils.auditor import suspended
+    with suspended():
+        model.objects.all().delete()
+
+
+def change_all_fields(instances, value):
+    field_names = get_field_names(len(instances[0]._meta.local_fields) - 1)
+    for instance in instances:
+        for name in field_names:
+            setattr(instance, name, value)
+
+
+@contextmanager
+def post_init_snapshots_disconnected(model):
+    """Disconnect the auditor's ``post_init`` receiver for ``model``."""
+    from django.db.models.signals import post_init
+    from arcutils.auditor import signals
+    post_init.disconnect(sender=model, dispatch_uid=signals.SAVE_CURRENT_DATA_UID)
+    try:
+        yield
+    finally:
+        receiver = signals.save_current_data_factory(model, signals.get_audited_fields(model))
+        post_init.connect(
+            receiver, sender=model, weak=False, dispatch_uid=signals.SAVE_CURRENT_DATA_UID)
+
+
+def benchmark_loads(user, iterations):
+    """Instance loads per second with and without snapshotting.
+
+    ``no_snapshot`` loads the audited model with its ``post_init``
+    receiver disconnected; ``suspended`` loads it in a
+    :func:`arcutils.auditor.suspended` block, where the receiver runs
+    but doesn't take a snapshot.
+
+    """
+    from arcutils.auditor import suspended
+
+    def load(model):
+        list(model.objects.all())
+
+    def load_suspended(model):
+        with suspended():
+            load(model)
+
+    def load_without_snapshots(model):
+        with post_init_snapshots_disconnected(model):
+            load(model)
+
+    results = {}
+    for n in FIELD_COUNTS:
+        audited, unaudited = get_model('Audited', n), get_model('Unaudited', n)
+        create_instances(audited, iterations)
+        create_instances(unaudited, iterations)
+        results[str(n)] = {
+            'unaudited': iterations / timed(load, unaudited),
+            'no_snapshot': iterations / timed(load_without_snapshots, audited),
+            'suspended': iterations / timed(load_suspended, audited),
+            'audited': iterations / timed(load, audited),
+        }
+        delete_instances(audited)
+        delete_instances(unaudited)
+    return results
+
+
+def benchmark_saves(user, iterations):
+    """Saves (with all fields changed) per second."""
+
+    def save(instances):
+        for instance in instances:
+            instance.save()
+
+    results = {}
+    for n in FIELD_COUNTS:
+        audited, unaudited = get_model('Audited', n), get_model('Unaudited', n)
+        result = results[str(n)] = {}
+        for key, model in (('unaudited', unaudited), ('audited', audited)):
+            instances = create_instances(model, iterations)
+            change_all_fields(instances, 'changed')
+            result[key] = iterations / in_request(user, timed, save, instances)
+            change_all_fields(instances, 'changed again')
+            result['{0}_queries'.format(key)] = in_request(
+                user, count_queries, save, instances[:1])
+            delete_instances(model)
+    return results
+
+
+def benchmark_deletes(user, iterations):
+    """Deletes per second."""
+
+    def delete(instances):
+        for instance in instances:
+            instance.delete()
+
+    results = {}
+    for n in FIELD_COUNTS:
+        audited, unaudited = get_model('Audited', n), get_model('Unaudited', n)
+        result = results[str(n)] = {}
+        for key, model in (('unaudited', unaudited), ('audited', audited)):
+            instances = create_instances(model, iterations + 1)
+            result[key] = iterations / in_request(user, timed, delete, instances[:-1])
+            result['{0}_queries'.format(key)] = in_request(
+                user, count_queries, delete, instances[-1:])
+    return results
+
+
+def run(iterations=1000):
+    """Run all benchmarks and return the results as a dict.
+
+    Throughput numbers are operations per second. Query counts are per
+    operation.
+
+    """
+    from django.contrib.auth import get_user_model
+    from arcutils.auditor.models import AuditLog
+
+    user = get_user_model().objects.create(username='benchmark')
+
+    results = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'iterations': iterations,
+        'loads': benchmark_loads(user, iterations),
+        'saves': benchmark_saves(user, iterations),
+        'deletes': benchmark_deletes(user, iterations),
+    }
+
+    AuditLog.objects.all().delete()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark auditor overhead')
+    parser.add_argument('-i', '--iterations', type=int, default=1000)
+    parser.add_argument('-o', '--output', default=None, help='Write JSON results to this file')
+    args = parser.parse_args(argv)
+
+    configure()
+    results = run(args.iterations)
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=4, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=4, sort_keys=True)
+        print()
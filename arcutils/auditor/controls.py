@@ -0,0 +1,272 @@
+"""Runtime controls for auditing.
+
+These are useful for large imports and data migrations, where writing an
+audit log record for every changed field of every object would make the
+job several times slower.
+
+- :func:`suspended` turns auditing off for the current thread.
+- :func:`bulk_changeset` records one summary record per model instead
+  of one record per changed field.
+- :func:`set_rules` changes the sampling rate and excluded fields for
+  a model.
+
+"""
+import random
+import threading
+import uuid
+import zlib
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+
+from django.apps import apps
+from django.utils import timezone
+
+from arcutils.threadlocals import get_current_request
+
+from .middleware import AuditorInfo
+from .utils import Sequencer
+
+
+Rules = namedtuple('Rules', 'sample_rate exclude_fields')
+
+
+DEFAULT_RULES = Rules(1.0, frozenset())
+
+
+_audited_fields = {}
+_rules = {}
+_rules_lock = threading.Lock()
+
+
+class _State(threading.local):
+
+    suspended = 0
+    bulk_changeset = None
+    record_buffer = None
+
+
+_state = _State()
+
+
+def register(model, fields):
+    """Register ``model`` for auditing of the specified ``fields``.
+
+    This is called for each model in ``AUDITOR['models']`` when the
+    auditor app is loaded.
+
+    """
+    _audited_fields[model] = tuple(fields)
+
+
+def get_audited_fields(model):
+    """Get fields of ``model`` that are audited (minus excluded fields).
+
+    If ``model`` isn't audited, ``None`` is returned.
+
+    """
+    fields = _audited_fields.get(model)
+    if fields is None:
+        return None
+    exclude_fields = get_rules(model).exclude_fields
+    if exclude_fields:
+        return tuple(f for f in fields if f not in exclude_fields)
+    return fields
+
+
+def get_auditor_info():
+    """Get the :class:`AuditorInfo` for the current request, if any."""
+    request = get_current_request()
+    if request is None:
+        return None
+    return getattr(request, 'auditor_info', None)
+
+
+def get_rules(model) -> Rules:
+    """Get the auditing rules for ``model``."""
+    return _rules.get(model, DEFAULT_RULES)
+
+
+def set_rules(model, sample_rate=None, exclude_fields=None) -> Rules:
+    """Change the auditing rules for ``model``.
+
+    Rules are initially set from the ``sample_rate`` and
+    ``exclude_fields`` keys of the model's spec in ``AUDITOR['models']``
+    and can be changed at any time via this function.
+
+    Args:
+        model: A model class or a model name like "articles.Article"
+        sample_rate: A number between 0 and 1 indicating the fraction
+            of objects whose changes will be logged. The decision is
+            made per object, based on its primary key (see
+            :func:`should_sample`).
+        exclude_fields: Audited fields whose changes should *not* be
+            logged
+
+    Returns:
+        Rules: The new rules for ``model``
+
+    """
+    if isinstance(model, str):
+        model = apps.get_model(model)
+    with _rules_lock:
+        rules = get_rules(model)
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError(
+                    'sample_rate must be between 0 and 1; got {0}'.format(sample_rate))
+            rules = rules._replace(sample_rate=sample_rate)
+        if exclude_fields is not None:
+            rules = rules._replace(exclude_fields=frozenset(exclude_fields))
+        _rules[model] = rules
+    return rules
+
+
+def should_sample(model, pk=None) -> bool:
+    """Decide whether changes to the ``model`` object with ``pk`` are
+    logged.
+
+    The decision is derived from ``pk``, so the same objects are sampled
+    whether they're changed via model instances or via bulk operations
+    (see :mod:`arcutils.auditor.query`). If ``pk`` isn't known, the
+    decision is random.
+
+    """
+    sample_rate = get_rules(model).sample_rate
+    if sample_rate >= 1:
+        return True
+    if sample_rate <= 0:
+        return False
+    if pk is None:
+        return random.random() < sample_rate
+    key = '{0.app_label}.{0.model_name}:{1}'.format(model._meta, pk).encode('utf-8')
+    return zlib.crc32(key) / 0x100000000 < sample_rate
+
+
+def is_suspended() -> bool:
+    """Indicates whether auditing is suspended in the current thread."""
+    return _state.suspended > 0
+
+
+@contextmanager
+def suspended():
+    """Suspend auditing in the current thread.
+
+    Changes made in this context will not be logged. The current values
+    of instances loaded in this context aren't saved either, so if one
+    of them is saved later, outside of this context, its audited fields
+    will be logged with their previous values unknown.
+
+    """
+    _state.suspended += 1
+    try:
+        yield
+    finally:
+        _state.suspended -= 1
+
+
+def get_bulk_changeset():
+    """Get the bulk changeset for the current thread, if any."""
+    return _state.bulk_changeset
+
+
+class BulkChangeset:
+
+    """Counts changes per model and logs them as summary records."""
+
+    def __init__(self, info, message=None):
+        self.info = info
+        self.message = message
+        self.counts = OrderedDict()
+
+    def add(self, model, action, count=1):
+        """Count an ``action`` ("created", "updated", or "deleted")."""
+        self.counts.setdefault(model, Counter())[action] += count
+
+    def save(self):
+        # Imported here so this module can be imported before apps are
+        # ready.
+        from django.contrib.contenttypes.models import ContentType
+        from .models import AuditLog
+
+        info = self.info
+        records = []
+        for model, counts in self.counts.items():
+            summary = {action: counts[action] for action in ('created', 'updated', 'deleted')}
+            message = self.message or (
+                'Bulk changeset: {created} created, {updated} updated, {deleted} deleted'
+                .format_map(summary))
+            records.append(AuditLog(
+                user=info.user,
+                timestamp=info.timestamp,
+                changeset_id=info.changeset_id,
+                sequence=next(info.sequencer),
+                message=message[:255],
+                content_type=ContentType.objects.get_for_model(model),
+                object_id='',
+                field_name='',
+                old_value=None,
+                new_value=summary,
+                created=False,
+                deleted=False,
+            ))
+        AuditLog.objects.bulk_create(records)
+        return records
+
+
+@contextmanager
+def bulk_changeset(user=None, message=None):
+    """Log a summary of changes instead of logging each change.
+
+    In this context, saves and deletes of audited models are counted
+    instead of being logged individually. When the context exits, one
+    audit log record per model is added with the number of instances
+    that were created, updated, and deleted (as its ``new_value``).
+
+    In a request context, the request's user and changeset are used.
+    Otherwise, ``user`` must be passed for the summary to be logged.
+
+    The summary is only logged if the block completes without an error,
+    so the block should generally be wrapped in a transaction.
+
+    As with :func:`suspended`, the current values of instances loaded in
+    this context aren't saved.
+
+    """
+    info = get_auditor_info()
+    if info is None and user is not None:
+        info = AuditorInfo(user, timezone.now(), uuid.uuid4(), Sequencer())
+
+    previous = _state.bulk_changeset
+    changeset = _state.bulk_changeset = BulkChangeset(info, message)
+    try:
+        yield changeset
+    finally:
+        _state.bulk_changeset = previous
+
+    if info is not None:
+        changeset.save()
+
+
+def save_record(record):
+    """Save audit log ``record`` or add it to the current buffer."""
+    if _state.record_buffer is not None:
+        _state.record_buffer.append(record)
+    else:
+        record.save(force_insert=True)
+
+
+@contextmanager
+def buffered_records():
+    """Collect records instead of saving them one at a time.
+
+    Yields a list of the records that would have been saved in this
+    context; the caller is responsible for saving them (typically with
+    ``bulk_create``).
+
+    """
+    previous = _state.record_buffer
+    records = _state.record_buffer = []
+    try:
+        yield records
+    finally:
+        _state.record_buffer = previous
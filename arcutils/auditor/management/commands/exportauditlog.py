@@ -0,0 +1,234 @@
+import csv
+import json
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from arcutils.auditor.models import AuditLog
+
+
+FIELDS = (
+    'id',
+    'timestamp',
+    'changeset_id',
+    'sequence',
+    'user_id',
+    'username',
+    'content_type',
+    'object_id',
+    'field_name',
+    'old_value',
+    'new_value',
+    'created',
+    'deleted',
+    'message',
+)
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Export audit log records as JSON lines or CSV. '
+        'Records are read in fixed-size chunks ordered by timestamp, so memory use does not '
+        'depend on the size of the log, and an interrupted export can be resumed with --after.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-f', '--format', choices=('jsonl', 'csv'), default='jsonl',
+            help='Output format. Defaults to jsonl.'
+        )
+        parser.add_argument(
+            '-o', '--output', default='-',
+            help='File to write records to. Defaults to stdout.'
+        )
+        parser.add_argument(
+            '-m', '--model', action='append', default=[], dest='models', metavar='MODEL',
+            help='Only export records for this model (e.g., articles.Article). '
+                 'Can be specified multiple times.'
+        )
+        parser.add_argument(
+            '--since', default=None,
+            help='Only export records with a timestamp at or after this ISO date/time.'
+        )
+        parser.add_argument(
+            '--until', default=None,
+            help='Only export records with a timestamp before this ISO date/time.'
+        )
+        parser.add_argument(
+            '--after', default=None, metavar='TIMESTAMP,ID',
+            help='Resume an export after the record with this timestamp and ID. '
+                 'The cursor for the last exported record is shown when the export finishes '
+                 'or is interrupted. '
+                 'When resuming, records are appended to the output file, and the CSV header '
+                 'is not written again.'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Number of records to fetch per query. Defaults to 2000.'
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError('--chunk-size must be greater than 0')
+
+        queryset = self.get_queryset(options)
+        cursor = self.parse_cursor(options['after'])
+        resuming = cursor is not None
+        content_types = {}
+        num_exported = 0
+
+        if options['output'] == '-':
+            stream = self.stdout
+        else:
+            # When resuming, add to the partial export instead of
+            # replacing it.
+            mode = 'a' if resuming else 'w'
+            stream = open(options['output'], mode, encoding='utf-8', newline='')
+
+        finished = False
+        try:
+            write = self.get_writer(options['format'], stream, header=not resuming)
+            while True:
+                records = list(self.after(queryset, cursor)[:chunk_size])
+                if not records:
+                    break
+                for record in records:
+                    content_type_id = record.pop('content_type_id')
+                    if content_type_id not in content_types:
+                        content_type = ContentType.objects.get_for_id(content_type_id)
+                        content_types[content_type_id] = '{0.app_label}.{0.model}'.format(
+                            content_type)
+                    record['content_type'] = content_types[content_type_id]
+                    write(record)
+                    # Advance the cursor per record so an interrupted
+                    # export resumes right after the last record written.
+                    cursor = (record['timestamp'], record['id'])
+                    num_exported += 1
+                if options['verbosity'] > 1:
+                    self.stderr.write('Exported {0} records...'.format(num_exported))
+            finished = True
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+            if finished:
+                self.stderr.write('Exported {0} records'.format(num_exported))
+            else:
+                self.stderr.write('Export interrupted after {0} records'.format(num_exported))
+            if cursor is not None:
+                self.stderr.write('Resume with: --after {0}'.format(self.format_cursor(cursor)))
+
+    def get_queryset(self, options):
+        # Fetching plain values (rather than model instances) keeps each
+        # record small and avoids a content type query per record.
+        queryset = AuditLog.objects.order_by('timestamp', 'id').values(
+            'id',
+            'timestamp',
+            'changeset_id',
+            'sequence',
+            'user_id',
+            self.username_lookup,
+            'content_type_id',
+            'object_id',
+            'field_name',
+            'old_value',
+            'new_value',
+            'created',
+            'deleted',
+            'message',
+        )
+
+        if options['models']:
+            content_types = []
+            for name in options['models']:
+                try:
+                    model = apps.get_model(name)
+                except (LookupError, ValueError):
+                    raise CommandError('Unknown model: {0}'.format(name))
+                content_types.append(ContentType.objects.get_for_model(model))
+            queryset = queryset.filter(content_type__in=content_types)
+
+        since = self.parse_timestamp(options['since'], '--since')
+        if since is not None:
+            queryset = queryset.filter(timestamp__gte=since)
+
+        until = self.parse_timestamp(options['until'], '--until')
+        if until is not None:
+            queryset = queryset.filter(timestamp__lt=until)
+
+        return queryset
+
+    def after(self, queryset, cursor):
+        """Filter ``queryset`` to records after ``cursor``.
+
+        Records are ordered by (timestamp, id), so each chunk is fetched
+        with an indexed range query instead of an ever-growing OFFSET.
+
+        """
+        if cursor is None:
+            return queryset
+        timestamp, id_ = cursor
+        return queryset.filter(Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, id__gt=id_))
+
+    @property
+    def username_lookup(self):
+        return 'user__{0}'.format(get_user_model().USERNAME_FIELD)
+
+    def get_writer(self, format_, stream, header=True):
+        username_lookup = self.username_lookup
+
+        def prepare(record):
+            record['username'] = record.pop(username_lookup)
+            return record
+
+        if format_ == 'csv':
+            writer = csv.DictWriter(stream, FIELDS, lineterminator='\n')
+            if header:
+                writer.writeheader()
+
+            def write(record):
+                record = prepare(record)
+                record['old_value'] = json.dumps(record['old_value'], cls=DjangoJSONEncoder)
+                record['new_value'] = json.dumps(record['new_value'], cls=DjangoJSONEncoder)
+                writer.writerow(record)
+        else:
+            encoder = DjangoJSONEncoder(sort_keys=True)
+
+            def write(record):
+                record = prepare(record)
+                stream.write(encoder.encode(record) + '\n')
+
+        return write
+
+    def parse_timestamp(self, value, option_name):
+        if value is None:
+            return None
+        timestamp = parse_datetime(value)
+        if timestamp is None:
+            raise CommandError('{0} must be an ISO date/time; got {1}'.format(option_name, value))
+        if settings.USE_TZ and timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp)
+        return timestamp
+
+    def parse_cursor(self, value):
+        if value is None:
+            return None
+        try:
+            timestamp, id_ = value.rsplit(',', 1)
+            id_ = uuid.UUID(id_)
+        except ValueError:
+            raise CommandError('--after must be formatted as TIMESTAMP,ID; got {0}'.format(value))
+        return self.parse_timestamp(timestamp, '--after'), id_
+
+    def format_cursor(self, cursor):
+        timestamp, id_ = cursor
+        return '{0},{1}'.format(timestamp.isoformat(), id_)
@@ -0,0 +1,62 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from arcutils.auditor.retention import create_partitions, is_partitioned, prune
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Delete audit log records that are older than the retention periods configured in '
+        'the AUDITOR setting. Records are deleted in small batches to avoid holding long locks.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of records to delete per transaction. Defaults to 1000.'
+        )
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Seconds to sleep between batches. Defaults to 0.'
+        )
+        parser.add_argument(
+            '--archive', default=None, metavar='FILE',
+            help='Append deleted records to this file as JSON lines before deleting them.'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Show how many records would be deleted without deleting anything.'
+        )
+        parser.add_argument(
+            '--create-partitions', type=int, default=None, metavar='MONTHS',
+            help='Create monthly partitions for the current month and this many months '
+                 'ahead (PostgreSQL only; requires AUDITOR.partitioned).'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be greater than 0')
+
+        if options['create_partitions'] is not None:
+            if not is_partitioned():
+                raise CommandError('The audit log is not partitioned')
+            created = create_partitions(options['create_partitions'])
+            self.stdout.write('Created {0} partitions'.format(len(created)))
+
+        prune_args = {
+            'batch_size': batch_size,
+            'dry_run': options['dry_run'],
+            'pause': options['pause'],
+        }
+
+        if options['archive']:
+            with open(options['archive'], 'a', encoding='utf-8') as archive:
+                num_deleted = prune(archive=archive, **prune_args)
+        else:
+            num_deleted = prune(**prune_args)
+
+        if options['dry_run']:
+            self.stdout.write('Would delete {0} records'.format(num_deleted))
+        else:
+            self.stdout.write('Deleted {0} records'.format(num_deleted))
@@ -16,7 +16,7 @@ class AuditLog(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4)
 
     user = models.ForeignKey(settings.AUTH_USER_MODEL)
-    timestamp = models.DateTimeField()
+    timestamp = models.DateTimeField(db_index=True)
     changeset_id = models.UUIDField()
     sequence = models.PositiveIntegerField()
     message = models.CharField(max_length=255)
@@ -0,0 +1,184 @@
+from django.db import models, transaction
+
+from .controls import (
+    buffered_records,
+    get_audited_fields,
+    get_auditor_info,
+    get_bulk_changeset,
+    is_suspended,
+    should_sample,
+)
+
+
+class AuditedQuerySet(models.QuerySet):
+
+    """Audits bulk operations that don't send model signals.
+
+    Use this (or :class:`AuditedManager`) as the manager for models
+    listed in ``AUDITOR['models']``::
+
+        class Article(models.Model):
+
+            objects = AuditedManager()
+
+    ``update()`` and ``bulk_create()`` log their changes in bulk
+    without loading model instances: the affected rows' audited fields
+    are read (and the rows are locked) with a single query before
+    updating and the log records are written with ``bulk_create``.
+
+    ``delete()`` does send signals, so changes are logged as usual, but
+    the log records are written in bulk after the delete.
+
+    For models that aren't audited, or when auditing is suspended, these
+    methods behave exactly like their standard counterparts.
+
+    .. note:: ``QuerySet.bulk_update()`` isn't available in the versions
+              of Django supported by this package.
+
+    """
+
+    def update(self, **kwargs):
+        audited_fields = self._get_audited_fields()
+        if audited_fields is None:
+            return super().update(**kwargs)
+
+        fields = [f for f in audited_fields if self._get_update_key(f, kwargs) is not None]
+        if not fields:
+            return super().update(**kwargs)
+
+        bulk_changeset = get_bulk_changeset()
+        if bulk_changeset is not None:
+            count = super().update(**kwargs)
+            bulk_changeset.add(self.model, 'updated', count)
+            return count
+
+        info = get_auditor_info()
+        if info is None:
+            return super().update(**kwargs)
+
+        values = {}
+        has_expressions = False
+        for name in fields:
+            value = kwargs[self._get_update_key(name, kwargs)]
+            if hasattr(value, 'resolve_expression'):
+                has_expressions = True
+            elif isinstance(value, models.Model):
+                value = value.pk
+            values[name] = value
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            # The rows are locked so they can't be changed between
+            # reading their current values and updating them.
+            rows = self.select_for_update().values('pk', *fields)
+            before = [row for row in rows if should_sample(self.model, row['pk'])]
+            count = super().update(**kwargs)
+
+            if has_expressions:
+                # Values computed by the database have to be read back.
+                pks = [row['pk'] for row in before]
+                queryset = self.model._base_manager.using(self.db).filter(pk__in=pks)
+                after = {row['pk']: row for row in queryset.values('pk', *fields)}
+            else:
+                after = None
+
+            records = []
+            for old in before:
+                new = values if after is None else after[old['pk']]
+                for name in fields:
+                    if old[name] != new[name]:
+                        records.append(self._make_record(
+                            info, old['pk'], name, old[name], new[name],
+                            'Automatically-detected update'))
+            self._save_records(records)
+
+        return count
+
+    update.alters_data = True
+
+    def delete(self):
+        if self._get_audited_fields() is None:
+            return super().delete()
+        with transaction.atomic(using=self.db, savepoint=False):
+            with buffered_records() as records:
+                result = super().delete()
+            self._save_records(records)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, batch_size=None):
+        audited_fields = self._get_audited_fields()
+        if audited_fields is None:
+            return super().bulk_create(objs, batch_size)
+
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = super().bulk_create(objs, batch_size)
+
+            bulk_changeset = get_bulk_changeset()
+            if bulk_changeset is not None:
+                bulk_changeset.add(self.model, 'created', len(objs))
+                return objs
+
+            info = get_auditor_info()
+            if info is None:
+                return objs
+
+            fields = [self.model._meta.get_field(name) for name in audited_fields]
+            records = []
+            for obj in objs:
+                if not should_sample(self.model, obj.pk):
+                    continue
+                for field in fields:
+                    # NOTE: On databases that don't return the IDs of
+                    #       bulk-created rows (anything but PostgreSQL),
+                    #       the primary key will be unknown unless it
+                    #       was set explicitly.
+                    records.append(self._make_record(
+                        info, obj.pk, field.name, None, field.value_from_object(obj),
+                        'Automatically-detected creation', created=True))
+            self._save_records(records)
+
+        return objs
+
+    def _get_audited_fields(self):
+        if is_suspended():
+            return None
+        return get_audited_fields(self.model)
+
+    def _get_update_key(self, name, kwargs):
+        field = self.model._meta.get_field(name)
+        for key in (field.name, field.attname):
+            if key in kwargs:
+                return key
+        return None
+
+    def _make_record(self, info, pk, field_name, old_value, new_value, message, created=False,
+                     deleted=False):
+        # Imported here so this module can be imported from projects'
+        # models modules.
+        from django.contrib.contenttypes.models import ContentType
+        from .models import AuditLog
+
+        return AuditLog(
+            user=info.user,
+            timestamp=info.timestamp,
+            changeset_id=info.changeset_id,
+            sequence=next(info.sequencer),
+            message=message,
+            content_type=ContentType.objects.get_for_model(self.model),
+            object_id='' if pk is None else str(pk),
+            field_name=field_name,
+            old_value=old_value,
+            new_value=new_value,
+            created=created,
+            deleted=deleted,
+        )
+
+    def _save_records(self, records):
+        from .models import AuditLog
+        if records:
+            AuditLog.objects.bulk_create(records, batch_size=1000)
+
+
+AuditedManager = models.Manager.from_queryset(AuditedQuerySet)
@@ -0,0 +1,246 @@
+"""Retention policies for audit log records.
+
+Retention is configured in the ``AUDITOR`` settings, either for all
+records or per model::
+
+    AUDITOR = {
+        'retention_days': 365 * 3,
+        'models': [{
+            'name': 'articles.Article',
+            'fields': ['body', 'status'],
+            'retention_days': 365,
+        }, {
+            'name': 'articles.Comment',
+            'fields': ['body'],
+            'retention_days': None,  # Keep forever
+        }]
+    }
+
+Expired records are removed by :func:`prune`, which can be run via the
+``pruneauditlog`` management command or as a daily task::
+
+    from arcutils.auditor.retention import prune
+    daily_tasks.add_task(prune, 2, 30, kwargs={'batch_size': 5000})
+
+"""
+import datetime
+import logging
+import re
+import time
+from collections import OrderedDict, namedtuple
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .models import AuditLog
+from .settings import settings
+
+
+log = logging.getLogger(__name__)
+
+
+RetentionPolicy = namedtuple('RetentionPolicy', 'name cutoff queryset')
+
+
+def get_retention_policies(now=None):
+    """Get retention policies from settings.
+
+    Returns a list of :class:`RetentionPolicy`s. The ``queryset`` of
+    each policy selects the records that have expired under that
+    policy.
+
+    """
+    now = now or timezone.now()
+    policies = []
+    overridden = []
+
+    for spec in settings.get('models', ()):
+        if 'retention_days' not in spec:
+            continue
+        model = apps.get_model(spec['name'])
+        content_type = ContentType.objects.get_for_model(model)
+        overridden.append(content_type)
+        days = spec['retention_days']
+        if days is not None:
+            cutoff = now - datetime.timedelta(days=days)
+            queryset = AuditLog.objects.filter(content_type=content_type, timestamp__lt=cutoff)
+            policies.append(RetentionPolicy(spec['name'], cutoff, queryset))
+
+    days = settings.get('retention_days', None)
+    if days is not None:
+        cutoff = now - datetime.timedelta(days=days)
+        queryset = AuditLog.objects.filter(timestamp__lt=cutoff)
+        queryset = queryset.exclude(content_type__in=overridden)
+        policies.append(RetentionPolicy('default', cutoff, queryset))
+
+    return policies
+
+
+def prune(batch_size=1000, archive=None, dry_run=False, pause=0, now=None, using=None):
+    """Delete expired audit log records.
+
+    Records are deleted oldest first in batches of ``batch_size``. Each
+    batch is deleted in its own transaction so that locks are only held
+    briefly. ``pause`` is the number of seconds to sleep between
+    batches, which can be used to further reduce the load on a busy
+    database.
+
+    If an ``archive`` file object is passed, each deleted record will
+    be written to it as a line of JSON before it's deleted.
+
+    If the audit log is partitioned (see :func:`create_partitions`),
+    monthly partitions in which every record has expired are dropped
+    first (unless ``archive`` is passed). The records in those
+    partitions are included in the count of deleted records.
+
+    Returns the number of records that were (or, when ``dry_run`` is
+    set, would be) deleted.
+
+    """
+    using = using or router.db_for_write(AuditLog)
+    policies = get_retention_policies(now)
+    num_deleted = 0
+
+    if not dry_run and archive is None and is_partitioned(using):
+        dropped = drop_expired_partitions(policies, using)
+        num_deleted += sum(dropped.values())
+
+    for policy in policies:
+        queryset = policy.queryset.using(using).order_by('timestamp')
+
+        if dry_run:
+            count = queryset.count()
+            log.info('Would delete %d audit log records for %s', count, policy.name)
+            num_deleted += count
+            continue
+
+        count = 0
+        while True:
+            with transaction.atomic(using=using):
+                ids = list(queryset.values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    break
+                batch = AuditLog.objects.using(using).filter(id__in=ids)
+                if archive is not None:
+                    encoder = DjangoJSONEncoder(sort_keys=True)
+                    for record in batch.values():
+                        archive.write(encoder.encode(record) + '\n')
+                batch.delete()
+            count += len(ids)
+            if pause:
+                time.sleep(pause)
+
+        log.info('Deleted %d audit log records for %s', count, policy.name)
+        num_deleted += count
+
+    return num_deleted
+
+
+# Partitioning (PostgreSQL 11+ only)
+
+
+PARTITION_NAME_RE = re.compile(r'_y(?P<year>\d{4})m(?P<month>\d{2})$')
+
+
+def is_partitioned(using=None):
+    using = using or router.db_for_write(AuditLog)
+    return settings.get('partitioned', False) and connections[using].vendor == 'postgresql'
+
+
+def get_month_bounds(year, month):
+    start = datetime.datetime(year, month, 1, tzinfo=timezone.utc)
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    end = datetime.datetime(year, month, 1, tzinfo=timezone.utc)
+    return start, end
+
+
+def get_partition_name(year, month):
+    return '{table}_y{year:04d}m{month:02d}'.format(
+        table=AuditLog._meta.db_table, year=year, month=month)
+
+
+def get_partitions(using=None):
+    """Get the audit log's partitions as (name, start, end) tuples."""
+    using = using or router.db_for_write(AuditLog)
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname FROM pg_inherits '
+            'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE parent.relname = %s',
+            [AuditLog._meta.db_table])
+        names = [row[0] for row in cursor.fetchall()]
+    partitions = []
+    for name in sorted(names):
+        match = PARTITION_NAME_RE.search(name)
+        if match:
+            start, end = get_month_bounds(int(match.group('year')), int(match.group('month')))
+            partitions.append((name, start, end))
+    return partitions
+
+
+def create_partitions(months=3, now=None, using=None):
+    """Create monthly partitions for the current and upcoming months.
+
+    This requires the audit log table to have been converted into a
+    table partitioned by range on ``timestamp``; see the README.
+
+    Returns the names of the partitions that were created.
+
+    """
+    using = using or router.db_for_write(AuditLog)
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    now = now or timezone.now()
+    year, month = now.year, now.month
+    existing = {name for (name, _, _) in get_partitions(using)}
+    created = []
+    with connection.cursor() as cursor:
+        for _ in range(months + 1):
+            name = get_partition_name(year, month)
+            if name not in existing:
+                start, end = get_month_bounds(year, month)
+                cursor.execute(
+                    'CREATE TABLE {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)'.format(
+                        name=quote_name(name), table=quote_name(AuditLog._meta.db_table)),
+                    [start, end])
+                log.info('Created audit log partition %s', name)
+                created.append(name)
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return created
+
+
+def drop_expired_partitions(policies, using=None):
+    """Drop monthly partitions in which every record has expired.
+
+    Partitions contain records for all models, so a partition can only
+    be dropped when there's a default retention period, no model is set
+    to keep its records forever, and the partition ends before the
+    earliest cutoff of any policy.
+
+    Returns a dict mapping the names of the partitions that were dropped
+    to the number of records they contained.
+
+    """
+    using = using or router.db_for_write(AuditLog)
+    keep_forever = any(
+        spec.get('retention_days', 0) is None for spec in settings.get('models', ()))
+    if keep_forever or settings.get('retention_days', None) is None or not policies:
+        return OrderedDict()
+    cutoff = min(policy.cutoff for policy in policies)
+    quote_name = connections[using].ops.quote_name
+    dropped = OrderedDict()
+    with connections[using].cursor() as cursor:
+        for name, start, end in get_partitions(using):
+            if end <= cutoff:
+                # Count the records first so they can be reported along
+                # with the records that are deleted row by row.
+                cursor.execute('SELECT COUNT(*) FROM {name}'.format(name=quote_name(name)))
+                count = cursor.fetchone()[0]
+                cursor.execute('DROP TABLE {name}'.format(name=quote_name(name)))
+                log.info('Dropped audit log partition %s (%d records)', name, count)
+                dropped[name] = count
+    return dropped
@@ -1,4 +1,20 @@
 from arcutils.settings import PrefixedSettings
 
 
-settings = PrefixedSettings('AUDITOR', defaults={})
+DEFAULTS = {
+    # Models and fields to audit; see the README.
+    'models': [],
+
+    # Number of days to keep audit log records. This can be overridden
+    # per model by adding 'retention_days' to a model's spec. ``None``
+    # means records are kept forever.
+    'retention_days': None,
+
+    # Set this when the audit log table has been set up with monthly
+    # partitions in PostgreSQL; expired partitions will be dropped
+    # instead of deleting their records row by row.
+    'partitioned': False,
+}
+
+
+settings = PrefixedSettings('AUDITOR', DEFAULTS)
@@ -6,11 +6,25 @@ from django.forms.models import model_to_dict
 
 from arcutils.threadlocals import get_current_request
 
+from .controls import (
+    get_audited_fields,
+    get_bulk_changeset,
+    is_suspended,
+    register,
+    save_record,
+    set_rules,
+    should_sample,
+)
 from .models import AuditLog
 from .settings import settings
 
 
-ModelToAudit = namedtuple('Model', 'name fields model')
+ModelToAudit = namedtuple('Model', 'name fields model sample_rate exclude_fields')
+
+
+# Used to disconnect the post_init receiver (e.g., to measure loads
+# without snapshots in the benchmarks).
+SAVE_CURRENT_DATA_UID = 'arcutils.auditor.save_current_data'
 
 
 def get_models_to_audit():
@@ -27,16 +41,23 @@ def get_models_to_audit():
         for field in fields:
             model._meta.get_field(field)
 
-        models.append(ModelToAudit(name, fields, model))
+        sample_rate = spec.get('sample_rate', 1.0)
+        exclude_fields = spec.get('exclude_fields', ())
+
+        models.append(ModelToAudit(name, fields, model, sample_rate, exclude_fields))
 
     return models
 
 
 def connect(app):
     models = get_models_to_audit()
-    for (name, fields, model) in models:
+    for (name, fields, model, sample_rate, exclude_fields) in models:
+        register(model, fields)
+        set_rules(model, sample_rate=sample_rate, exclude_fields=exclude_fields)
+
         save_current_values = save_current_data_factory(model, fields)
-        post_init.connect(save_current_values, sender=model, weak=False)
+        post_init.connect(
+            save_current_values, sender=model, weak=False, dispatch_uid=SAVE_CURRENT_DATA_UID)
 
         add_audit_log_record = add_audit_log_record_factory(model, fields)
         post_save.connect(add_audit_log_record, sender=model, weak=False)
@@ -48,7 +69,20 @@ def connect(app):
 def save_current_data_factory(model, fields):
 
     def save_current_data(sender, instance, **kwargs):
-        data = model_to_dict(instance, fields)
+        # Previous values aren't needed when auditing is suspended or
+        # changes are being summarized, so loads in those contexts
+        # don't pay for a snapshot. If an instance loaded in one of
+        # those contexts is saved later, its previous values are
+        # logged as unknown.
+        if is_suspended() or get_bulk_changeset() is not None:
+            instance._auditor_data = None
+            return
+        # New instances usually don't have a primary key yet, so
+        # they're sampled when they're saved instead.
+        if instance.pk is not None and not should_sample(model, instance.pk):
+            instance._auditor_skip = True
+            return
+        data = model_to_dict(instance, get_audited_fields(model))
         instance._auditor_data = data
 
     return save_current_data
@@ -57,13 +91,36 @@ def save_current_data_factory(model, fields):
 def add_audit_log_record_factory(model, fields):
 
     def add_audit_log_record(sender, instance, created, **kwargs):
+        if is_suspended():
+            return
+
+        bulk_changeset = get_bulk_changeset()
+
+        # Sampling doesn't apply to summaries; every change is counted.
+        if bulk_changeset is not None:
+            bulk_changeset.add(model, 'created' if created else 'updated')
+            return
+
+        if getattr(instance, '_auditor_skip', False):
+            return
+
+        # Instances loaded before auditing was set up (or while it was
+        # suspended) won't have saved data.
+        saved_data = getattr(instance, '_auditor_data', None)
+
+        # Instances that have saved data were sampled when they were
+        # loaded.
+        if (created or saved_data is None) and not should_sample(model, instance.pk):
+            instance._auditor_skip = True
+            return
+
         request = get_current_request()
 
         if request is None:
             return
 
         def add_record(field_name, old_value, new_value, message):
-            AuditLog.objects.create(
+            save_record(AuditLog(
                 user=info.user,
                 timestamp=info.timestamp,
                 changeset_id=info.changeset_id,
@@ -75,17 +132,23 @@ def add_audit_log_record_factory(model, fields):
                 new_value=new_value,
                 created=created,
                 deleted=False,
-            )
+            ))
 
         info = request.auditor_info
-        saved_data = instance._auditor_data
+        audited_fields = get_audited_fields(model)
 
         if created:
-            for field in fields:
+            for field in audited_fields:
                 message = 'Automatically-detected creation'
                 add_record(field, None, getattr(instance, field), message)
+        elif saved_data is None:
+            for field in audited_fields:
+                message = 'Automatically-detected update (previous value unknown)'
+                add_record(field, None, getattr(instance, field), message)
         else:
-            for field in fields:
+            for field in audited_fields:
+                if field not in saved_data:
+                    continue
                 old_val = saved_data[field]
                 new_val = getattr(instance, field)
                 if old_val != new_val:
@@ -98,13 +161,31 @@ def add_audit_log_record_factory(model, fields):
 def add_last_audit_log_record_factory(model, fields):
 
     def add_last_audit_log_record(sender, instance, **kwargs):
+        if is_suspended():
+            return
+
+        bulk_changeset = get_bulk_changeset()
+
+        if bulk_changeset is not None:
+            bulk_changeset.add(model, 'deleted')
+            return
+
+        if getattr(instance, '_auditor_skip', False):
+            return
+
+        # Instances that have saved data were sampled when they were
+        # loaded.
+        saved_data = getattr(instance, '_auditor_data', None)
+        if saved_data is None and not should_sample(model, instance.pk):
+            return
+
         request = get_current_request()
 
         if request is None:
             return
 
         def add_record(field_name, old_value, new_value, message):
-            AuditLog.objects.create(
+            save_record(AuditLog(
                 user=info.user,
                 timestamp=info.timestamp,
                 changeset_id=info.changeset_id,
@@ -116,11 +197,11 @@ def add_last_audit_log_record_factory(model, fields):
                 new_value=new_value,
                 created=False,
                 deleted=True,
-            )
+            ))
 
         info = request.auditor_info
 
-        for field in fields:
+        for field in get_audited_fields(model):
             message = 'Automatically-detected deletion'
             add_record(field, getattr(instance, field), None, message)
 
@@ -1,16 +1,178 @@
-from enum import Enum
+from collections import Mapping, OrderedDict, namedtuple
+from enum import Enum, EnumMeta
+
+
+DEFAULT_FETCH_SIZE = 1000
+
+
+def get_column_names(cursor):
+    """Return the column names for the last query run on cursor."""
+    return [col[0] for col in cursor.description]
 
 
 def dictfetchall(cursor):
     """Return all rows from cursor as a list of dicts."""
-    desc = cursor.description
-    return [
-        dict(zip([col[0] for col in desc], row))
-        for row in cursor.fetchall()
-    ]
+    columns = get_column_names(cursor)
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def fetchiter(cursor, size=DEFAULT_FETCH_SIZE, close=False):
+    """Iterate over rows from cursor, fetching ``size`` rows at a time.
+
+    Rows are yielded as tuples. Unlike ``cursor.fetchall()``, this only
+    holds ``size`` rows in memory at a time, so it can be used to
+    stream large result sets, e.g. with ``StreamingHttpResponse``::
+
+        def report_view(request):
+            cursor = connection.cursor()
+            cursor.execute('SELECT ...')
+            rows = dictfetchiter(cursor, close=True)
+            lines = (json.dumps(row) + '\\n' for row in rows)
+            return StreamingHttpResponse(lines, content_type='application/x-ndjson')
+
+    Pass ``close=True`` to close the cursor when iteration finishes or
+    is abandoned (when the response is closed, for example). Don't use
+    the cursor as a context manager in this case, since it would be
+    closed before the response is streamed.
+
+    .. note:: Some database drivers, including psycopg2, load the entire
+              result set into memory when a query is executed unless
+              a server-side (named) cursor is used.
+
+    """
+    try:
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        if close:
+            cursor.close()
+
+
+def dictfetchiter(cursor, size=DEFAULT_FETCH_SIZE, close=False):
+    """Iterate over rows from cursor as dicts.
+
+    See :func:`fetchiter` for details.
+
+    """
+    columns = get_column_names(cursor)
+    for row in fetchiter(cursor, size, close):
+        yield dict(zip(columns, row))
 
 
-def will_be_deleted_with(instance):
+def namedtuplefetchiter(cursor, size=DEFAULT_FETCH_SIZE, close=False, name='Row'):
+    """Iterate over rows from cursor as named tuples.
+
+    The named tuple type is created once per call, and its instances are
+    considerably smaller than dicts. Column names that aren't valid
+    Python identifiers are renamed to ``_0``, ``_1``, etc (by position).
+
+    See :func:`fetchiter` for details.
+
+    """
+    row_type = namedtuple(name, get_column_names(cursor), rename=True)
+    return map(row_type._make, fetchiter(cursor, size, close))
+
+
+def columnfetch(cursor, dtypes=None, size=DEFAULT_FETCH_SIZE, structured=False):
+    """Fetch all rows from cursor into NumPy arrays.
+
+    By default, an ordered dict mapping column names to 1-D arrays is
+    returned. Pass ``structured=True`` to get a single structured array
+    (with a field per column) instead.
+
+    Rows are fetched ``size`` at a time and packed into arrays a chunk
+    at a time, so no per-row dicts are created, and the results can be
+    aggregated with vectorized NumPy operations::
+
+        cursor.execute('SELECT department, salary FROM employee')
+        columns = columnfetch(cursor, dtypes={'salary': 'f8'})
+        columns['salary'].mean()
+
+    ``dtypes`` can be a dict mapping column names to NumPy dtypes or
+    a sequence of dtypes (one per column). The dtypes of columns that
+    aren't specified are inferred from their values: boolean and numeric
+    columns are packed; everything else (strings, dates, columns
+    containing NULLs, etc) is stored as Python objects. When a chunk
+    has values that don't fit the dtype inferred from earlier chunks
+    (e.g., a float or a NULL in a column of ints), the column is widened
+    (to float or object) so no values are lost.
+
+    .. note:: This requires NumPy, which is an optional dependency.
+
+    """
+    import numpy
+
+    columns = get_column_names(cursor)
+
+    if len(set(columns)) != len(columns):
+        raise ValueError('Column names must be unique; use aliases for duplicate columns')
+
+    if dtypes is None:
+        dtypes = {}
+    elif not isinstance(dtypes, Mapping):
+        dtypes = dict(zip(columns, dtypes))
+
+    dtype = None
+    chunks = []
+    column_chunks = OrderedDict((name, []) for name in columns)
+
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            break
+        chunk_dtype = numpy.dtype([
+            (name, dtypes.get(name) or _infer_dtype(numpy, rows, i))
+            for i, name in enumerate(columns)
+        ])
+        if dtype is None:
+            dtype = chunk_dtype
+        elif chunk_dtype != dtype:
+            dtype = numpy.dtype([
+                (name, _widen_dtype(numpy, dtype[name], chunk_dtype[name]))
+                for name in columns
+            ])
+        chunk = numpy.array([tuple(row) for row in rows], dtype=chunk_dtype)
+        if structured:
+            chunks.append(chunk)
+        else:
+            for name in columns:
+                column_chunks[name].append(chunk[name].copy())
+
+    if dtype is None:
+        dtype = numpy.dtype([(name, dtypes.get(name) or object) for name in columns])
+
+    # Chunks packed before a column was widened are converted to the
+    # final dtype here.
+    if structured:
+        if not chunks:
+            return numpy.empty(0, dtype)
+        return numpy.concatenate([chunk.astype(dtype, copy=False) for chunk in chunks])
+
+    return OrderedDict(
+        (name, numpy.concatenate([a.astype(dtype[name], copy=False) for a in arrays])
+            if arrays else numpy.empty(0, dtype[name]))
+        for name, arrays in column_chunks.items()
+    )
+
+
+def _infer_dtype(numpy, rows, index):
+    dtype = numpy.array([row[index] for row in rows]).dtype
+    return dtype if dtype.kind in 'biuf' else numpy.dtype(object)
+
+
+def _widen_dtype(numpy, dtype, other):
+    """Get a dtype that can hold values of ``dtype`` and ``other``."""
+    if dtype == other:
+        return dtype
+    if dtype.kind in 'biuf' and other.kind in 'biuf':
+        return numpy.promote_types(dtype, other)
+    return numpy.dtype(object)
+
+
+def will_be_deleted_with(instance, using=None, summary=False):
     """Get items that would be deleted along with model ``instance``.
 
     Pass in any Django model instance that you intend to delete and get
@@ -19,18 +181,41 @@ def will_be_deleted_with(instance):
     Since this is implemented as a generator, if you want a list of
     items, you'll need to do ``list(will_be_deleted_with(instance))``.
 
+    Collecting every related object can be slow when there are a lot of
+    them (e.g., on a delete confirmation page). Pass ``summary=True``
+    to get the number of objects per model instead; the counts are
+    computed with one ``COUNT`` query per model without loading any
+    objects. Only ``CASCADE`` relations are followed in summary mode.
+
     Args:
         instance: A Django ORM instance
+        using: The database to use; defaults to the database
+            ``instance`` was loaded from
+        summary: Yield counts instead of items
 
     Returns:
         pairs: (model class, items of that class that will be deleted)
+            or (model class, number of items that will be deleted)
 
     """
+    using = _get_db_for_instance(instance, using)
+
+    if summary:
+        model = instance.__class__
+        queryset = model._base_manager.using(using).filter(pk=instance.pk)
+        for cls, queryset in _get_cascade(queryset, using):
+            if cls is model:
+                queryset = queryset.exclude(pk=instance.pk)
+            count = queryset.count()
+            if count:
+                yield cls, count
+        return
+
     # XXX: Not sure why this import can't be moved to module scope.
     from django.contrib.admin.utils import NestedObjects
     # The collector returns a list of all objects in the database that
     # would be deleted if `obj` were deleted.
-    collector = NestedObjects(using='default')
+    collector = NestedObjects(using=using)
     collector.collect([instance])
     for cls, items_to_delete in collector.data.items():
         # XXX: Not sure the collector will ever include the original
@@ -42,7 +227,183 @@ def will_be_deleted_with(instance):
             yield cls, items_to_delete
 
 
-class ChoiceEnum(Enum):
+def delete_in_chunks(instance_or_queryset, chunk_size=DEFAULT_FETCH_SIZE, using=None):
+    """Delete ``instance_or_queryset`` and its related objects in chunks.
+
+    A regular delete collects every related object in memory and then
+    deletes everything in one transaction, which can take a long time
+    and lock a lot of rows when there are many related objects.
+
+    This deletes the object(s) ``chunk_size`` at a time. For each chunk,
+    objects related via ``CASCADE`` relations are deleted first,
+    starting with those furthest from the chunk, in chunks of
+    ``chunk_size``. Each chunk is deleted in its own transaction using
+    the regular delete machinery, so signals are sent and ``SET_NULL``,
+    ``PROTECT``, etc are handled as usual.
+
+    The primary keys of the objects in a queryset are read before
+    anything is deleted, so querysets that are filtered through related
+    objects (which may be deleted along the way) work as expected.
+
+    Note that since each chunk is committed separately, an error part
+    way through will leave some related objects deleted.
+
+    Args:
+        instance_or_queryset: A Django ORM instance or a queryset
+        chunk_size: The maximum number of objects to delete at once
+        using: The database to use; defaults to the database the
+            object(s) were loaded from
+
+    Returns:
+        OrderedDict: The number of objects deleted per model class, in
+            the order they were deleted
+
+    """
+    from django.db.models import QuerySet
+
+    if isinstance(instance_or_queryset, QuerySet):
+        queryset = instance_or_queryset
+        model = queryset.model
+        using = using or queryset.db
+        # A queryset filtered through a relation can have duplicates.
+        pks = list(OrderedDict.fromkeys(queryset.using(using).values_list('pk', flat=True)))
+    else:
+        instance = instance_or_queryset
+        model = instance.__class__
+        using = _get_db_for_instance(instance, using)
+        pks = [instance.pk]
+
+    manager = model._base_manager.using(using)
+    counts = OrderedDict()
+
+    for i in range(0, len(pks), chunk_size):
+        chunk = manager.filter(pk__in=pks[i:i + chunk_size])
+
+        # Deleting the deepest objects first means each chunk's delete
+        # has little or nothing left to cascade to.
+        cascade = list(_get_cascade(chunk, using, with_depth=True))
+        cascade.sort(key=lambda item: item[2], reverse=True)
+        cascade.append((model, chunk, 0))
+
+        for cls, queryset, _ in cascade:
+            count = _delete_queryset_in_chunks(cls, queryset, chunk_size, using)
+            if count:
+                counts[cls] = counts.get(cls, 0) + count
+
+    return counts
+
+
+def _delete_queryset_in_chunks(model, queryset, chunk_size, using):
+    from django.db import transaction
+
+    count = 0
+    while True:
+        with transaction.atomic(using=using):
+            pks = list(queryset.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            model._base_manager.using(using).filter(pk__in=pks).delete()
+        count += len(pks)
+    return count
+
+
+def _get_db_for_instance(instance, using=None):
+    if using is not None:
+        return using
+    if instance._state.db is not None:
+        return instance._state.db
+    from django.db import router
+    return router.db_for_write(instance.__class__, instance=instance)
+
+
+def _get_cascade(queryset, using, max_depth=20, with_depth=False):
+    """Find the models that a delete of ``queryset`` would cascade to.
+
+    Yields a (model class, queryset) pair for each model with at least
+    one object that would be deleted via a ``CASCADE`` relation. The
+    querysets select related objects using subqueries, so no objects
+    are loaded here (other than to check whether related objects exist
+    at each level).
+
+    When ``with_depth`` is set, the maximum distance (in relations)
+    from ``queryset`` at which each model was found is included too.
+
+    ``max_depth`` limits how far self-referential and circular
+    relations are followed.
+
+    """
+    from functools import reduce
+    from operator import or_
+    from django.db.models import CASCADE, Q
+    from django.db.models.deletion import get_candidate_relations_to_delete
+
+    found = OrderedDict()  # model -> [conditions, depth]
+    frontier = [(queryset.model, queryset)]
+    depth = 0
+
+    while frontier and depth < max_depth:
+        depth += 1
+        level = OrderedDict()
+        for model, parent_queryset in frontier:
+            for related in get_candidate_relations_to_delete(model._meta):
+                if related.on_delete is CASCADE:
+                    lookup = '{0}__in'.format(related.field.name)
+                    condition = Q(**{lookup: parent_queryset})
+                    level.setdefault(related.related_model, []).append(condition)
+        frontier = []
+        for model, conditions in level.items():
+            related_queryset = model._base_manager.using(using).filter(reduce(or_, conditions))
+            if related_queryset.exists():
+                entry = found.setdefault(model, [[], depth])
+                entry[0].extend(conditions)
+                entry[1] = depth
+                frontier.append((model, related_queryset))
+
+    for model, (conditions, depth) in found.items():
+        related_queryset = model._base_manager.using(using).filter(reduce(or_, conditions))
+        if with_depth:
+            yield model, related_queryset, depth
+        else:
+            yield model, related_queryset
+
+
+class ChoiceEnumMeta(EnumMeta):
+
+    """Precomputes lookup tables when a :class:`ChoiceEnum` is created.
+
+    Labels, choices, and value => member mappings are computed once per
+    class so that looking them up for each row of a large result set is
+    a single dict lookup.
+
+    """
+
+    def __new__(metacls, *args, **kwargs):
+        cls = super().__new__(metacls, *args, **kwargs)
+        members = list(cls)
+        for member in members:
+            member._label = member._make_label()
+        # Keyed by both value and member so that either can be used for
+        # lookups. Members aren't equal to their values, so these keys
+        # don't collide.
+        cls._members = {}
+        cls._labels = {}
+        for member in members:
+            label = member.label
+            cls._members[member.value] = cls._members[member] = member
+            cls._labels[member.value] = cls._labels[member] = label
+        for value, member in cls._value2member_map_.items():
+            # Aliases
+            cls._members.setdefault(value, member)
+            cls._labels.setdefault(value, member.label)
+        # Tuples so the precomputed tables can't be modified in place;
+        # as_choices() hands out copies.
+        cls._choices = tuple((member.value, member.label) for member in members)
+        cls._choice_dicts = tuple(
+            {'value': value, 'label': label} for (value, label) in cls._choices)
+        return cls
+
+
+class ChoiceEnum(Enum, metaclass=ChoiceEnumMeta):
 
     """An enum type for use w/ the ``choices`` arg of model fields.
 
@@ -77,6 +438,11 @@ class ChoiceEnum(Enum):
             status = models.CharField(
                 max_length=255, choices=Status.as_choices(), default=Status.new.value)
 
+    Labels and choices are computed once, when the class is created.
+
+    To store members directly in a model field (rather than their
+    values), use :class:`arcutils.db.models.ChoiceEnumField`.
+
     """
 
     @classmethod
@@ -91,11 +457,49 @@ class ChoiceEnum(Enum):
             >>> LayoutType.as_choices()
             [(0, 'Text only'), (1, 'Chart'), (2, 'Map'), (3, 'Image')]
 
+        The choices are precomputed; a new list (and new dicts) are
+        returned on each call, so modifying the result is safe.
+
         """
-        choices = [(choice.value, choice.label) for choice in cls]
         if as_dict:
-            choices = [{'value': value, 'label': label} for (value, label) in choices]
-        return choices
+            return [dict(choice) for choice in cls._choice_dicts]
+        return list(cls._choices)
+
+    @classmethod
+    def from_value(cls, value):
+        """Get the member for ``value`` (which can also be a member).
+
+        This is like ``cls(value)`` but faster.
+
+            >>> LayoutType.from_value(3)
+            <LayoutType.image: 3>
+            >>> LayoutType.from_value(LayoutType.image)
+            <LayoutType.image: 3>
+
+        Raises:
+            ValueError: ``value`` isn't a valid value
+
+        """
+        try:
+            return cls._members[value]
+        except (KeyError, TypeError):
+            raise ValueError('{0!r} is not a valid {1}'.format(value, cls.__name__))
+
+    @classmethod
+    def get_label(cls, value):
+        """Get the label for ``value`` (which can also be a member).
+
+            >>> LayoutType.get_label(3)
+            'Image'
+
+        Raises:
+            ValueError: ``value`` isn't a valid value
+
+        """
+        try:
+            return cls._labels[value]
+        except (KeyError, TypeError):
+            raise ValueError('{0!r} is not a valid {1}'.format(value, cls.__name__))
 
     @property
     def label(self):
@@ -111,6 +515,9 @@ class ChoiceEnum(Enum):
             'Image'
 
         """
+        return self._label
+
+    def _make_label(self):
         parts = self.name.split('_')
         parts[0] = parts[0].title()
         return ' '.join(parts)
@@ -0,0 +1,237 @@
+"""Helpers for loading large numbers of rows in chunks.
+
+Each helper consumes its input in chunks of ``chunk_size`` rows, so rows
+can come from a generator and never all be held in memory, and each
+chunk is written with one statement (or one ``executemany`` call).
+
+Each helper returns a :class:`BulkStats` with the number of rows
+written and the elapsed time. Progress is logged after each chunk at
+the DEBUG level.
+
+Example::
+
+    def read_rows(path):
+        with open(path) as fp:
+            for line in fp:
+                yield Thing(**parse(line))
+
+    stats = chunked_bulk_create(Thing, read_rows('things.txt'))
+    print('{0.rows} rows at {0.rows_per_second:.0f} rows/second'.format(stats))
+
+"""
+import io
+import logging
+import time
+from collections import namedtuple
+from itertools import islice
+
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.db.models import Case, Value, When
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class BulkStats(namedtuple('BulkStats', 'rows chunks seconds')):
+
+    __slots__ = ()
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+def chunked(iterable, size=DEFAULT_CHUNK_SIZE):
+    """Split ``iterable`` into lists of ``size`` items (or fewer).
+
+        >>> list(chunked(range(5), 2))
+        [[0, 1], [2, 3], [4]]
+
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+def _process_chunks(description, iterable, chunk_size, process_chunk):
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be greater than 0')
+    rows = chunks = 0
+    start = time.perf_counter()
+    for chunk in chunked(iterable, chunk_size):
+        process_chunk(chunk)
+        rows += len(chunk)
+        chunks += 1
+        seconds = time.perf_counter() - start
+        log.debug(
+            '%s: %d rows in %.1fs (%.0f rows/second)',
+            description, rows, seconds, BulkStats(rows, chunks, seconds).rows_per_second)
+    stats = BulkStats(rows, chunks, time.perf_counter() - start)
+    log.info(
+        '%s: %d rows in %d chunks in %.1fs (%.0f rows/second)',
+        description, stats.rows, stats.chunks, stats.seconds, stats.rows_per_second)
+    return stats
+
+
+def chunked_bulk_create(model, objs, chunk_size=DEFAULT_CHUNK_SIZE, using=None):
+    """Create ``objs`` with one ``bulk_create`` per chunk.
+
+    ``objs`` can be any iterable of ``model`` instances, including a
+    generator. As with ``bulk_create``, model ``save()`` methods aren't
+    called and no signals are sent.
+
+    """
+    queryset = model._default_manager.using(using or router.db_for_write(model))
+
+    def process_chunk(chunk):
+        queryset.bulk_create(chunk)
+
+    # Options.label is only available in Django 1.9+
+    description = 'Created {0.app_label}.{0.object_name}'.format(model._meta)
+    return _process_chunks(description, objs, chunk_size, process_chunk)
+
+
+def chunked_bulk_update(model, objs, fields, chunk_size=DEFAULT_CHUNK_SIZE, using=None):
+    """Update ``fields`` of ``objs`` with one ``UPDATE`` per chunk.
+
+    This is like ``QuerySet.bulk_update()`` in Django 2.2+: each field
+    is set with a ``CASE`` expression that maps each object's primary
+    key to its value.
+
+    ``objs`` can be any iterable of saved ``model`` instances, including
+    a generator. Model ``save()`` methods aren't called and no signals
+    are sent.
+
+    Each object adds two query parameters per field plus one for its
+    primary key, so on backends that limit the number of parameters
+    per query (e.g., SQLite), chunks are split into batches that fit
+    (all in the chunk's transaction).
+
+    """
+    # Cast is only available in Django 1.10+
+    try:
+        from django.db.models.functions import Cast
+    except ImportError:
+        Cast = None
+
+    using = using or router.db_for_write(model)
+    queryset = model._default_manager.using(using)
+    fields = [model._meta.get_field(name) for name in fields]
+    if not fields:
+        raise ValueError('At least one field must be specified')
+    if any(field.primary_key or not field.concrete or field.many_to_many for field in fields):
+        raise ValueError('Only concrete, non-primary key fields can be updated')
+
+    connection = connections[using]
+
+    # PostgreSQL can't infer the types of CASE parameters.
+    cast = Cast is not None and connection.vendor == 'postgresql'
+
+    # One parameter per object for its primary key in the WHERE clause
+    # and two per field for its WHEN pk = ... THEN value.
+    parameter_fields = [model._meta.pk] + fields + fields
+
+    def update(batch):
+        updates = {}
+        for field in fields:
+            cases = []
+            for obj in batch:
+                value = Value(getattr(obj, field.attname), output_field=field)
+                if cast:
+                    value = Cast(value, output_field=field)
+                cases.append(When(pk=obj.pk, then=value))
+            updates[field.attname] = Case(*cases, output_field=field)
+        queryset.filter(pk__in=[obj.pk for obj in batch]).update(**updates)
+
+    def process_chunk(chunk):
+        batch_size = max(connection.ops.bulk_batch_size(parameter_fields, chunk), 1)
+        with transaction.atomic(using=using, savepoint=False):
+            for batch in chunked(chunk, batch_size):
+                update(batch)
+
+    description = 'Updated {0.app_label}.{0.object_name}'.format(model._meta)
+    return _process_chunks(description, objs, chunk_size, process_chunk)
+
+
+def chunked_executemany(cursor, sql, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Run ``cursor.executemany(sql, chunk)`` for each chunk of ``rows``.
+
+    ``rows`` can be any iterable of parameter sequences, including a
+    generator.
+
+    """
+    def process_chunk(chunk):
+        cursor.executemany(sql, chunk)
+
+    description = 'Executed {0}'.format(sql.split(None, 1)[0].upper())
+    return _process_chunks(description, rows, chunk_size, process_chunk)
+
+
+def insert_rows(table, columns, rows, chunk_size=DEFAULT_CHUNK_SIZE, using=DEFAULT_DB_ALIAS,
+                copy=True):
+    """Insert ``rows`` into ``table``.
+
+    ``rows`` can be any iterable of value sequences corresponding to
+    ``columns``, including a generator.
+
+    On PostgreSQL, when ``copy`` is set, each chunk is loaded with
+    ``COPY FROM``, which is considerably faster than ``INSERT``. Values
+    are converted to strings using ``str()`` (except ``None``, which is
+    converted to ``NULL``), which works for most simple types.
+
+    Otherwise, each chunk is inserted with ``executemany``.
+
+    Each chunk is inserted in its own transaction (unless this is
+    called in a transaction).
+
+    """
+    connection = connections[using]
+    quote_name = connection.ops.quote_name
+    table = quote_name(table)
+    placeholders = ', '.join('%s' for _ in columns)
+    columns = ', '.join(quote_name(column) for column in columns)
+
+    with connection.cursor() as cursor:
+        if copy and connection.vendor == 'postgresql':
+            sql = 'COPY {table} ({columns}) FROM STDIN'.format(table=table, columns=columns)
+
+            def process_chunk(chunk):
+                buffer = io.StringIO()
+                for row in chunk:
+                    buffer.write('\t'.join(_to_copy_text(value) for value in row))
+                    buffer.write('\n')
+                buffer.seek(0)
+                with transaction.atomic(using=using, savepoint=False):
+                    cursor.copy_expert(sql, buffer)
+
+            description = 'Copied to {0}'.format(table)
+        else:
+            sql = 'INSERT INTO {table} ({columns}) VALUES ({placeholders})'.format(
+                table=table, columns=columns, placeholders=placeholders)
+
+            def process_chunk(chunk):
+                with transaction.atomic(using=using, savepoint=False):
+                    cursor.executemany(sql, chunk)
+
+            description = 'Inserted into {0}'.format(table)
+
+        return _process_chunks(description, rows, chunk_size, process_chunk)
+
+
+def _to_copy_text(value):
+    """Convert ``value`` to PostgreSQL's COPY text format."""
+    if value is None:
+        return '\\N'
+    return (
+        str(value)
+        .replace('\\', '\\\\')
+        .replace('\t', '\\t')
+        .replace('\n', '\\n')
+        .replace('\r', '\\r')
+    )
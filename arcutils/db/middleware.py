@@ -0,0 +1,395 @@
+"""Middleware for finding inefficient queries.
+
+- :class:`QueryCountMiddleware` detects views that run too many queries.
+- :class:`SlowQueryMiddleware` logs slow queries along with their plans.
+
+Query counts
+============
+
+Add the middleware to the project's settings::
+
+    MIDDLEWARE = [
+        'arcutils.db.middleware.QueryCountMiddleware',
+        ...
+    ]
+
+    QUERY_COUNT = {
+        'max_queries': 50,
+        'max_repeats': 10,
+        'action': 'log',
+        'sample_rate': 1.0,
+    }
+
+The queries run in each request are counted and grouped by fingerprint;
+statements that differ only in their parameters (e.g., the same query
+run for each item in a list) have the same fingerprint. When a request
+runs more than ``max_queries`` queries in total or the same statement
+more than ``max_repeats`` times (which usually indicates an N+1 query
+pattern), a warning is logged. Set ``action`` to "raise" to raise a
+:class:`TooManyQueriesError` instead, which can be useful in
+development and in tests.
+
+Only a counter per fingerprint is kept for each request, so the
+overhead is small. To reduce it further, set ``sample_rate`` to check
+only a fraction of requests (e.g., 0.01 in production).
+
+Slow queries
+============
+
+Add the middleware to the project's settings::
+
+    MIDDLEWARE = [
+        'arcutils.db.middleware.SlowQueryMiddleware',
+        ...
+    ]
+
+    SLOW_QUERIES = {
+        'threshold': 0.5,
+        'explain': True,
+        'explain_interval': 300,
+    }
+
+Each query is timed, and queries that take longer than ``threshold``
+seconds are logged along with the view that ran them and a summary of
+the stack at the point the query was run.
+
+When ``explain`` is set, the query's plan is captured too (via
+``EXPLAIN`` on PostgreSQL and MySQL or ``EXPLAIN QUERY PLAN`` on
+SQLite). Since a database that's running slow queries is probably
+already under load, plans are captured at most once per
+``explain_interval`` seconds for each distinct statement. Only
+``SELECT``, ``INSERT``, ``UPDATE``, and ``DELETE`` statements are
+explained, and each ``EXPLAIN`` is run in a savepoint so that a failure
+won't break the request's transaction.
+
+Both middlewares use :mod:`arcutils.db.wrappers` to hook into query
+execution.
+
+"""
+import logging
+import random
+import re
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
+
+from django.db import connections, transaction
+
+from arcutils.middleware import MiddlewareBase
+from arcutils.settings import PrefixedSettings
+
+from . import wrappers
+from .wrappers import add_execute_wrapper, remove_execute_wrapper
+
+
+log = logging.getLogger(__name__)
+
+
+QUERY_COUNT_DEFAULTS = {
+    'enabled': True,
+
+    # Maximum number of queries per request (None for no limit)
+    'max_queries': 50,
+
+    # Maximum number of times any one statement can be run per request
+    # (None for no limit)
+    'max_repeats': 10,
+
+    # What to do when a limit is exceeded: "log" or "raise"
+    'action': 'log',
+
+    # Fraction of requests to check
+    'sample_rate': 1.0,
+}
+
+
+query_count_settings = PrefixedSettings('QUERY_COUNT', QUERY_COUNT_DEFAULTS)
+
+
+SLOW_QUERIES_DEFAULTS = {
+    'enabled': True,
+
+    # Queries that take longer than this many seconds are logged
+    'threshold': 0.5,
+
+    # Whether to capture the plans of slow queries
+    'explain': True,
+
+    # Minimum number of seconds between captures of the plan for any
+    # one statement
+    'explain_interval': 300,
+
+    # Maximum number of stack frames to log with each slow query
+    'stack_limit': 8,
+}
+
+
+slow_query_settings = PrefixedSettings('SLOW_QUERIES', SLOW_QUERIES_DEFAULTS)
+
+
+class TooManyQueriesError(Exception):
+
+    pass
+
+
+_FINGERPRINT_SUBSTITUTIONS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),  # String literals
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),  # Numbers
+    (re.compile(r'%s'), '?'),  # Placeholders
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?...)'),  # IN (...) lists
+    (re.compile(r'\s+'), ' '),
+)
+
+
+def fingerprint(sql):
+    """Get a fingerprint for ``sql`` with its parameters removed.
+
+        >>> fingerprint("SELECT * FROM t WHERE id = 1 AND name = 'x'")
+        'SELECT * FROM t WHERE id = ? AND name = ?'
+        >>> fingerprint('SELECT * FROM t WHERE id IN (%s, %s, %s)')
+        'SELECT * FROM t WHERE id IN (?...)'
+
+    """
+    for regex, replacement in _FINGERPRINT_SUBSTITUTIONS:
+        sql = regex.sub(replacement, sql)
+    return sql.strip()
+
+
+class QueryStats:
+
+    """Counts queries by fingerprint.
+
+    Instances are execute wrappers (see :mod:`arcutils.db.wrappers`).
+
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.add(sql)
+        return execute(sql, params, many, context)
+
+    def add(self, sql):
+        self.count += 1
+        self.fingerprints[fingerprint(sql)] += 1
+
+    def get_problems(self, max_queries=None, max_repeats=None):
+        """Get a list of messages describing exceeded limits."""
+        problems = []
+        if max_queries is not None and self.count > max_queries:
+            problems.append('{0} queries were run (max: {1})'.format(self.count, max_queries))
+        if max_repeats is not None:
+            for sql, count in self.fingerprints.most_common():
+                if count <= max_repeats:
+                    break
+                problems.append(
+                    'Query was run {0} times (max: {1}): {2}'.format(count, max_repeats, sql))
+        return problems
+
+
+class QueryCountMiddleware(MiddlewareBase):
+
+    """Count queries per request and report views that run too many.
+
+    See the module docstring for settings.
+
+    """
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.max_queries = query_count_settings.get('max_queries')
+        self.max_repeats = query_count_settings.get('max_repeats')
+        self.action = query_count_settings.get('action')
+        self.sample_rate = query_count_settings.get('sample_rate')
+        if self.action not in ('log', 'raise'):
+            raise ValueError('QUERY_COUNT.action must be "log" or "raise"')
+
+    def enabled(self):
+        return query_count_settings.get('enabled')
+
+    def before_view(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            request._query_count_stats = None
+            return
+        stats = request._query_count_stats = QueryStats()
+        for alias in connections:
+            add_execute_wrapper(stats, alias)
+
+    def after_view(self, request, response):
+        stats = self.stop(request)
+        if stats is None:
+            return
+        problems = stats.get_problems(self.max_queries, self.max_repeats)
+        if problems:
+            message = '{0} {1}: {2}'.format(request.method, request.path, '; '.join(problems))
+            if self.action == 'raise':
+                raise TooManyQueriesError(message)
+            log.warning(message)
+
+    def process_exception(self, request, exception):
+        self.stop(request)
+
+    def stop(self, request):
+        """Stop counting queries for ``request`` and return its stats."""
+        stats = getattr(request, '_query_count_stats', None)
+        if stats is not None:
+            request._query_count_stats = None
+            for alias in connections:
+                remove_execute_wrapper(stats, alias)
+        return stats
+
+
+EXPLAIN_PREFIXES = {
+    'mysql': 'EXPLAIN ',
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+
+
+EXPLAINABLE_RE = re.compile(r'^\s*(SELECT|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+# Maximum number of fingerprints to remember plan capture times for;
+# the least recently explained are forgotten first.
+EXPLAINED_AT_MAX_SIZE = 1000
+
+_explained_at = OrderedDict()
+_explained_at_lock = threading.Lock()
+
+_stack_summary_excludes = {__file__, wrappers.__file__}
+
+
+def is_explainable(sql):
+    """Is ``sql`` a DML statement that can be safely ``EXPLAIN``ed?"""
+    return EXPLAINABLE_RE.match(sql) is not None
+
+
+def should_explain(sql, interval):
+    """Rate limit plan captures to one per ``interval`` per fingerprint."""
+    key = fingerprint(sql)
+    now = time.monotonic()
+    with _explained_at_lock:
+        explained_at = _explained_at.get(key)
+        if explained_at is not None and now - explained_at < interval:
+            return False
+        _explained_at[key] = now
+        _explained_at.move_to_end(key)
+        while len(_explained_at) > EXPLAINED_AT_MAX_SIZE:
+            _explained_at.popitem(last=False)
+        return True
+
+
+def get_stack_summary(limit):
+    """Get the last ``limit`` stack frames outside of Django & arcutils.db."""
+    frames = [
+        frame for frame in traceback.extract_stack()[:-1]
+        if '/django/' not in frame[0] and frame[0] not in _stack_summary_excludes
+    ]
+    return ''.join(traceback.format_list(frames[-limit:]))
+
+
+class SlowQueryLogger:
+
+    """An execute wrapper that logs slow queries.
+
+    See the module docstring for settings.
+
+    """
+
+    def __init__(self, threshold, explain=True, explain_interval=300, stack_limit=8, view=None):
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.stack_limit = stack_limit
+        self.view = view
+        self.explaining = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.explaining:
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration = time.perf_counter() - start
+        if duration >= self.threshold:
+            self.log(sql, params, many, context['connection'], duration)
+        return result
+
+    def log(self, sql, params, many, connection, duration):
+        plan = None
+        explain = self.explain and not many and is_explainable(sql)
+        if explain and should_explain(sql, self.explain_interval):
+            plan = self.get_plan(sql, params, connection)
+        view = self.view or '(unknown view)'
+        stack = get_stack_summary(self.stack_limit)
+        log.warning(
+            'Slow query (%.3fs) in %s: %s\nStack:\n%s\nPlan:\n%s',
+            duration, view, sql, stack, plan or '(not captured)',
+            extra={
+                'duration': duration,
+                'sql': sql,
+                'view': view,
+                'plan': plan,
+            })
+
+    def get_plan(self, sql, params, connection):
+        prefix = EXPLAIN_PREFIXES.get(connection.vendor)
+        if prefix is None:
+            return None
+        self.explaining = True
+        try:
+            # Use a savepoint so a failed EXPLAIN doesn't abort the
+            # transaction the slow query was run in (on PostgreSQL).
+            with transaction.atomic(using=connection.alias, savepoint=True):
+                with connection.cursor() as cursor:
+                    cursor.execute(prefix + sql, params)
+                    rows = cursor.fetchall()
+        except Exception:
+            log.exception('Could not get plan for query: %s', sql)
+            return None
+        finally:
+            self.explaining = False
+        return '\n'.join(' '.join(str(col) for col in row) for row in rows)
+
+
+class SlowQueryMiddleware(MiddlewareBase):
+
+    """Log queries that take longer than ``SLOW_QUERIES.threshold``.
+
+    See the module docstring for settings.
+
+    """
+
+    def enabled(self):
+        return slow_query_settings.get('enabled')
+
+    def before_view(self, request):
+        slow_query_logger = request._slow_query_logger = SlowQueryLogger(
+            threshold=slow_query_settings.get('threshold'),
+            explain=slow_query_settings.get('explain'),
+            explain_interval=slow_query_settings.get('explain_interval'),
+            stack_limit=slow_query_settings.get('stack_limit'),
+            view='{0.method} {0.path}'.format(request),
+        )
+        for alias in connections:
+            add_execute_wrapper(slow_query_logger, alias)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        slow_query_logger = getattr(request, '_slow_query_logger', None)
+        if slow_query_logger is not None:
+            slow_query_logger.view = '{0} ({1.__module__}.{1.__qualname__})'.format(
+                slow_query_logger.view, view_func)
+
+    def after_view(self, request, response):
+        self.stop(request)
+
+    def process_exception(self, request, exception):
+        self.stop(request)
+
+    def stop(self, request):
+        slow_query_logger = getattr(request, '_slow_query_logger', None)
+        if slow_query_logger is not None:
+            request._slow_query_logger = None
+            for alias in connections:
+                remove_execute_wrapper(slow_query_logger, alias)
@@ -1 +1,2 @@
 from .audit import AuditModel  # noqa
+from .fields import ChoiceEnumField  # noqa
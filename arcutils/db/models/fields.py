@@ -0,0 +1,83 @@
+from django.core.exceptions import ValidationError
+from django.db import models
+
+
+class ChoiceEnumField(models.Field):
+
+    """A model field for :class:`arcutils.db.ChoiceEnum` members.
+
+    Members are stored as their values; the column type is integer if
+    all the values are integers and varchar otherwise. When loaded from
+    the database, values are converted to members with a single dict
+    lookup each. Choices are set from the enum type automatically::
+
+        class Page(models.Model):
+
+            layout = ChoiceEnumField(LayoutType, default=LayoutType.text_only)
+
+        page.layout  # -> LayoutType.text_only
+        page.layout.label  # -> 'Text only'
+        Page.objects.filter(layout=LayoutType.chart)
+
+    Values can be assigned or used in queries as members or as raw
+    values.
+
+    """
+
+    description = 'A ChoiceEnum member'
+
+    def __init__(self, enum_type, *args, **kwargs):
+        self.enum_type = enum_type
+        values = [value for (value, _) in enum_type.as_choices()]
+        self.is_integer = all(isinstance(value, int) for value in values)
+        if not self.is_integer:
+            kwargs.setdefault('max_length', max([len(str(v)) for v in values] or [1]))
+        kwargs['choices'] = enum_type.as_choices()
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs.pop('choices', None)
+        kwargs['enum_type'] = self.enum_type
+        return name, path, args, kwargs
+
+    def get_internal_type(self):
+        return 'IntegerField' if self.is_integer else 'CharField'
+
+    def from_db_value(self, value, *args):
+        if value is None:
+            return value
+        return self.enum_type.from_value(value)
+
+    def to_python(self, value):
+        if value is None or value == '':
+            return None
+        try:
+            return self.enum_type.from_value(value)
+        except ValueError:
+            pass
+        if self.is_integer and isinstance(value, str):
+            # Form data
+            try:
+                return self.enum_type.from_value(int(value))
+            except ValueError:
+                pass
+        raise ValidationError(
+            self.error_messages['invalid_choice'], code='invalid_choice', params={'value': value})
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if isinstance(value, self.enum_type):
+            return value.value
+        return value
+
+    def value_from_object(self, obj):
+        # Forms compare raw values to choices.
+        return self.get_prep_value(super().value_from_object(obj))
+
+    def value_to_string(self, obj):
+        value = self.value_from_object(obj)
+        return '' if value is None else str(value)
+
+    def validate(self, value, model_instance):
+        super().validate(self.get_prep_value(value), model_instance)
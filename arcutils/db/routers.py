@@ -0,0 +1,207 @@
+"""Route reads to read replicas and writes to the primary database.
+
+To use this, add the replicas to ``DATABASES``, then add the router and
+middleware to the project's settings::
+
+    DATABASE_ROUTERS = ['arcutils.db.routers.ReplicaRouter']
+
+    DATABASE_REPLICAS = {
+        # Aliases of replica databases in DATABASES. This can also be
+        # a dict of alias => weight; e.g., {'replica1': 1, 'replica2': 3}
+        # will send three times as many reads to replica2.
+        'replicas': ['replica1', 'replica2'],
+    }
+
+    MIDDLEWARE = [
+        'arcutils.db.routers.ReplicaMiddleware',
+        ...
+    ]
+
+Reads are sent to the replicas in (weighted) round-robin order. Writes
+are always sent to the primary database.
+
+Since replicas may lag behind the primary, reads that follow a write
+need to go to the primary too. In a request, the first write pins the
+rest of the request to the primary. A cookie is also set so that the
+same client's requests will be pinned to the primary for the next
+``sticky_seconds`` seconds; this covers the typical post/redirect/get
+cycle.
+
+Outside of requests (e.g., in management commands), use
+:func:`use_primary` to send reads to the primary.
+
+"""
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from arcutils.middleware import MiddlewareBase
+from arcutils.settings import PrefixedSettings
+
+
+DEFAULTS = {
+    # Alias of the primary (read/write) database
+    'primary': 'default',
+
+    # Aliases of read replicas (list) or alias => weight (dict)
+    'replicas': [],
+
+    # How long to pin a client to the primary after it writes
+    'sticky_seconds': 10,
+
+    # Name of the cookie used to pin a client to the primary
+    'cookie_name': 'use_primary_db_until',
+}
+
+
+settings = PrefixedSettings('DATABASE_REPLICAS', DEFAULTS)
+
+
+class _State(threading.local):
+
+    # Depth of use_primary() contexts (a request counts as one when the
+    # client is pinned)
+    pinned = 0
+
+    # Whether a request is being handled by ReplicaMiddleware
+    in_request = False
+
+    # Whether a write was routed in the current request
+    written = False
+
+
+_state = _State()
+
+
+def is_pinned() -> bool:
+    """Indicates whether reads are being sent to the primary."""
+    return _state.pinned > 0
+
+
+@contextmanager
+def use_primary():
+    """Send reads in this context to the primary database."""
+    _state.pinned += 1
+    try:
+        yield
+    finally:
+        _state.pinned -= 1
+
+
+def get_replica_cycle(replicas):
+    """Get an iterator that cycles through ``replicas`` forever.
+
+    ``replicas`` can be a list of aliases (round-robin) or a dict of
+    alias => weight (smooth weighted round-robin, which interleaves
+    replicas instead of hitting the same one ``weight`` times in a row).
+
+        >>> cycle = get_replica_cycle({'a': 1, 'b': 2})
+        >>> [next(cycle) for _ in range(6)]
+        ['b', 'a', 'b', 'b', 'a', 'b']
+
+    Replicas with a weight of 0 are never used.
+
+    Raises:
+        ValueError: A weight is negative, or all weights are 0 (in
+            which case there's no replica to read from)
+
+    """
+    if not hasattr(replicas, 'items'):
+        replicas = {alias: 1 for alias in replicas}
+    weights = sorted(replicas.items())
+    if any(weight < 0 for (_, weight) in weights):
+        raise ValueError('Replica weights must not be negative: {0!r}'.format(replicas))
+    total = sum(weight for (_, weight) in weights)
+    if total < 1:
+        raise ValueError(
+            'At least one replica must have a positive weight: {0!r}'.format(replicas))
+    current = {alias: 0 for (alias, _) in weights}
+    sequence = []
+    for _ in range(total):
+        for alias, weight in weights:
+            current[alias] += weight
+        alias = max(weights, key=lambda item: current[item[0]])[0]
+        current[alias] -= total
+        sequence.append(alias)
+    return itertools.cycle(sequence)
+
+
+class ReplicaRouter:
+
+    """Send reads to replicas and writes to the primary.
+
+    The primary and replicas are read from the ``DATABASE_REPLICAS``
+    setting by default. They can also be passed in, in which case an
+    instance can be added to ``DATABASE_ROUTERS`` directly.
+
+    """
+
+    def __init__(self, primary=None, replicas=None):
+        self.primary = primary or settings.get('primary')
+        replicas = settings.get('replicas') if replicas is None else replicas
+        self.replicas = tuple(replicas)
+        self.databases = {self.primary}.union(self.replicas)
+        self._replica_cycle = get_replica_cycle(replicas) if replicas else None
+
+    def db_for_read(self, model, **hints):
+        if self._replica_cycle is None or is_pinned():
+            return self.primary
+        return next(self._replica_cycle)
+
+    def db_for_write(self, model, **hints):
+        if _state.in_request and not _state.written:
+            # Pin the rest of the request to the primary.
+            _state.written = True
+            _state.pinned += 1
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db in self.databases and obj2._state.db in self.databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary.
+        if db in self.replicas:
+            return False
+        return None
+
+
+class ReplicaMiddleware(MiddlewareBase):
+
+    """Pin clients to the primary database after they write.
+
+    If the client has written recently (according to its cookie), reads
+    are sent to the primary for the whole request. Otherwise, reads are
+    sent to the primary after the first write in the request.
+
+    """
+
+    def before_view(self, request):
+        self.reset()
+        _state.in_request = True
+        cookie_name = settings.get('cookie_name')
+        try:
+            pinned_until = float(request.COOKIES.get(cookie_name, 0))
+        except ValueError:
+            pinned_until = 0
+        if pinned_until > time.time():
+            _state.pinned = 1
+
+    def after_view(self, request, response):
+        if _state.written:
+            sticky_seconds = settings.get('sticky_seconds')
+            if sticky_seconds:
+                response.set_cookie(
+                    settings.get('cookie_name'), str(time.time() + sticky_seconds),
+                    max_age=sticky_seconds, httponly=True)
+        self.reset()
+
+    def process_exception(self, request, exception):
+        self.reset()
+
+    def reset(self):
+        _state.pinned = 0
+        _state.in_request = False
+        _state.written = False
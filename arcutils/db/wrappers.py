@@ -0,0 +1,89 @@
+"""Execute wrappers for all supported versions of Django.
+
+Django 2.0 added ``connection.execute_wrapper()``, which installs
+a function that's called around every query run via the connection:
+
+    def wrapper(execute, sql, params, many, context):
+        # Do something before the query runs...
+        result = execute(sql, params, many, context)
+        # Do something after the query runs...
+        return result
+
+The functions here use ``connection.execute_wrappers`` when it's
+available. On older versions of Django, they wrap the connection's
+cursors instead, so wrappers work the same way regardless of version.
+
+"""
+from contextlib import contextmanager
+from functools import partial
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.utils import CursorWrapper
+
+
+def add_execute_wrapper(wrapper, using=DEFAULT_DB_ALIAS):
+    """Call ``wrapper`` around every query run via ``using``.
+
+    Like Django's connections, this applies to the current thread only.
+
+    """
+    get_execute_wrappers(connections[using]).append(wrapper)
+
+
+def remove_execute_wrapper(wrapper, using=DEFAULT_DB_ALIAS):
+    """Remove a wrapper added with :func:`add_execute_wrapper`."""
+    wrappers = get_execute_wrappers(connections[using])
+    if wrapper in wrappers:
+        wrappers.remove(wrapper)
+
+
+@contextmanager
+def execute_wrapper(wrapper, using=DEFAULT_DB_ALIAS):
+    """Call ``wrapper`` around every query run in this context."""
+    add_execute_wrapper(wrapper, using)
+    try:
+        yield
+    finally:
+        remove_execute_wrapper(wrapper, using)
+
+
+def get_execute_wrappers(connection):
+    """Get the list of execute wrappers for ``connection``."""
+    if hasattr(connection, 'execute_wrappers'):
+        # Django 2.0+
+        return connection.execute_wrappers
+    if not hasattr(connection, '_arcutils_execute_wrappers'):
+        connection._arcutils_execute_wrappers = []
+        make_cursor = connection.make_cursor
+        make_debug_cursor = connection.make_debug_cursor
+        connection.make_cursor = lambda cursor: _WrappedCursor(make_cursor(cursor), connection)
+        connection.make_debug_cursor = lambda cursor: _WrappedCursor(
+            make_debug_cursor(cursor), connection)
+    return connection._arcutils_execute_wrappers
+
+
+class _WrappedCursor(CursorWrapper):
+
+    """Calls execute wrappers around a Django cursor (Django < 2.0).
+
+    ``cursor`` is the cursor wrapper Django would normally return, so
+    query logging, error wrapping, etc work as usual.
+
+    """
+
+    def execute(self, sql, params=None):
+        return self._execute_with_wrappers(sql, params, False, self._execute)
+
+    def executemany(self, sql, param_list):
+        return self._execute_with_wrappers(sql, param_list, True, self._execute)
+
+    def _execute(self, sql, params, many, context):
+        if many:
+            return self.cursor.executemany(sql, params)
+        return self.cursor.execute(sql, params)
+
+    def _execute_with_wrappers(self, sql, params, many, executor):
+        context = {'connection': self.db, 'cursor': self}
+        for wrapper in reversed(self.db._arcutils_execute_wrappers):
+            executor = partial(wrapper, executor)
+        return executor(sql, params, many, context)
@@ -10,3 +10,51 @@ class LocalDateTimeField(serializers.DateTimeField):
     def to_representation(self, value):
         value = timezone.localtime(value)
         return super().to_representation(value)
+
+
+class ChoiceEnumField(serializers.ChoiceField):
+
+    """Serializes :class:`arcutils.db.ChoiceEnum` members.
+
+    Members are represented as their values by default. Pass
+    ``representation='label'`` to represent them as their labels or
+    ``representation='dict'`` to represent them as dicts with "value" and
+    "label" keys. Each of these is a single (precomputed) lookup; dicts are
+    copied so that callers can't modify the precomputed ones.
+
+    Input must be a valid value, which is converted to a member.
+
+    This is typically used with :class:`arcutils.db.models.ChoiceEnumField`,
+    which has to be declared explicitly on model serializers::
+
+        class PageSerializer(serializers.ModelSerializer):
+
+            layout = ChoiceEnumField(LayoutType, representation='label')
+
+    """
+
+    def __init__(self, enum_type, representation='value', **kwargs):
+        if representation not in ('value', 'label', 'dict'):
+            raise ValueError('representation must be one of "value", "label", or "dict"')
+        self.enum_type = enum_type
+        self.representation = representation
+        if representation == 'dict':
+            self.representations = {
+                choice['value']: choice for choice in enum_type.as_choices(as_dict=True)}
+        super().__init__(enum_type.as_choices(), **kwargs)
+
+    def to_internal_value(self, data):
+        value = super().to_internal_value(data)
+        if value == '':
+            return value
+        return self.enum_type.from_value(value)
+
+    def to_representation(self, value):
+        if value in ('', None):
+            return value
+        if self.representation == 'label':
+            return self.enum_type.get_label(value)
+        value = getattr(value, 'value', value)
+        if self.representation == 'dict':
+            return dict(self.representations[value])
+        return value
@@ -29,7 +29,7 @@ TODO: Incorporate the ldap3 library's abstraction layer:
 import ldap3
 
 from .connection import connect  # noqa
-from .search import ldapsearch, ldapsearch_by_email  # noqa
+from .search import ldapsearch, ldapsearch_by_email, ldapsearch_iter, ldapsearch_many  # noqa
 from .utils import escape, parse_dn  # noqa
 
 CONNECTION_TYPE = ldap3.Connection
@@ -0,0 +1,213 @@
+"""Asynchronous LDAP searches for use with :mod:`asyncio`.
+
+:func:`arcutils.ldap.ldapsearch` blocks until each search completes, so
+searches run one after another. The coroutines here use ldap3's
+``ASYNC`` strategy instead: each search request is sent right away,
+and the event loop is free to run other tasks (including other
+searches) while the server works on it::
+
+    from arcutils.ldap import aio
+
+    async def get_profiles(usernames):
+        queries = ['(uid={0})'.format(escape(u)) for u in usernames]
+        return await aio.ldapsearch_all(queries)
+
+LDAP allows many operations to be outstanding on a single connection,
+so one bound connection is kept open per ``using`` alias (per event
+loop) and searches are multiplexed over it. To avoid overwhelming the
+server, the number of outstanding searches per alias is limited by the
+``max_concurrency`` setting::
+
+    LDAP = {
+        'default': {
+            'host': 'ldap-login.oit.pdx.edu',
+            'max_concurrency': 10,
+        }
+    }
+
+ldap3 receives responses on a background thread; waiting for them is
+done in the event loop's default executor.
+
+.. note:: This module requires Python 3.5+.
+
+"""
+import asyncio
+import logging
+import weakref
+from functools import partial
+
+import ldap3
+from ldap3.core.exceptions import LDAPCommunicationError, LDAPException
+
+from .breaker import guard
+from .connection import connect
+from .search import _collect_many, _prepare_many, get_attributes, get_parser
+from .settings import settings
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_CONCURRENCY = 10
+
+
+class _State:
+
+    def __init__(self, max_concurrency):
+        self.connection = None
+        self.lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+
+class AsyncConnectionManager:
+
+    """Keeps a bound ``ASYNC`` connection open per ``using`` alias.
+
+    Connections, locks, and semaphores can't be shared between event
+    loops, so each event loop gets its own.
+
+    Args:
+        connect: A function that creates an (unbound) connection for
+            a ``using`` alias and client ``strategy``;
+            :func:`arcutils.ldap.connect` by default
+
+    """
+
+    def __init__(self, connect=connect):
+        self._connect = connect
+        self._loops = weakref.WeakKeyDictionary()
+
+    async def search(self, using='default', **search_args):
+        """Run a search and return its response.
+
+        ``search_args`` are passed to :meth:`ldap3.Connection.search`.
+
+        If the connection turns out to be stale, the search is retried
+        once with a new connection.
+
+        Searches are guarded by the circuit breaker for ``using`` (see
+        :mod:`arcutils.ldap.breaker`).
+
+        """
+        state = self._get_state(using)
+        with guard(using):
+            async with state.semaphore:
+                connection = None
+                try:
+                    connection = await self._get_connection(state, using)
+                    return await self._search(connection, search_args)
+                except LDAPCommunicationError:
+                    log.info(
+                        'LDAP connection for %s was stale; retrying with new connection', using)
+                    if connection is not None:
+                        self._discard(state, connection)
+                connection = await self._get_connection(state, using)
+                return await self._search(connection, search_args)
+
+    def close_all(self):
+        """Close all connections (for all event loops)."""
+        for states in list(self._loops.values()):
+            for state in states.values():
+                self._discard(state)
+        self._loops.clear()
+
+    async def _search(self, connection, search_args):
+        message_id = connection.search(**search_args)
+        loop = asyncio.get_event_loop()
+        response, _ = await loop.run_in_executor(None, connection.get_response, message_id)
+        return response
+
+    async def _get_connection(self, state, using):
+        async with state.lock:
+            if state.connection is None or state.connection.closed:
+                connection = self._connect(using, strategy=ldap3.ASYNC)
+                # Lazy connections don't actually bind until they're used.
+                connection.lazy = False
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, connection.bind)
+                state.connection = connection
+            return state.connection
+
+    def _get_state(self, using):
+        states = self._loops.setdefault(asyncio.get_event_loop(), {})
+        if using not in states:
+            max_concurrency = settings.get(
+                'max_concurrency', DEFAULT_MAX_CONCURRENCY, using=using)
+            states[using] = _State(max_concurrency)
+        return states[using]
+
+    def _discard(self, state, connection=None):
+        """Close ``connection`` if it's still ``state``'s connection.
+
+        Many searches share a connection, so by the time a search on
+        a stale connection fails, another search may have already
+        replaced it; that new connection must be left alone.
+
+        If ``connection`` isn't specified, ``state``'s current
+        connection is closed.
+
+        """
+        if connection is None:
+            connection = state.connection
+        if connection is None or state.connection is not connection:
+            return
+        state.connection = None
+        try:
+            connection.unbind()
+        except LDAPException:
+            pass
+
+
+connection_manager = AsyncConnectionManager()
+
+
+async def ldapsearch(query, using='default', search_base=None, search_scope=ldap3.SUBTREE,
+                     attributes=None, parse=True, fields=None, **kwargs):
+    """Performs an LDAP search and returns the results.
+
+    This is the asynchronous version of :func:`arcutils.ldap.ldapsearch`
+    (except that connections can't be passed in and results aren't
+    cached).
+
+    """
+    get = partial(settings.get, using=using)
+
+    search_base = search_base or get('search_base')
+    attributes = get_attributes(using, attributes, fields)
+
+    response = await connection_manager.search(
+        using,
+        search_base=search_base,
+        search_filter=query,
+        search_scope=search_scope,
+        attributes=attributes,
+        **kwargs)
+
+    results = [r for r in response if r.get('type') != 'searchResRef']
+    parser = get_parser(parse, fields)
+    return [parser(r['attributes']) for r in results] if parser else results
+
+
+async def ldapsearch_all(queries, **kwargs):
+    """Run ``queries`` concurrently.
+
+    Returns a list containing the results for each query, in order.
+    Keyword args are passed through to :func:`ldapsearch`.
+
+    """
+    return await asyncio.gather(*(ldapsearch(query, **kwargs) for query in queries))
+
+
+async def ldapsearch_many(values, attribute='uid', chunk_size=100, using='default',
+                          attributes=None, parse=True, fields=None, **kwargs):
+    """Look up many entries by ``attribute`` in a few concurrent searches.
+
+    This is the asynchronous version of
+    :func:`arcutils.ldap.ldapsearch_many`.
+
+    """
+    wanted, queries, attributes = _prepare_many(
+        values, attribute, chunk_size, using, attributes, fields)
+    chunk_results = await ldapsearch_all(
+        queries, using=using, attributes=attributes, parse=False, **kwargs)
+    return _collect_many(wanted, chunk_results, attribute, parse, fields)
@@ -0,0 +1,228 @@
+"""Circuit breakers for LDAP connections.
+
+When the LDAP servers for an alias can't be reached, each search would
+otherwise wait for the connect (or receive) timeout, tying up a request
+thread for each one. A circuit breaker tracks consecutive failures per
+``using`` alias, and once ``failure_threshold`` searches in a row have
+failed, it "opens": searches fail immediately with
+:class:`CircuitOpenError` for ``reset_timeout`` seconds. After that, the
+breaker is "half open", and a single search is let through as a probe.
+If it succeeds, the breaker closes again; if it fails, the breaker
+reopens.
+
+Circuit breakers are enabled by default; they can be configured (or
+disabled by setting ``circuit_breaker`` to ``None``) per connection::
+
+    LDAP = {
+        'default': {
+            'host': 'ldap-login.oit.pdx.edu',
+            'connect_timeout': 5,
+            'receive_timeout': 30,
+            'circuit_breaker': {
+                'failure_threshold': 5,
+                'reset_timeout': 30,
+            },
+        }
+    }
+
+Since :class:`CircuitOpenError` is an ``LDAPCommunicationError``, code
+that already handles communication errors handles open circuits too.
+For pages where directory data is optional::
+
+    try:
+        results = ldapsearch(query)
+    except LDAPCommunicationError:
+        results = []
+
+Use :func:`get_circuit_breaker_states` to check breakers in health
+checks.
+
+Only communication errors count as failures. Other errors (e.g., an
+invalid filter) mean the server is responding.
+
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from ldap3.core.exceptions import (
+    LDAPCommunicationError,
+    LDAPResponseTimeoutError,
+    LDAPServerPoolExhaustedError,
+)
+
+from .settings import settings
+
+
+log = logging.getLogger(__name__)
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+DEFAULT_CIRCUIT_BREAKER_SETTINGS = {
+    'failure_threshold': 5,
+    'reset_timeout': 30,
+}
+
+
+# Errors that indicate the servers can't be reached
+FAILURE_TYPES = (
+    LDAPCommunicationError,
+    LDAPResponseTimeoutError,
+    LDAPServerPoolExhaustedError,
+)
+
+
+class CircuitOpenError(LDAPCommunicationError):
+
+    pass
+
+
+class CircuitBreaker:
+
+    """Fail fast after ``failure_threshold`` consecutive failures.
+
+    See the module docstring for details.
+
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._get_state()
+
+    def before_call(self):
+        """Raise :class:`CircuitOpenError` if calls aren't allowed now.
+
+        In the half open state, only one call (the probe) is allowed
+        until it succeeds or fails.
+
+        """
+        with self._lock:
+            state = self._get_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+        raise CircuitOpenError('LDAP circuit breaker for {0} is open'.format(self.name))
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                log.info('LDAP circuit breaker for %s closed', self.name)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    log.warning(
+                        'LDAP circuit breaker for %s opened after %d failures',
+                        self.name, self._failures)
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+    @contextmanager
+    def guard(self):
+        """Record the outcome of the LDAP operations in a ``with`` block.
+
+        :class:`CircuitOpenError` is raised on entry if operations aren't
+        allowed now.
+
+        """
+        self.before_call()
+        try:
+            yield
+        except FAILURE_TYPES:
+            self.record_failure()
+            raise
+        except BaseException:
+            # Some other error occurred (or the caller stopped early);
+            # that doesn't say anything about the servers, but a probe
+            # shouldn't be left outstanding.
+            with self._lock:
+                self._probing = False
+            raise
+        self.record_success()
+
+    def call(self, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)`` if the breaker allows it."""
+        with self.guard():
+            return func(*args, **kwargs)
+
+    def reset(self):
+        self.record_success()
+
+    def _get_state(self):
+        if self._opened_at is None:
+            return CLOSED
+        if time.monotonic() - self._opened_at < self.reset_timeout:
+            return OPEN
+        return HALF_OPEN
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(using='default'):
+    """Get the circuit breaker for ``using``.
+
+    Returns ``None`` if circuit breaking is disabled for ``using``.
+
+    """
+    with _circuit_breakers_lock:
+        if using not in _circuit_breakers:
+            breaker_settings = settings.get('circuit_breaker', {}, using=using)
+            if breaker_settings is None:
+                breaker = None
+            else:
+                breaker_settings = dict(DEFAULT_CIRCUIT_BREAKER_SETTINGS, **breaker_settings)
+                breaker = CircuitBreaker(using, **breaker_settings)
+            _circuit_breakers[using] = breaker
+        return _circuit_breakers[using]
+
+
+def get_circuit_breaker_states():
+    """Get the states of the circuit breakers that have been used.
+
+    Returns a dict mapping ``using`` aliases to states (``'closed'``,
+    ``'open'``, or ``'half-open'``).
+
+    """
+    with _circuit_breakers_lock:
+        breakers = [b for b in _circuit_breakers.values() if b is not None]
+    return {breaker.name: breaker.state for breaker in breakers}
+
+
+@contextmanager
+def guard(using='default'):
+    """Guard a ``with`` block with the breaker for ``using``.
+
+    See :meth:`CircuitBreaker.guard`. If circuit breaking is disabled
+    for ``using``, this does nothing.
+
+    """
+    breaker = get_circuit_breaker(using)
+    if breaker is None:
+        yield
+    else:
+        with breaker.guard():
+            yield
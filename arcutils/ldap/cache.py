@@ -0,0 +1,231 @@
+"""Caching for LDAP search results.
+
+Caching is opt-in per connection via the ``cache`` setting::
+
+    LDAP = {
+        'default': {
+            'host': 'ldap-login.oit.pdx.edu',
+            'cache': {
+                # Seconds to cache non-empty results
+                'ttl': 300,
+                # Seconds to cache empty results
+                'negative_ttl': 60,
+                # Max number of results to keep in the in-process cache
+                'max_size': 1000,
+                # Name of a Django cache (in CACHES) to use as a second
+                # tier that's shared between processes (optional)
+                'django_cache': None,
+            },
+        }
+    }
+
+Results are cached by (using, search base, filter, scope, attributes,
+parse flag or parser name, profile fields, and other search args). When
+a result is found in the in-process cache, no other cache or LDAP server
+is consulted. When it's found in the Django cache, it's also added to
+the in-process cache.
+
+Searches that pass a ``parse`` function without a stable name (e.g.,
+a lambda, a ``partial``, or a bound method) aren't cached, since there's
+no way to make a key for them that's the same in every process.
+
+Use :func:`invalidate` to remove cached results. Since there's no way
+to remove the results for a specific query from the Django cache, all
+of the Django-cached results for the connection are invalidated at once
+(by bumping a version number). Other processes' in-process caches can't
+be invalidated; their entries will expire after ``ttl`` seconds.
+
+"""
+import copy
+import hashlib
+import inspect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from .settings import settings
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_CACHE_SETTINGS = {
+    'ttl': 300,
+    'negative_ttl': 60,
+    'max_size': 1000,
+    'django_cache': None,
+}
+
+
+def get_cache_settings(using='default'):
+    """Get cache settings for ``using``.
+
+    Returns ``None`` if caching isn't enabled for ``using``.
+
+    """
+    cache_settings = settings.get('cache', None, using=using)
+    if cache_settings is None:
+        return None
+    return dict(DEFAULT_CACHE_SETTINGS, **cache_settings)
+
+
+def make_key(using, search_base, query, search_scope, attributes, parse, kwargs, fields=None):
+    """Make a cache key for a search.
+
+    Returns ``None`` if the search can't be cached because ``parse``
+    doesn't have a stable name.
+
+    """
+    parser_key = _get_parser_key(parse)
+    if parser_key is None:
+        return None
+    if not isinstance(attributes, str):
+        attributes = sorted(attributes)
+    key = (
+        using, search_base, query, search_scope, attributes, parser_key,
+        sorted(kwargs.items()), fields)
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def _get_parser_key(parse):
+    """Get a key for ``parse`` that's the same in every process.
+
+    The ``repr()`` of most functions and other callables includes their
+    memory address, so named functions and classes are keyed on their
+    qualified names instead. ``None`` is returned for other callables.
+
+    """
+    if parse is None or isinstance(parse, bool):
+        return repr(parse)
+    if inspect.ismethod(parse):
+        # The result may depend on the instance's state.
+        return None
+    name = getattr(parse, '__qualname__', None)
+    module = getattr(parse, '__module__', None)
+    if not isinstance(name, str) or not module or '<' in name:
+        # Lambdas, local functions, partials, and callable instances
+        return None
+    return '{0}.{1}'.format(module, name)
+
+
+class SearchCache:
+
+    """Two-tier cache for LDAP search results.
+
+    The first tier is an in-process LRU cache; the second, optional
+    tier is a Django cache.
+
+    Cached results are copied on the way in and on the way out, so
+    callers are free to modify the results they get.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}  # using -> OrderedDict(key -> (query, expires, results))
+
+    def get(self, using, key, cache_settings):
+        """Get results for ``key``; returns ``None`` on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entries = self._entries.get(using)
+            entry = entries.get(key) if entries else None
+            if entry is not None:
+                if entry[1] > now:
+                    entries.move_to_end(key)
+                    return copy.deepcopy(entry[2])
+                del entries[key]
+
+        django_cache = self._get_django_cache(cache_settings)
+        if django_cache is not None:
+            entry = django_cache.get(self._get_django_key(django_cache, using, key))
+            if entry is not None:
+                query, results = entry
+                self._set_local(using, key, query, results, cache_settings)
+                return copy.deepcopy(results)
+
+        return None
+
+    def set(self, using, key, query, results, cache_settings):
+        """Cache ``results`` for ``key``."""
+        results = copy.deepcopy(results)
+        self._set_local(using, key, query, results, cache_settings)
+        django_cache = self._get_django_cache(cache_settings)
+        if django_cache is not None:
+            ttl = self._get_ttl(results, cache_settings)
+            try:
+                django_cache.set(
+                    self._get_django_key(django_cache, using, key), (query, results), ttl)
+            except Exception:
+                log.exception('Could not cache LDAP results in Django cache')
+
+    def invalidate(self, using='default', query=None, cache_settings=None):
+        """Remove cached results for ``using``.
+
+        If ``query`` is passed, only the in-process results for that
+        query will be removed. All results for ``using`` are always
+        removed from the Django cache.
+
+        """
+        with self._lock:
+            entries = self._entries.get(using)
+            if entries:
+                if query is None:
+                    entries.clear()
+                else:
+                    for key in [k for (k, e) in entries.items() if e[0] == query]:
+                        del entries[key]
+
+        cache_settings = cache_settings or get_cache_settings(using)
+        django_cache = self._get_django_cache(cache_settings) if cache_settings else None
+        if django_cache is not None:
+            version_key = self._get_version_key(using)
+            try:
+                django_cache.incr(version_key)
+            except ValueError:
+                django_cache.set(version_key, 1, None)
+
+    def clear(self):
+        """Clear the in-process cache for all connections."""
+        with self._lock:
+            self._entries = {}
+
+    def _set_local(self, using, key, query, results, cache_settings):
+        expires = time.monotonic() + self._get_ttl(results, cache_settings)
+        with self._lock:
+            entries = self._entries.setdefault(using, OrderedDict())
+            entries[key] = (query, expires, results)
+            entries.move_to_end(key)
+            while len(entries) > cache_settings['max_size']:
+                entries.popitem(last=False)
+
+    def _get_ttl(self, results, cache_settings):
+        return cache_settings['ttl'] if results else cache_settings['negative_ttl']
+
+    def _get_django_cache(self, cache_settings):
+        name = cache_settings['django_cache']
+        if name is None:
+            return None
+        from django.core.cache import caches
+        return caches[name]
+
+    def _get_version_key(self, using):
+        return 'arcutils.ldap.cache:{using}:version'.format(using=using)
+
+    def _get_django_key(self, django_cache, using, key):
+        version = django_cache.get(self._get_version_key(using), 0)
+        return 'arcutils.ldap.cache:{using}:{version}:{key}'.format(
+            using=using, version=version, key=key)
+
+
+search_cache = SearchCache()
+
+
+def invalidate(using='default', query=None):
+    """Remove cached results for ``using`` (and ``query``).
+
+    See :meth:`SearchCache.invalidate`.
+
+    """
+    search_cache.invalidate(using, query)
@@ -1,10 +1,13 @@
 import ssl
+import threading
+import time
 from functools import partial
 
 from django.core.exceptions import ImproperlyConfigured
 
 import ldap3
 from ldap3 import Connection, Server, ServerPool, Tls
+from ldap3.core.exceptions import LDAPServerPoolExhaustedError
 
 from arcutils.path import abs_path
 
@@ -12,12 +15,14 @@ from .settings import settings
 from .utils import setting_to_ldap3_attr
 
 
-def connect(using='default') -> Connection:
+def connect(using='default', strategy=None) -> Connection:
     """Connect to the LDAP server indicated by ``using``.
 
     Args:
         using: The name of an LDAP connection specified in the project's
             settings
+        strategy: The name of an ldap3 client strategy (e.g., "ASYNC");
+            overrides the ``strategy`` setting
 
     Returns:
         Connection
@@ -25,6 +30,66 @@ def connect(using='default') -> Connection:
     """
     get = partial(settings.get, using=using)
 
+    client_args = {
+        'user': get('username', None),
+        'password': get('password', None),
+        'auto_bind': setting_to_ldap3_attr(get('auto_bind', 'AUTO_BIND_NONE')),
+        'authentication': setting_to_ldap3_attr(get('authentication', None)),
+        'client_strategy': setting_to_ldap3_attr(strategy or get('strategy', 'SYNC')),
+        'read_only': get('read_only', True),
+        'lazy': get('lazy', True),
+        'raise_exceptions': get('raise_exceptions', True),
+        'pool_name': get('pool_name', None),
+        'pool_size': get('pool_size', None),
+        'pool_lifetime': get('pool_lifetime', None),
+        'receive_timeout': get('receive_timeout', None),
+    }
+
+    return Connection(get_server(using), **client_args)
+
+
+# Pool strategy that orders servers by health (see ServerHealth)
+FASTEST = 'FASTEST'
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_server(using='default'):
+    """Get the ``Server`` or ``ServerPool`` for ``using``.
+
+    ``Server`` objects, along with their TLS configuration, are created
+    the first time they're needed for an alias and reused after that.
+
+    When ``hosts`` is set, a ``ServerPool`` is returned. Its strategy
+    can be set via the ``pool_strategy`` setting: one of ldap3's
+    strategies ("FIRST", "ROUND_ROBIN", or "RANDOM") or "FASTEST". With
+    "FASTEST", servers are tried in order of their health as tracked by
+    :data:`server_health`: the fastest server first, with servers that
+    have failed in the last ``server_cooldown`` seconds (60 by default)
+    moved to the end.
+
+    """
+    with _servers_lock:
+        server = _servers.get(using)
+        if server is None:
+            server = _servers[using] = _make_server(using)
+    if isinstance(server, list):
+        cooldown = settings.get('server_cooldown', DEFAULT_SERVER_COOLDOWN, using=using)
+        server = ServerPool(server_health.sort(server, cooldown), ldap3.FIRST, active=1)
+    return server
+
+
+def clear_server_cache():
+    """Clear the cache used by :func:`get_server`."""
+    with _servers_lock:
+        _servers.clear()
+
+
+def _make_server(using):
+    get = partial(settings.get, using=using)
+
     host = get('host', None)
     hosts = get('hosts', None)
 
@@ -54,29 +119,119 @@ def connect(using='default') -> Connection:
 
     server_args = {
         'port': get('port', None),
+        'connect_timeout': get('connect_timeout', None),
         'use_ssl': use_ssl,
         'tls': tls,
         'get_info': ldap3.NONE,
     }
 
     if host:
-        server = Server(host, **server_args)
-    else:
-        hosts = [Server(h, **server_args) for h in hosts]
-        server = ServerPool(hosts)
+        return Server(host, **server_args)
 
-    client_args = {
-        'user': get('username', None),
-        'password': get('password', None),
-        'auto_bind': setting_to_ldap3_attr(get('auto_bind', 'AUTO_BIND_NONE')),
-        'authentication': setting_to_ldap3_attr(get('authentication', None)),
-        'client_strategy': setting_to_ldap3_attr(get('strategy', 'SYNC')),
-        'read_only': get('read_only', True),
-        'lazy': get('lazy', True),
-        'raise_exceptions': get('raise_exceptions', True),
-        'pool_name': get('pool_name', None),
-        'pool_size': get('pool_size', None),
-        'pool_lifetime': get('pool_lifetime', None),
-    }
+    servers = [Server(h, **server_args) for h in hosts]
+    pool_strategy = get('pool_strategy', None)
+    if pool_strategy == FASTEST:
+        # A new pool is created for each connection; see get_server().
+        return servers
+    if pool_strategy:
+        return ServerPool(servers, setting_to_ldap3_attr(pool_strategy))
+    return ServerPool(servers)
+
+
+DEFAULT_SERVER_COOLDOWN = 60
+
+
+class ServerHealth:
+
+    """Tracks the latency and errors of LDAP servers.
+
+    Latency is tracked as an exponentially weighted moving average of
+    the durations passed to :meth:`record_latency`; ``smoothing`` is the
+    weight given to each new duration. Only binds and single round
+    trips should be recorded as latency; the duration of other
+    operations depends on how much data they transfer, so they're
+    recorded via :meth:`record_success` instead.
+
+    """
 
-    return Connection(server, **client_args)
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._failed_at = {}
+
+    def record_latency(self, server, seconds):
+        """Record a successful bind or round trip to ``server``."""
+        with self._lock:
+            latency = self._latencies.get(server.name)
+            if latency is None:
+                latency = seconds
+            else:
+                latency += self.smoothing * (seconds - latency)
+            self._latencies[server.name] = latency
+            self._failed_at.pop(server.name, None)
+
+    def record_success(self, server):
+        """Record a successful operation on ``server`` without timing it."""
+        with self._lock:
+            self._failed_at.pop(server.name, None)
+
+    def record_error(self, server):
+        """Record a communication error for ``server``."""
+        with self._lock:
+            self._failed_at[server.name] = time.monotonic()
+
+    def record_open(self, connection, seconds):
+        """Record the successful opening (and binding) of ``connection``.
+
+        When a ``FIRST`` server pool is used, any servers in the pool
+        ahead of the one that was connected to must have been
+        unavailable, so errors are recorded for them.
+
+        """
+        pool = connection.server_pool
+        if pool is not None and pool.strategy == ldap3.FIRST:
+            for server in pool:
+                if server is connection.server:
+                    break
+                self.record_error(server)
+            else:
+                return
+            if server is not pool.servers[0]:
+                # The time includes the time spent on the other servers.
+                return
+        self.record_latency(connection.server, seconds)
+
+    def record_connection_error(self, connection, exc):
+        """Record a communication error (``exc``) for ``connection``."""
+        if isinstance(exc, LDAPServerPoolExhaustedError):
+            for server in connection.server_pool:
+                self.record_error(server)
+        elif connection.server is not None:
+            self.record_error(connection.server)
+
+    def sort(self, servers, cooldown=DEFAULT_SERVER_COOLDOWN):
+        """Sort ``servers`` from most to least preferred.
+
+        Healthy servers come first, fastest first (servers without any
+        recorded operations are tried before others so their latency
+        can be measured), followed by servers that have failed in the
+        last ``cooldown`` seconds, least recently failed first.
+
+        """
+        now = time.monotonic()
+        with self._lock:
+            def key(server):
+                failed_at = self._failed_at.get(server.name)
+                if failed_at is not None and now - failed_at < cooldown:
+                    return (1, failed_at)
+                return (0, self._latencies.get(server.name, 0))
+            return sorted(servers, key=key)
+
+    def reset(self):
+        with self._lock:
+            self._latencies.clear()
+            self._failed_at.clear()
+
+
+server_health = ServerHealth()
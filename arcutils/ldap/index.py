@@ -0,0 +1,216 @@
+"""In-memory directory index for autocomplete.
+
+Running a wildcard LDAP search on every keystroke is slow and puts
+a lot of load on the LDAP servers. A :class:`DirectoryIndex` loads the
+username, names, and email address of every entry matching a query
+(via a paged search) and answers prefix queries from memory::
+
+    directory_index = DirectoryIndex()
+    directory_index.refresh()
+    directory_index.start_refresher(interval=3600)
+
+    directory_index.search('matt j')
+    # -> [IndexEntry(username='mdj2', first_name='Matt', ...), ...]
+
+Each search term must be a prefix of the entry's username, first name,
+last name, full name, or email address (case-insensitive).
+
+The index is a sorted array of lower-cased terms with a parallel array
+of entry numbers, which is compact and allows prefix lookups via
+bisection. Refreshing builds a new index in the background and swaps
+it in when it's complete, so searches are never blocked and never see
+a partial index.
+
+If the index hasn't been loaded yet or has no matches for a query, it
+falls back to a live LDAP search (pass ``fallback=False`` to disable
+this).
+
+.. note:: Each process has its own index, so the refresher runs in
+          a thread in each process rather than in a separate process
+          like :class:`arcutils.tasks.DailyTasksProcess`. The refresh
+          method can be used as a daily task for a process that does
+          its own searching, though.
+
+"""
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+from ldap3.core.exceptions import LDAPException
+
+from .breaker import CircuitOpenError
+from .search import ldapsearch, ldapsearch_iter
+from .utils import escape
+
+
+log = logging.getLogger(__name__)
+
+
+IndexEntry = namedtuple(
+    'IndexEntry', 'username first_name last_name full_name email_address')
+
+
+INDEX_FIELDS = IndexEntry._fields
+
+
+_Index = namedtuple('_Index', 'entries keys entry_numbers')
+
+
+class DirectoryIndex:
+
+    """An in-memory prefix index of directory entries.
+
+    Args:
+        using: The LDAP connection to load entries from
+        query: The query used to select entries
+        page_size: The page size used when loading entries
+        fallback: Whether to fall back to a live LDAP search when the
+            index has no matches for a query
+
+    """
+
+    def __init__(self, using='default', query='(uid=*)', page_size=500, fallback=True):
+        self.using = using
+        self.query = query
+        self.page_size = page_size
+        self.fallback = fallback
+        self._index = None
+        self._refresh_lock = threading.Lock()
+        self._stop_event = None
+
+    def __len__(self):
+        index = self._index
+        return len(index.entries) if index is not None else 0
+
+    @property
+    def loaded(self):
+        return self._index is not None
+
+    def refresh(self):
+        """Load entries from LDAP and swap in a new index."""
+        with self._refresh_lock:
+            results = ldapsearch_iter(
+                self.query, using=self.using, page_size=self.page_size, fields=INDEX_FIELDS)
+            index = self.build(results)
+            self._index = index
+            log.info('Loaded %d LDAP entries into directory index', len(index.entries))
+
+    def build(self, profiles):
+        """Build an index from ``profiles`` (dicts with the index fields)."""
+        entries = []
+        terms = []
+        for profile in profiles:
+            entry = IndexEntry(*(profile.get(field) for field in INDEX_FIELDS))
+            entry_number = len(entries)
+            entries.append(entry)
+            terms.extend((term, entry_number) for term in _get_terms(entry))
+        terms.sort()
+        keys = [key for key, _ in terms]
+        entry_numbers = array('I', (entry_number for _, entry_number in terms))
+        return _Index(tuple(entries), keys, entry_numbers)
+
+    def search(self, query, limit=10):
+        """Find up to ``limit`` entries matching ``query``.
+
+        ``query`` is split into words, and each word must be a prefix of
+        one of the entry's terms (username, first name, etc).
+
+        """
+        words = query.lower().split()
+        if not words:
+            return []
+        index = self._index
+        results = self._search_index(index, words, limit) if index is not None else []
+        if not results and self.fallback:
+            results = self._search_ldap(words, limit)
+        return results
+
+    def start_refresher(self, interval=3600):
+        """Refresh the index every ``interval`` seconds in a thread.
+
+        If the index hasn't been loaded yet, it's loaded right away (in
+        the thread).
+
+        """
+        if self._stop_event is not None:
+            raise RuntimeError('Refresher already started')
+        stop_event = self._stop_event = threading.Event()
+
+        def run():
+            wait = 0 if self._index is None else interval
+            while not stop_event.wait(wait):
+                try:
+                    self.refresh()
+                except Exception:
+                    log.exception('Could not refresh directory index; keeping current index')
+                wait = interval
+
+        thread = threading.Thread(target=run, name='DirectoryIndexRefresher', daemon=True)
+        thread.start()
+        return thread
+
+    def stop_refresher(self):
+        if self._stop_event is not None:
+            self._stop_event.set()
+            self._stop_event = None
+
+    def _search_index(self, index, words, limit):
+        # Find candidates via the longest word, which probably has the
+        # fewest matches, then check them against the other words.
+        words = sorted(words, key=len, reverse=True)
+        first_word, other_words = words[0], words[1:]
+        keys, entry_numbers, entries = index.keys, index.entry_numbers, index.entries
+        seen = set()
+        results = []
+        i = bisect_left(keys, first_word)
+        while i < len(keys) and keys[i].startswith(first_word):
+            entry_number = entry_numbers[i]
+            i += 1
+            if entry_number in seen:
+                continue
+            seen.add(entry_number)
+            entry = entries[entry_number]
+            if other_words:
+                terms = _get_terms(entry)
+                if not all(any(t.startswith(w) for t in terms) for w in other_words):
+                    continue
+            results.append(entry)
+            if len(results) == limit:
+                break
+        return results
+
+    def _search_ldap(self, words, limit):
+        filters = []
+        for word in words:
+            word = escape(word)
+            filters.append(
+                '(|(uid={0}*)(givenName={0}*)(sn={0}*)(cn={0}*)(mail={0}*))'.format(word))
+        query = '(&{0})'.format(''.join(filters)) if len(filters) > 1 else filters[0]
+        try:
+            results = ldapsearch(query, using=self.using, fields=INDEX_FIELDS, size_limit=limit)
+        except CircuitOpenError:
+            # The failures that opened the circuit were already logged,
+            # so a traceback for every search (i.e., every keystroke)
+            # would just be noise.
+            log.debug(
+                'Directory index fallback search skipped; circuit for %s is open', self.using)
+            return []
+        except LDAPException:
+            log.exception('Directory index fallback search failed')
+            return []
+        return [IndexEntry(*(r[field] for field in INDEX_FIELDS)) for r in results[:limit]]
+
+
+def _get_terms(entry):
+    """Get the lower-cased terms an entry can be found by."""
+    terms = set()
+    for value in entry:
+        if value:
+            value = value.lower()
+            terms.add(value)
+            terms.update(value.split())
+    if entry.email_address:
+        terms.add(entry.email_address.split('@', 1)[0].lower())
+    return terms
@@ -0,0 +1,237 @@
+"""Persistent, bound LDAP connections.
+
+Opening a connection and binding costs several round trips (more when
+``use_ssl`` is set), which is often more than the search itself. The
+:class:`ConnectionManager` keeps bound connections open and hands them
+out to one thread at a time, so a search costs one round trip.
+
+:func:`arcutils.ldap.ldapsearch` uses the default manager unless it's
+disabled for a connection by setting ``connection_pool`` to ``None``::
+
+    LDAP = {
+        'default': {
+            'host': 'ldap-login.oit.pdx.edu',
+            'connection_pool': {
+                # Max number of idle connections to keep open
+                'max_size': 4,
+                # Connections that have been idle for this many seconds
+                # are checked before they're used
+                'keepalive': 60,
+                # Connections that have been idle for this many seconds
+                # are closed instead of being used
+                'max_idle': 600,
+            },
+        }
+    }
+
+Connections that turn out to be stale (e.g., because the server closed
+them) are replaced transparently.
+
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import ldap3
+from ldap3.core.exceptions import (
+    LDAPCommunicationError,
+    LDAPException,
+    LDAPServerPoolExhaustedError,
+)
+
+from .connection import connect, server_health
+from .settings import settings
+
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_POOL_SETTINGS = {
+    'max_size': 4,
+    'keepalive': 60,
+    'max_idle': 600,
+}
+
+
+def get_pool_settings(using='default'):
+    """Get connection pool settings for ``using``.
+
+    Returns ``None`` if pooling is disabled for ``using``.
+
+    """
+    pool_settings = settings.get('connection_pool', {}, using=using)
+    if pool_settings is None:
+        return None
+    return dict(DEFAULT_POOL_SETTINGS, **pool_settings)
+
+
+class ConnectionManager:
+
+    """Keeps bound LDAP connections open per ``using`` alias.
+
+    Connections are checked out via :meth:`connection` and returned to
+    the pool when the ``with`` block exits. A connection is used by only
+    one thread at a time.
+
+    Args:
+        connect: A function that creates an (unbound) connection for
+            a ``using`` alias; :func:`arcutils.ldap.connect` by default
+
+    """
+
+    def __init__(self, connect=connect):
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._pools = {}
+        self._pid = os.getpid()
+
+    @contextmanager
+    def connection(self, using='default', fresh=False):
+        """Check out a bound connection for ``using``.
+
+        If an LDAP communication error occurs in the ``with`` block, the
+        connection is discarded instead of being returned to the pool.
+
+        If ``fresh`` is set, a new connection will be opened instead of
+        reusing an idle connection.
+
+        """
+        connection = self._open(using) if fresh else self.checkout(using)
+        try:
+            yield connection
+        except LDAPCommunicationError:
+            self.discard(connection)
+            raise
+        except BaseException:
+            self.checkin(using, connection)
+            raise
+        else:
+            self.checkin(using, connection)
+
+    def run(self, using, func, *args, **kwargs):
+        """Call ``func(connection, *args, **kwargs)`` and return its result.
+
+        If the connection turns out to be stale, ``func`` is retried
+        once with a new connection.
+
+        The success or failure of each call is recorded for the
+        connection's server (see :class:`arcutils.ldap.connection.ServerHealth`).
+        Calls aren't timed, since their duration depends on how much
+        data they transfer; latency is measured when connections are
+        bound and checked instead.
+
+        """
+        try:
+            with self.connection(using) as connection:
+                return self._call(connection, func, *args, **kwargs)
+        except LDAPCommunicationError:
+            log.info('LDAP connection for %s was stale; retrying with new connection', using)
+        with self.connection(using, fresh=True) as connection:
+            return self._call(connection, func, *args, **kwargs)
+
+    def checkout(self, using='default'):
+        """Get a bound connection; prefer :meth:`connection`."""
+        pool_settings = get_pool_settings(using) or DEFAULT_POOL_SETTINGS
+        now = time.monotonic()
+        while True:
+            with self._lock:
+                self._check_pid()
+                idle = self._pools.get(using)
+                item = idle.pop() if idle else None
+            if item is None:
+                return self._open(using)
+            connection, last_used = item
+            idle_time = now - last_used
+            if idle_time > pool_settings['max_idle']:
+                self.discard(connection)
+            elif idle_time > pool_settings['keepalive'] and not self.is_alive(connection):
+                self.discard(connection)
+            else:
+                return connection
+
+    def checkin(self, using, connection):
+        """Return a connection to the pool."""
+        pool_settings = get_pool_settings(using) or DEFAULT_POOL_SETTINGS
+        if connection.closed or not connection.bound:
+            return
+        with self._lock:
+            self._check_pid()
+            idle = self._pools.setdefault(using, deque())
+            if len(idle) < pool_settings['max_size']:
+                idle.append((connection, time.monotonic()))
+                connection = None
+        if connection is not None:
+            self.discard(connection)
+
+    def discard(self, connection):
+        """Close ``connection`` (ignoring errors)."""
+        try:
+            connection.unbind()
+        except LDAPException:
+            pass
+
+    def close_all(self):
+        """Close all idle connections."""
+        with self._lock:
+            pools, self._pools = self._pools, {}
+        for idle in pools.values():
+            for connection, _ in idle:
+                self.discard(connection)
+
+    def is_alive(self, connection):
+        """Check ``connection`` with a cheap search of the root DSE.
+
+        This is a single round trip, so its duration is recorded as the
+        server's latency.
+
+        """
+        start = time.monotonic()
+        try:
+            connection.search('', '(objectClass=*)', ldap3.BASE, attributes=['1.1'])
+        except LDAPCommunicationError as exc:
+            server_health.record_connection_error(connection, exc)
+            return False
+        except LDAPException:
+            # The server responded, just not in the expected way.
+            pass
+        if connection.closed:
+            return False
+        server_health.record_latency(connection.server, time.monotonic() - start)
+        return True
+
+    def _call(self, connection, func, *args, **kwargs):
+        try:
+            result = func(connection, *args, **kwargs)
+        except LDAPCommunicationError as exc:
+            server_health.record_connection_error(connection, exc)
+            raise
+        server_health.record_success(connection.server)
+        return result
+
+    def _open(self, using):
+        connection = self._connect(using)
+        # Lazy connections don't actually bind until they're used.
+        connection.lazy = False
+        start = time.monotonic()
+        try:
+            connection.bind()
+        except (LDAPCommunicationError, LDAPServerPoolExhaustedError) as exc:
+            server_health.record_connection_error(connection, exc)
+            raise
+        server_health.record_open(connection, time.monotonic() - start)
+        return connection
+
+    def _check_pid(self):
+        # Connections opened in a parent process can't be shared with
+        # forked child processes (e.g., WSGI workers), so they're
+        # forgotten (but not unbound, which would affect the parent).
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pools = {}
+            self._pid = pid
+
+
+connection_manager = ConnectionManager()
@@ -1,10 +1,74 @@
 import functools
 import re
+from collections import Mapping
+
+from .utils import parse_dn_cached
+
+
+PROFILE_FIELDS = (
+    'first_name',
+    'last_name',
+    'full_name',
+    'title',
+    'ou',
+    'school_or_office',
+    'department',
+    'email_address',
+    'email_addresses',
+    'canonical_email_address',
+    'odin',  # deprecated
+    'username',
+    'phone_number',
+    'extension',
+    'room_number',
+    'roles',
+    'password_expiration_date',
+    'member_of',
+)
+
+
+# Profile field => LDAP attributes it's parsed from
+_NAME_ATTRIBUTES = ('preferredcn', 'displayName', 'cn')
+_EMAIL_ATTRIBUTES = ('mail', 'uid', 'name')
+PROFILE_FIELD_ATTRIBUTES = {
+    'first_name': ('givenName',) + _NAME_ATTRIBUTES,
+    'last_name': ('sn',) + _NAME_ATTRIBUTES,
+    'full_name': _NAME_ATTRIBUTES,
+    'title': ('title',),
+    'ou': ('ou', 'department'),
+    'school_or_office': ('ou', 'department'),
+    'department': ('ou', 'department'),
+    'email_address': _EMAIL_ATTRIBUTES,
+    'email_addresses': _EMAIL_ATTRIBUTES + ('mailRoutingAddress', 'mailLocalAddress'),
+    'canonical_email_address': ('mailRoutingAddress', 'mail'),
+    'odin': ('uid', 'name'),
+    'username': ('uid', 'name'),
+    'phone_number': ('telephoneNumber',),
+    'extension': ('telephoneNumber',),
+    'room_number': ('roomNumber', 'physicalDeliveryOfficeName'),
+    'roles': ('eduPersonAffiliation',),
+    'password_expiration_date': ('psuPasswordExpireDate',),
+    'member_of': ('memberOf',),
+}
+
+
+def get_profile_attributes(fields):
+    """Get the LDAP attributes needed to parse the profile ``fields``.
+
+        >>> get_profile_attributes(['username', 'title'])
+        ['name', 'title', 'uid']
 
-from .utils import parse_dn
+    """
+    attributes = set()
+    for field in fields:
+        try:
+            attributes.update(PROFILE_FIELD_ATTRIBUTES[field])
+        except KeyError:
+            raise ValueError('Unknown profile field: {field}'.format(field=field)) from None
+    return sorted(attributes)
 
 
-def parse_profile(attributes):
+def parse_profile(attributes, fields=None):
     """Parse fields from LDAP attributes into a dict.
 
     Items that will be present in the returned dict:
@@ -34,61 +98,161 @@ def parse_profile(attributes):
         >>> parse_profile(attributes)
         {'first_name': 'Matthew', 'last_name': 'Johnson', 'username': 'mdj2', ...}
 
+    If ``fields`` is passed, only those fields will be parsed and
+    included in the returned dict. :func:`get_profile_attributes` can be
+    used to get the LDAP attributes needed for them.
+
+    See :class:`LDAPProfile` for a lazy alternative.
+
     """
-    get = functools.partial(_get_attribute, attributes)
+    profile = LDAPProfile(attributes)
+    if fields is None:
+        return dict(profile)
+    return {field: profile[field] for field in fields}
+
+
+class LDAPProfile(Mapping):
+
+    """A read-only, lazily-parsed profile.
+
+    This has the same items as the dict returned by
+    :func:`parse_profile`, but each item is parsed from the LDAP
+    attributes only when it's first accessed (as a key or as an
+    attribute). Since values are stored in slots, profiles are also
+    smaller than dicts. This makes a difference when only a few items
+    are needed from a large number of results::
+
+        >>> results = ldapsearch('(uid=*)', parse=LDAPProfile)
+        >>> [(r.username, r['email_address']) for r in results]
+        [('bob', 'bob@pdx.edu'), ...]
+
+    Use ``dict(profile)`` to get a regular dict (e.g., to serialize it
+    as JSON).
 
-    first_name, last_name = parse_name(attributes)
-    full_name = get('preferredcn') or get('displayName') or get('cn') or ''
-    full_name = full_name.split(',', 1)[0]
-    title = get('title')
-
-    # XXX: This part is wonky. I'm not sure how many OU parts there can
-    #      be or what their proper names are (school vs office, etc).
-    ou = get('ou') or get('department')
-    if ou:
-        ou_parts = ou.split(' - ', 1)
-        if len(ou_parts) == 1:
-            school_or_office = ou_parts[0]
-            department = None
+    """
+
+    __slots__ = ('_attributes',) + PROFILE_FIELDS
+
+    def __init__(self, attributes):
+        self._attributes = attributes
+
+    def __getattr__(self, name):
+        # This is only called when a field's slot hasn't been set yet.
+        parser = _PROFILE_PARSERS.get(name)
+        if parser is None:
+            raise AttributeError(
+                "'{0.__class__.__name__}' object has no attribute '{1}'".format(self, name))
+        parser(self)
+        return object.__getattribute__(self, name)
+
+    def __getitem__(self, key):
+        if key not in _PROFILE_PARSERS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(PROFILE_FIELDS)
+
+    def __len__(self):
+        return len(PROFILE_FIELDS)
+
+    def __reduce__(self):
+        # Parsed values aren't copied or pickled; they're cheap to
+        # reparse on demand.
+        return (self.__class__, (self._attributes,))
+
+    def __repr__(self):
+        return '<{0.__class__.__name__}: {0.username}>'.format(self)
+
+    def _get(self, key, all=False):
+        return _get_attribute(self._attributes, key, all)
+
+    def _parse_name(self):
+        self.first_name, self.last_name = parse_name(self._attributes)
+
+    def _parse_full_name(self):
+        full_name = self._get('preferredcn') or self._get('displayName') or self._get('cn') or ''
+        self.full_name = full_name.split(',', 1)[0]
+
+    def _parse_title(self):
+        self.title = self._get('title')
+
+    def _parse_ou(self):
+        # XXX: This part is wonky. I'm not sure how many OU parts there can
+        #      be or what their proper names are (school vs office, etc).
+        ou = self._get('ou') or self._get('department')
+        if ou:
+            ou_parts = ou.split(' - ', 1)
+            if len(ou_parts) == 1:
+                school_or_office = ou_parts[0]
+                department = None
+            else:
+                school_or_office = ou_parts[1]
+                department = ou_parts[0]
         else:
-            school_or_office = ou_parts[1]
-            department = ou_parts[0]
-    else:
-        ou = school_or_office = department = None
-
-    username = get('uid') or get('name')
-
-    preferred_email_address = parse_email(attributes)
-    canonical_email_address = get('mailRoutingAddress') or get('mail')
-    email_addresses = [preferred_email_address] if preferred_email_address else []
-    additional_email_addresses = get('mailRoutingAddress', True) + get('mailLocalAddress', True)
-    for a in additional_email_addresses:
-        if a not in email_addresses:
-            email_addresses.append(a)
-
-    phone_number = parse_phone_number(attributes)
-    extension = parse_psu_extension(attributes, phone_number)
-
-    return {
-        'first_name': first_name,
-        'last_name': last_name,
-        'full_name': full_name,
-        'title': title,
-        'ou': ou,
-        'school_or_office': school_or_office,
-        'department': department,
-        'email_address': preferred_email_address,
-        'email_addresses': email_addresses,
-        'canonical_email_address': canonical_email_address,
-        'odin': username,  # deprecated
-        'username': username,
-        'phone_number': phone_number,
-        'extension': extension,
-        'room_number': get('roomNumber') or get('physicalDeliveryOfficeName'),
-        'roles': get('eduPersonAffiliation', True),
-        'password_expiration_date': _reformat_datetime(get('psuPasswordExpireDate')),
-        'member_of': parse_member_of(attributes)
-    }
+            ou = school_or_office = department = None
+        self.ou, self.school_or_office, self.department = ou, school_or_office, department
+
+    def _parse_email_address(self):
+        self.email_address = parse_email(self._attributes)
+
+    def _parse_email_addresses(self):
+        preferred_email_address = self.email_address
+        email_addresses = [preferred_email_address] if preferred_email_address else []
+        additional_email_addresses = (
+            self._get('mailRoutingAddress', True) + self._get('mailLocalAddress', True))
+        for a in additional_email_addresses:
+            if a not in email_addresses:
+                email_addresses.append(a)
+        self.email_addresses = email_addresses
+
+    def _parse_canonical_email_address(self):
+        self.canonical_email_address = self._get('mailRoutingAddress') or self._get('mail')
+
+    def _parse_username(self):
+        self.username = self.odin = self._get('uid') or self._get('name')
+
+    def _parse_phone_number(self):
+        self.phone_number = parse_phone_number(self._attributes)
+
+    def _parse_extension(self):
+        self.extension = _get_psu_extension(self.phone_number)
+
+    def _parse_room_number(self):
+        self.room_number = self._get('roomNumber') or self._get('physicalDeliveryOfficeName')
+
+    def _parse_roles(self):
+        self.roles = self._get('eduPersonAffiliation', True)
+
+    def _parse_password_expiration_date(self):
+        self.password_expiration_date = _reformat_datetime(self._get('psuPasswordExpireDate'))
+
+    def _parse_member_of(self):
+        self.member_of = parse_member_of(self._attributes)
+
+
+# Field name => function that sets the field (and possibly related
+# fields) on an LDAPProfile
+_PROFILE_PARSERS = {
+    'first_name': LDAPProfile._parse_name,
+    'last_name': LDAPProfile._parse_name,
+    'full_name': LDAPProfile._parse_full_name,
+    'title': LDAPProfile._parse_title,
+    'ou': LDAPProfile._parse_ou,
+    'school_or_office': LDAPProfile._parse_ou,
+    'department': LDAPProfile._parse_ou,
+    'email_address': LDAPProfile._parse_email_address,
+    'email_addresses': LDAPProfile._parse_email_addresses,
+    'canonical_email_address': LDAPProfile._parse_canonical_email_address,
+    'odin': LDAPProfile._parse_username,
+    'username': LDAPProfile._parse_username,
+    'phone_number': LDAPProfile._parse_phone_number,
+    'extension': LDAPProfile._parse_extension,
+    'room_number': LDAPProfile._parse_room_number,
+    'roles': LDAPProfile._parse_roles,
+    'password_expiration_date': LDAPProfile._parse_password_expiration_date,
+    'member_of': LDAPProfile._parse_member_of,
+}
 
 
 def parse_name(attributes):
@@ -143,6 +307,17 @@ def parse_email(attributes, field='mail'):
     return email
 
 
+_NORMALIZED_PHONE_NUMBER_RE = re.compile(r'^[2-9]\d{2}-\d{3}-\d{4}$')
+_PHONE_NUMBER_JUNK_RE = re.compile(r'[\s()-.]')
+_SEVEN_DIGITS_RE = re.compile(r'^\d{7}$')
+_FIVE_DIGIT_EXTENSION_RE = re.compile(r'^x?5\d{4}$')
+_FOUR_DIGIT_EXTENSION_RE = re.compile(r'^x?\d{4}$')
+_ELEVEN_DIGITS_RE = re.compile(r'^1\d{10}$')
+_TEN_DIGITS_RE = re.compile(r'^[2-9]\d{9}$')
+_PSU_PHONE_NUMBER_RE = re.compile(r'503-725-\d{4}$')
+_DATETIME_RE = re.compile(r'^\d{14}Z$')
+
+
 def parse_phone_number(attributes, phone_number=None):
     """Get phone number from LDAP attributes and standardize it.
 
@@ -192,7 +367,7 @@ def parse_phone_number(attributes, phone_number=None):
     if not phone_number:
         return None
 
-    if re.search(r'^[2-9]\d{2}-\d{3}-\d{4}$', phone_number):
+    if _NORMALIZED_PHONE_NUMBER_RE.search(phone_number):
         # Short circuit if already normalized
         return phone_number
 
@@ -203,26 +378,26 @@ def parse_phone_number(attributes, phone_number=None):
         phone_number = phone_number[2:]
         phone_number = phone_number.strip()
 
-    phone_number = re.sub('[\s()-.]', '', phone_number)
+    phone_number = _PHONE_NUMBER_JUNK_RE.sub('', phone_number)
 
     # Add area code
-    if re.search(r'^\d{7}$', phone_number):
+    if _SEVEN_DIGITS_RE.search(phone_number):
         phone_number = '503{phone_number}'.format_map(locals())
     # Convert extension to full number
-    elif re.search(r'^x?5\d{4}$', phone_number):
+    elif _FIVE_DIGIT_EXTENSION_RE.search(phone_number):
         extension = phone_number[1:] if phone_number.startswith('x') else phone_number
         phone_number = '50372{extension}'.format_map(locals())
     # Apparently, extensions are sometimes specified using just the last
     # four digits
-    elif re.search(r'^x?\d{4}$', phone_number):
+    elif _FOUR_DIGIT_EXTENSION_RE.search(phone_number):
         extension = phone_number[1:] if phone_number.startswith('x') else phone_number
         phone_number = '503725{extension}'.format_map(locals())
     # Strip leading 1
-    elif re.search(r'^1\d{10}$', phone_number):
+    elif _ELEVEN_DIGITS_RE.search(phone_number):
         phone_number = phone_number[1:]
 
     # Normalize number by adding dashes between parts
-    if re.search(r'^[2-9]\d{9}$', phone_number):
+    if _TEN_DIGITS_RE.search(phone_number):
         phone_number = '-'.join((phone_number[:3], phone_number[3:6], phone_number[6:]))
     else:
         phone_number = original_value
@@ -247,13 +422,17 @@ def parse_psu_extension(attributes, phone_number=None):
         None: The phone doesn't look like a PSU number
 
     """
-    phone_number = parse_phone_number(attributes, phone_number)
-    if phone_number and re.search(r'503-725-\d{4}$', phone_number):
+    return _get_psu_extension(parse_phone_number(attributes, phone_number))
+
+
+def _get_psu_extension(phone_number):
+    """Get extension from an already-normalized phone number."""
+    if phone_number and _PSU_PHONE_NUMBER_RE.search(phone_number):
         return phone_number[-6:]
     return None
 
 
-def parse_member_of(attributes):
+def parse_member_of(attributes, parsed_dns=None):
     """Parse AD ``memberOf`` field into a list of dicts.
 
     The ``memberOf`` field contains items with this format::
@@ -265,10 +444,17 @@ def parse_member_of(attributes):
 
         [{'name': 'AAA'}, {'name': 'XXX'}]
 
+    Parsed DNs are cached. When parsing many results, the DNs from all
+    of them can be parsed up front via :func:`arcutils.ldap.utils.parse_dns`
+    and passed as ``parsed_dns``.
+
     """
     member_of = _get_attribute(attributes, 'memberOf', True)
-    member_of = [parse_dn(m) for m in member_of]
-    member_of = [{'name': dn['first_cn']} for dn in member_of]
+    if parsed_dns is None:
+        member_of = [parse_dn_cached(m) for m in member_of]
+    else:
+        member_of = [parsed_dns.get(m) or parse_dn_cached(m) for m in member_of]
+    member_of = [{'name': dn.get('first_cn')} for dn in member_of]
     return member_of
 
 
@@ -277,7 +463,7 @@ def _reformat_datetime(dt):
     # between date and time).
     if not dt:
         return
-    if not re.search('^\d{14}Z$', dt):
+    if not _DATETIME_RE.search(dt):
         raise ValueError('Expected string with format yyyyMMddHHmmssZ; got {}'.format(dt))
     return '{}T{}'.format(dt[:8], dt[8:])
 
@@ -303,15 +489,10 @@ def _get_attribute(attributes, key, all=False):
     .. note:: A list is always returned when ``all`` is set.
 
     """
-    if key in attributes:
-        attr = attributes[key]
-        attr = [v.strip() for v in attr]
-        attr = [v for v in attr if v]
-        if not all:
-            try:
-                attr = attr[0]
-            except IndexError:
-                attr = None
-    else:
-        attr = [] if all else None
-    return attr
+    if key not in attributes:
+        return [] if all else None
+    values = (v.strip() for v in attributes[key])
+    if all:
+        return [v for v in values if v]
+    # Only strip values up to the first non-empty value
+    return next((v for v in values if v), None)
@@ -1,18 +1,37 @@
 import ldap3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
+from ldap3.core.exceptions import LDAPException
+
 from ..registry import get_registry
+from .breaker import guard
+from .cache import get_cache_settings, make_key, search_cache
 from .connection import connect
-from .profile import parse_profile
+from .pool import connection_manager, get_pool_settings
+from .profile import get_profile_attributes, parse_profile
 from .settings import settings
+from .utils import escape
 
 
 def ldapsearch(query, connection=None, using='default', search_base=None,
-               search_scope=ldap3.SUBTREE, attributes=None, parse=True, **kwargs):
+               search_scope=ldap3.SUBTREE, attributes=None, parse=True, cache=True, fields=None,
+               **kwargs):
     """Performs an LDAP search and returns the results.
 
     If there are results, they will be parsed via :func:`parse_profile`
-    unless ``parse=False``.
+    unless ``parse=False``. ``parse`` can also be a function that takes
+    the attributes of a result, such as
+    :class:`arcutils.ldap.profile.LDAPProfile`, which parses fields
+    lazily.
+
+    To fetch and parse only some profile fields, pass their names as
+    ``fields`` (e.g., ``fields=['username', 'email_address']``). Only
+    the LDAP attributes needed for those fields will be requested (see
+    :func:`arcutils.ldap.profile.get_profile_attributes`), and, when the
+    default parser is used, only those fields will be included in each
+    profile.
 
     If there are no results, an empty list will be returned.
 
@@ -26,8 +45,19 @@ def ldapsearch(query, connection=None, using='default', search_base=None,
 
     If a ``connection`` isn't passed, we first look for one in the
     component registry (registered under ``ldap3.Connection``). If
-    a connection object isn't found in the registry, one will be
-    constructed from the ``LDAP`` settings indicated by ``using``.
+    a connection object isn't found in the registry, a persistent
+    connection for ``using`` is checked out from the connection manager
+    (see :mod:`arcutils.ldap.pool`), or, if pooling is disabled for
+    ``using``, a new connection is constructed from the ``LDAP``
+    settings indicated by ``using``. In these cases, the search is
+    guarded by the circuit breaker for ``using`` (see
+    :mod:`arcutils.ldap.breaker`), so it will fail fast with
+    a :class:`arcutils.ldap.breaker.CircuitOpenError` when the LDAP
+    servers are known to be unreachable.
+
+    If caching is enabled for ``using`` (see :mod:`arcutils.ldap.cache`)
+    and a ``connection`` isn't passed, cached results will be returned
+    when available. Pass ``cache=False`` to skip the cache.
 
     ``attributes`` and all other keyword args are sent directly to
     :meth:`ldap3.Connection.search`.
@@ -36,15 +66,21 @@ def ldapsearch(query, connection=None, using='default', search_base=None,
     get = partial(settings.get, using=using)
 
     search_base = search_base or get('search_base')
-    attributes = attributes or get('attributes', None) or ldap3.ALL_ATTRIBUTES
+    attributes = get_attributes(using, attributes, fields)
 
-    if connection is None:
-        registry = get_registry()
-        connection = registry.get_component(ldap3.Connection, name=using)
-        if connection is None:
-            connection = connect(using)
+    cache_settings = get_cache_settings(using) if cache and connection is None else None
+    if cache_settings is not None:
+        cache_key = make_key(
+            using, search_base, query, search_scope, attributes, parse, kwargs, fields)
+        if cache_key is None:
+            # parse can't be keyed, so this search isn't cached
+            cache_settings = None
+    if cache_settings is not None:
+        results = search_cache.get(using, cache_key, cache_settings)
+        if results is not None:
+            return results
 
-    with connection:
+    def search(connection):
         result = connection.search(
             search_base=search_base,
             search_filter=query,
@@ -59,8 +95,148 @@ def ldapsearch(query, connection=None, using='default', search_base=None,
             # For asynchronous strategies, result will be an int.
             response, _ = connection.get_response(result)
 
+        return response
+
+    if connection is None:
+        registry = get_registry()
+        connection = registry.get_component(ldap3.Connection, name=using)
+
+    if connection is not None:
+        with connection:
+            response = search(connection)
+    elif get_pool_settings(using) is None:
+        with guard(using), connect(using) as connection:
+            response = search(connection)
+    else:
+        with guard(using):
+            response = connection_manager.run(using, search)
+
     results = [r for r in response if r.get('type') != 'searchResRef']
-    return [parse_profile(r['attributes']) for r in results] if parse else results
+    parser = get_parser(parse, fields)
+    results = [parser(r['attributes']) for r in results] if parser else results
+
+    if cache_settings is not None:
+        search_cache.set(using, cache_key, query, results, cache_settings)
+
+    return results
+
+
+PAGED_RESULTS_CONTROL = '1.2.840.113556.1.4.319'
+
+
+def ldapsearch_iter(query, connection=None, using='default', search_base=None,
+                    search_scope=ldap3.SUBTREE, attributes=None, parse=True, page_size=500,
+                    fields=None, **kwargs):
+    """Performs a paged LDAP search and yields results as they arrive.
+
+    This is like :func:`ldapsearch`, but results are requested from the
+    server ``page_size`` entries at a time using the simple paged
+    results control (RFC 2696), and each result is parsed only when it's
+    reached. This allows searches that return more than the server's
+    size limit (e.g., 2,000 entries) to be run in bounded memory::
+
+        for profile in ldapsearch_iter('(uid=*)'):
+            ...
+
+    The next page isn't requested until the current page has been
+    consumed, so breaking out of the loop (or closing the generator)
+    stops the search. In that case, the server is told to discard the
+    rest of the results.
+
+    A connection is held from the time iteration starts until it stops
+    (see :mod:`arcutils.ldap.pool`). Results are never cached.
+
+    ``attributes`` and all other keyword args are sent directly to
+    :meth:`ldap3.Connection.search`.
+
+    """
+    if page_size < 1:
+        raise ValueError('page_size must be greater than 0')
+
+    get = partial(settings.get, using=using)
+
+    search_base = search_base or get('search_base')
+    attributes = get_attributes(using, attributes, fields)
+
+    def search(connection, cookie, size=page_size):
+        result = connection.search(
+            search_base=search_base,
+            search_filter=query,
+            search_scope=search_scope,
+            attributes=attributes,
+            paged_size=size,
+            paged_cookie=cookie,
+            **kwargs)
+
+        if connection.strategy.sync:
+            response = connection.response if result else []
+            result = connection.result
+        else:
+            response, result = connection.get_response(result)
+
+        controls = (result or {}).get('controls') or {}
+        cookie = controls.get(PAGED_RESULTS_CONTROL, {}).get('value', {}).get('cookie')
+        return response or [], cookie
+
+    parser = get_parser(parse, fields)
+
+    def iter_results(connection):
+        cookie = None
+        done = False
+        try:
+            while not done:
+                response, cookie = search(connection, cookie)
+                done = not cookie
+                for r in response:
+                    if r.get('type') != 'searchResRef':
+                        yield parser(r['attributes']) if parser else r
+        finally:
+            if cookie and not done:
+                # Tell the server to discard the rest of the results by
+                # requesting an empty page.
+                try:
+                    search(connection, cookie, size=0)
+                except LDAPException:
+                    pass
+
+    if connection is None:
+        registry = get_registry()
+        connection = registry.get_component(ldap3.Connection, name=using)
+
+    if connection is not None:
+        with connection:
+            yield from iter_results(connection)
+    elif get_pool_settings(using) is None:
+        with guard(using), connect(using) as connection:
+            yield from iter_results(connection)
+    else:
+        with guard(using), connection_manager.connection(using) as connection:
+            yield from iter_results(connection)
+
+
+def get_attributes(using='default', attributes=None, fields=None):
+    """Get the attributes to request.
+
+    In order of precedence: the specified ``attributes``, the
+    attributes needed to parse the profile ``fields``, the attributes
+    from the ``using`` settings, or all attributes.
+
+    """
+    if attributes:
+        return attributes
+    if fields:
+        return get_profile_attributes(fields)
+    return settings.get('attributes', None, using=using) or ldap3.ALL_ATTRIBUTES
+
+
+def get_parser(parse, fields=None):
+    """Get the function used to parse results (``None`` if ``parse`` is
+    false).
+
+    """
+    if parse is True:
+        return partial(parse_profile, fields=fields) if fields else parse_profile
+    return parse or None
 
 
 def ldapsearch_by_email(email, **kwargs):
@@ -79,3 +255,112 @@ def ldapsearch_by_email(email, **kwargs):
         .format(email=email)
     )
     return ldapsearch(query, **kwargs)
+
+
+class ManyResults(OrderedDict):
+
+    """Results of :func:`ldapsearch_many` keyed by input value.
+
+    Values that weren't found are listed in ``misses``.
+
+    """
+
+    def __init__(self, *args, misses=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.misses = list(misses)
+
+
+def ldapsearch_many(values, attribute='uid', chunk_size=100, max_workers=4, using='default',
+                    attributes=None, parse=True, fields=None, **kwargs):
+    """Look up many entries by ``attribute`` in a few searches.
+
+    Instead of running one search per value, values are combined into
+    ``(|(uid=a)(uid=b)...)`` filters with up to ``chunk_size`` values
+    each, and up to ``max_workers`` of these searches are run
+    concurrently (each on its own connection). If a ``connection`` is
+    passed or one is registered for ``using``, the searches are run
+    one after another instead, since a connection can't be shared
+    between threads.
+
+    Values are escaped, and matching is case-insensitive.
+
+    Returns a :class:`ManyResults` dict that maps each value that was
+    found to its (parsed) result; values that weren't found are listed
+    in its ``misses`` attribute::
+
+        >>> results = ldapsearch_many(['bob', 'alice', 'nobody'])
+        >>> results['bob']
+        {'first_name': 'Bob', ...}
+        >>> results.misses
+        ['nobody']
+
+    Other keyword args are passed through to :func:`ldapsearch`.
+
+    """
+    wanted, queries, attributes = _prepare_many(
+        values, attribute, chunk_size, using, attributes, fields)
+    search = partial(ldapsearch, using=using, attributes=attributes, parse=False, **kwargs)
+
+    connection = kwargs.get('connection')
+    if connection is None:
+        connection = get_registry().get_component(ldap3.Connection, name=using)
+    if connection is not None:
+        max_workers = 1
+
+    if len(queries) > 1 and max_workers > 1:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+            chunk_results = list(executor.map(search, queries))
+    else:
+        chunk_results = [search(query) for query in queries]
+
+    return _collect_many(wanted, chunk_results, attribute, parse, fields)
+
+
+def _prepare_many(values, attribute, chunk_size, using, attributes, fields):
+    """Get normalized values, chunked queries, and attributes for
+    :func:`ldapsearch_many`.
+
+    """
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be greater than 0')
+
+    # Normalized value => input values that normalize to it
+    wanted = OrderedDict()
+    for value in values:
+        wanted.setdefault(value.lower(), []).append(value)
+
+    attributes = get_attributes(using, attributes, fields)
+    if attributes != ldap3.ALL_ATTRIBUTES and attribute not in attributes:
+        attributes = list(attributes) + [attribute]
+
+    keys = list(wanted)
+    chunks = [keys[i:i + chunk_size] for i in range(0, len(keys), chunk_size)]
+    queries = [
+        '(|{0})'.format(''.join('({0}={1})'.format(attribute, escape(v)) for v in chunk))
+        for chunk in chunks
+    ]
+    return wanted, queries, attributes
+
+
+def _collect_many(wanted, chunk_results, attribute, parse, fields):
+    """Match the entries found by :func:`ldapsearch_many` to values."""
+    parser = get_parser(parse, fields)
+    found = {}
+    for entries in chunk_results:
+        for entry in entries:
+            entry_values = entry['attributes'].get(attribute, [])
+            if isinstance(entry_values, str):
+                entry_values = [entry_values]
+            for entry_value in entry_values:
+                key = entry_value.lower()
+                if key in wanted and key not in found:
+                    found[key] = parser(entry['attributes']) if parser else entry
+
+    results = ManyResults()
+    for key, input_values in wanted.items():
+        if key in found:
+            for value in input_values:
+                results[value] = found[key]
+        else:
+            results.misses.extend(input_values)
+    return results
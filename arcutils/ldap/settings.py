@@ -23,6 +23,11 @@ DEFAULTS = {
         'password': None,
         'strategy': 'SYNC',
 
+        # Seconds to wait for a connection to be opened and for a
+        # response to be received (None to wait indefinitely)
+        'connect_timeout': 5,
+        'receive_timeout': 30,
+
         'tls': {
             'ca_certs_file': 'certifi:cacert.pem',
             'validate': 'CERT_REQUIRED',
@@ -39,9 +44,14 @@ DEFAULTS = {
     # cis-windows.
     'ad': {
         'hosts': ['oitdcpsu01.psu.ds.pdx.edu', 'oitdcpsu02.psu.ds.pdx.edu'],
+        # Prefer the fastest healthy domain controller; see get_server()
+        # in arcutils.ldap.connection
+        'pool_strategy': 'FASTEST',
         'use_ssl': True,
         'strategy': 'SYNC',
         'search_base': 'ou=people,dc=psu,dc=ds,dc=pdx,dc=edu',
+        'connect_timeout': 5,
+        'receive_timeout': 30,
         # These are required for AD and must be in the project's local settings:
         # 'username': None,
         # 'password': None,
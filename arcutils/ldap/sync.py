@@ -0,0 +1,197 @@
+"""Incremental syncing of Django users from LDAP.
+
+:func:`sync_users` searches for entries that have been modified since
+a given time (via ``modifyTimestamp``), so the time it takes depends on
+how many entries have changed rather than on the size of the directory.
+Entries are read with a paged search and applied to the user model in
+chunks, with one ``bulk_create`` and one bulk update per chunk.
+
+The ``syncldapusers`` management command wraps this and keeps track of
+the high-water mark (the latest ``modifyTimestamp`` seen) between runs.
+
+.. note:: Entries that are deleted from the directory can't be found
+          this way, so their users are left as is.
+
+"""
+import datetime
+import logging
+import re
+from collections import namedtuple
+
+from django.contrib.auth import get_user_model
+from django.db import router, transaction
+
+from arcutils.db.bulk import DEFAULT_CHUNK_SIZE, chunked, chunked_bulk_create, chunked_bulk_update
+
+from .profile import get_profile_attributes, parse_profile
+from .search import ldapsearch_iter
+
+
+log = logging.getLogger(__name__)
+
+
+# User model field => profile field
+DEFAULT_USER_FIELDS = {
+    'first_name': 'first_name',
+    'last_name': 'last_name',
+    'email': 'email_address',
+}
+
+
+# An LDAP generalized time in UTC, optionally with fractional seconds
+# (as returned by Active Directory).
+TIMESTAMP_RE = re.compile(r'^\d{14}(\.\d+)?Z$')
+
+
+class SyncStats(namedtuple('SyncStats', 'created updated unchanged high_water_mark')):
+
+    __slots__ = ()
+
+
+def format_timestamp(value):
+    """Format ``value`` as an LDAP generalized time.
+
+        >>> format_timestamp(datetime.datetime(2017, 9, 1, 12, 30, 0))
+        '20170901123000Z'
+        >>> format_timestamp('20170901123000Z')
+        '20170901123000Z'
+
+    ``datetime`` values are assumed to be in UTC. Fractional seconds are
+    dropped so that timestamps can be compared as strings regardless of
+    where they came from::
+
+        >>> format_timestamp('20170901123000.0Z')
+        '20170901123000Z'
+
+    Raises:
+        ValueError: ``value`` isn't a ``datetime`` or a generalized
+            time in UTC
+
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.strftime('%Y%m%d%H%M%SZ')
+    if not isinstance(value, str) or not TIMESTAMP_RE.match(value):
+        raise ValueError('Not an LDAP generalized time in UTC: {0!r}'.format(value))
+    return '{0}Z'.format(value[:14])
+
+
+def sync_users(since=None, using='default', query='(uid=*)', user_fields=None,
+               page_size=500, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+    """Create & update users from LDAP entries modified at or after ``since``.
+
+    Args:
+        since: An LDAP generalized time (e.g., "20170901123000Z") or
+            a ``datetime``; if this isn't specified, all entries will be
+            synced
+        using: The LDAP connection to search
+        query: The query used to select entries; it's combined with
+            a ``modifyTimestamp`` filter
+        user_fields: A dict mapping user model fields to the profile
+            fields they're set from; defaults to ``DEFAULT_USER_FIELDS``
+        page_size: The page size used for the LDAP search
+        chunk_size: The number of users to create/update at a time
+            (each chunk's queries are split further as needed to fit
+            the database's limit on query parameters)
+        dry_run: Count the changes that would be made without making
+            them
+
+    Returns:
+        SyncStats: The number of users created, updated, and unchanged,
+            and the latest ``modifyTimestamp`` seen (``since`` if no
+            entries were found), formatted by :func:`format_timestamp`
+
+    Raises:
+        ValueError: ``since`` isn't a valid generalized time
+
+    """
+    user_model = get_user_model()
+    username_field = user_model.USERNAME_FIELD
+    user_fields = DEFAULT_USER_FIELDS if user_fields is None else user_fields
+    profile_fields = ['username'] + list(user_fields.values())
+    attributes = get_profile_attributes(profile_fields) + ['modifyTimestamp']
+    max_lengths = {field: user_model._meta.get_field(field).max_length for field in user_fields}
+
+    since = format_timestamp(since)
+    if since:
+        query = '(&{query}(modifyTimestamp>={since}))'.format(query=query, since=since)
+
+    entries = ldapsearch_iter(
+        query, using=using, attributes=attributes, parse=False, page_size=page_size)
+
+    db = router.db_for_write(user_model)
+    manager = user_model._default_manager.db_manager(db)
+    created = updated = unchanged = 0
+    high_water_mark = since
+
+    for chunk in chunked(entries, chunk_size):
+        profiles = {}
+        for entry in chunk:
+            entry_attributes = entry['attributes']
+            profile = parse_profile(entry_attributes, profile_fields)
+            if profile['username']:
+                profiles[profile['username']] = profile
+            timestamp = _get_timestamp(entry)
+            if timestamp and (high_water_mark is None or timestamp > high_water_mark):
+                high_water_mark = timestamp
+
+        existing = manager.filter(**{'{0}__in'.format(username_field): list(profiles)})
+        existing = {getattr(user, username_field): user for user in existing}
+
+        to_create = []
+        to_update = []
+        for username, profile in profiles.items():
+            values = {}
+            for field, profile_field in user_fields.items():
+                value = profile[profile_field] or ''
+                if max_lengths[field]:
+                    value = value[:max_lengths[field]]
+                values[field] = value
+            user = existing.get(username)
+            if user is None:
+                user = user_model(**{username_field: username})
+                for field, value in values.items():
+                    setattr(user, field, value)
+                user.set_unusable_password()
+                to_create.append(user)
+            elif any(getattr(user, field) != value for (field, value) in values.items()):
+                for field, value in values.items():
+                    setattr(user, field, value)
+                to_update.append(user)
+            else:
+                unchanged += 1
+
+        if not dry_run:
+            with transaction.atomic(using=db):
+                if to_create:
+                    chunked_bulk_create(user_model, to_create, chunk_size, using=db)
+                if to_update:
+                    chunked_bulk_update(
+                        user_model, to_update, list(user_fields), chunk_size, using=db)
+
+        created += len(to_create)
+        updated += len(to_update)
+
+    stats = SyncStats(created, updated, unchanged, high_water_mark)
+    log.info(
+        'Synced users from LDAP: %d created, %d updated, %d unchanged (high-water mark: %s)',
+        *stats)
+    return stats
+
+
+def _get_timestamp(entry):
+    value = _first(entry['attributes'].get('modifyTimestamp'))
+    try:
+        return format_timestamp(value)
+    except ValueError:
+        log.warning('Ignoring invalid modifyTimestamp for %s: %r', entry.get('dn'), value)
+        return None
+
+
+def _first(value):
+    if isinstance(value, (list, tuple)):
+        return value[0] if value else None
+    return value
@@ -1,4 +1,6 @@
+import sys
 from collections import defaultdict
+from functools import lru_cache
 
 import ldap3
 from ldap3.utils.conv import escape_filter_chars as escape  # noqa
@@ -58,18 +60,65 @@ def parse_dn(dn):
         >>> result['top_level_ou']
         'ACME'
 
+    Parsed DNs are cached (see :func:`parse_dn_cached`); a copy of the
+    cached result is returned, so it can be modified.
+
     """
+    cached = parse_dn_cached(dn)
+    result = defaultdict(list)
+    for key, value in cached.items():
+        result[key] = list(value) if isinstance(value, list) else value
+    return result
+
+
+# Max number of distinct DNs to keep parsed results for
+DN_CACHE_SIZE = 4096
+
+
+def parse_dn_cached(dn):
+    """Parse ``dn`` into parts like :func:`parse_dn`, with caching.
+
+    The same DNs show up over and over in some results (e.g., AD group
+    DNs in ``memberOf``), so the most recently used ``DN_CACHE_SIZE``
+    results are cached.
+
+    .. note:: The returned dict is shared and must *not* be modified.
+
+    """
+    return _parse_dn(sys.intern(dn))
+
+
+def parse_dns(dns):
+    """Parse the distinct DNs in ``dns``.
+
+    Returns a dict mapping each distinct DN to its (shared) parsed
+    result. This is useful for parsing the DNs in a set of results
+    (e.g., all the ``memberOf`` values for a group of users), where each
+    DN will only be parsed once.
+
+        >>> parsed = parse_dns(['CN=A,DC=EXAMPLE', 'CN=B,DC=EXAMPLE', 'CN=A,DC=EXAMPLE'])
+        >>> sorted(p['first_cn'] for p in parsed.values())
+        ['A', 'B']
+
+    """
+    return {dn: parse_dn_cached(dn) for dn in set(dns)}
+
+
+@lru_cache(maxsize=DN_CACHE_SIZE)
+def _parse_dn(dn):
     result = defaultdict(list)
     parts = ldap3_parse_dn(dn)
     for part in parts:
         type_, value, _ = part
-        type_ = type_.lower()
+        type_ = sys.intern(type_.lower())
         items = result[type_]
-        items.append(value)
+        items.append(sys.intern(value))
     if 'cn' in result:
         result['first_cn'] = result['cn'][0]
     if 'o' in result:
         result['organization'] = result['o'][0]
     if 'ou' in result:
         result['top_level_ou'] = result['ou'][0]
+    # Don't let lookups of missing keys modify the shared result.
+    result.default_factory = None
     return result
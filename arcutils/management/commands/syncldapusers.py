@@ -0,0 +1,111 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from arcutils.ldap.sync import format_timestamp, sync_users
+
+
+class Command(BaseCommand):
+
+    help = (
+        'Create and update users from LDAP entries that have been modified since the last sync. '
+        'The latest modifyTimestamp seen is saved to a state file and used as the starting '
+        'point for the next sync.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--state-file', default='.syncldapusers.json',
+            help='File the high-water mark is stored in. Defaults to .syncldapusers.json in the '
+                 'current directory.'
+        )
+        parser.add_argument(
+            '--since', default=None, metavar='TIMESTAMP',
+            help='Sync entries modified at or after this LDAP timestamp (e.g., 20170901000000Z) '
+                 'instead of the one in the state file.'
+        )
+        parser.add_argument(
+            '--full', action='store_true', default=False,
+            help='Sync all entries, ignoring the state file.'
+        )
+        parser.add_argument(
+            '--using', default='default',
+            help='LDAP connection to use. Defaults to "default".'
+        )
+        parser.add_argument(
+            '--query', default='(uid=*)',
+            help='LDAP query used to select entries. Defaults to "(uid=*)".'
+        )
+        parser.add_argument(
+            '--page-size', type=int, default=500,
+            help='Number of entries to fetch per LDAP page. Defaults to 500.'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help='Number of users to create or update at a time. Defaults to 1000.'
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help='Show how many users would be created or updated without changing anything.'
+        )
+
+    def handle(self, *args, **options):
+        for option in ('page_size', 'chunk_size'):
+            if options[option] < 1:
+                raise CommandError('--{0} must be greater than 0'.format(option.replace('_', '-')))
+
+        state_file = options['state_file']
+
+        if options['full']:
+            since = None
+        elif options['since']:
+            since = self.validate_timestamp(options['since'], '--since')
+        else:
+            since = self.read_state(state_file).get('high_water_mark')
+            since = self.validate_timestamp(since, 'State file {0}'.format(state_file))
+
+        stats = sync_users(
+            since=since,
+            using=options['using'],
+            query=options['query'],
+            page_size=options['page_size'],
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run'],
+        )
+
+        if options['dry_run']:
+            message = 'Would create {0.created} users and update {0.updated} users'
+        else:
+            message = 'Created {0.created} users and updated {0.updated} users'
+        self.stdout.write((message + ' ({0.unchanged} unchanged)').format(stats))
+
+        if not options['dry_run'] and stats.high_water_mark:
+            self.write_state(state_file, {'high_water_mark': stats.high_water_mark})
+            self.stdout.write('High-water mark: {0}'.format(stats.high_water_mark))
+
+    def validate_timestamp(self, value, source):
+        # The timestamp is interpolated into an LDAP filter, so it has
+        # to be checked before it's used.
+        try:
+            return format_timestamp(value)
+        except ValueError:
+            raise CommandError(
+                '{0}: not an LDAP timestamp like 20170901000000Z: {1!r}'.format(source, value))
+
+    def read_state(self, path):
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, encoding='utf-8') as fp:
+                return json.load(fp)
+        except ValueError:
+            raise CommandError('Could not read state file: {0}'.format(path))
+
+    def write_state(self, path, state):
+        # Write to a temporary file first so an interrupted write can't
+        # corrupt the state file.
+        temp_path = '{0}.tmp'.format(path)
+        with open(temp_path, 'w', encoding='utf-8') as fp:
+            json.dump(state, fp)
+        os.replace(temp_path, path)
@@ -0,0 +1,519 @@
+import csv
+import datetime
+import json
+import os
+import re
+import tempfile
+import uuid
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.apps import apps
+from django.contrib.auth.models import Group
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.db.models.signals import post_delete, post_init, post_save
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from arcutils.auditor import AuditedQuerySet, bulk_changeset, controls, set_rules, suspended
+from arcutils.auditor.middleware import AuditorInfo
+from arcutils.auditor.utils import Sequencer
+from arcutils.settings import PrefixedSettings
+from arcutils.test.user import UserMixin
+
+
+# The audit log uses PostgreSQL-specific fields, so the tests that need
+# its table are only run against PostgreSQL (with the auditor app
+# installed); see the test command's --database option.
+AUDITOR_AVAILABLE = (
+    apps.is_installed('arcutils.auditor') and connection.vendor == 'postgresql')
+
+
+requires_postgresql = skipUnless(
+    AUDITOR_AVAILABLE, 'The audit log requires PostgreSQL and arcutils.auditor')
+
+
+if AUDITOR_AVAILABLE:
+    from arcutils.auditor import retention, signals
+    from arcutils.auditor.management.commands import exportauditlog
+    from arcutils.auditor.models import AuditLog
+    from arcutils.auditor.settings import DEFAULTS as AUDITOR_DEFAULTS
+
+
+class AuditLogMixin(UserMixin):
+
+    def create_records(self, timestamps, user=None, content_type=None, field_name='first_name'):
+        user = user or self.user
+        content_type = content_type or ContentType.objects.get_for_model(self.user_model)
+        records = [
+            AuditLog(
+                user=user,
+                timestamp=timestamp,
+                changeset_id=uuid.uuid4(),
+                sequence=0,
+                message='Automatically-detected update',
+                content_type=content_type,
+                object_id=str(user.pk),
+                field_name=field_name,
+                old_value='old',
+                new_value='new',
+                created=False,
+                deleted=False,
+            )
+            for timestamp in timestamps
+        ]
+        AuditLog.objects.bulk_create(records)
+        return sorted(records, key=lambda r: (r.timestamp, r.id))
+
+
+class AuditedUserMixin(AuditLogMixin):
+
+    """Audit changes to users' first names and email addresses."""
+
+    audited_fields = ('first_name', 'email')
+
+    def audit_users(self):
+        model = self.user_model
+        fields = self.audited_fields
+        controls.register(model, fields)
+        self.addCleanup(controls._audited_fields.pop, model, None)
+        self.addCleanup(controls._rules.pop, model, None)
+        receivers = (
+            (post_init, signals.save_current_data_factory(model, fields)),
+            (post_save, signals.add_audit_log_record_factory(model, fields)),
+            (post_delete, signals.add_last_audit_log_record_factory(model, fields)),
+        )
+        for signal, receiver in receivers:
+            signal.connect(receiver, sender=model, weak=False)
+            self.addCleanup(signal.disconnect, receiver, sender=model)
+
+    def start_request(self, user):
+        """Make it look like the current thread is handling a request."""
+        info = AuditorInfo(user, timezone.now(), uuid.uuid4(), Sequencer())
+        request = mock.Mock(auditor_info=info)
+        for target in ('controls', 'signals'):
+            patch = mock.patch(
+                'arcutils.auditor.{0}.get_current_request'.format(target), return_value=request)
+            patch.start()
+            self.addCleanup(patch.stop)
+        return request
+
+
+@requires_postgresql
+class TestExportAuditLog(AuditLogMixin, TestCase):
+
+    def setUp(self):
+        self.user = self.create_user()
+        self.start = timezone.now() - datetime.timedelta(days=1)
+        # Pairs of records share timestamps to check that the
+        # (timestamp, id) cursor neither skips nor repeats records.
+        self.records = self.create_records(
+            self.start + datetime.timedelta(seconds=i // 2) for i in range(5))
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def export(self, *args):
+        stderr = StringIO()
+        call_command(
+            'exportauditlog', '--output', self.path, '--chunk-size', '2', *args, stderr=stderr)
+        match = re.search(r'--after (\S+)', stderr.getvalue())
+        return match.group(1) if match else None
+
+    def read_jsonl(self):
+        with open(self.path, encoding='utf-8') as fp:
+            return [json.loads(line) for line in fp]
+
+    def read_csv(self):
+        with open(self.path, encoding='utf-8', newline='') as fp:
+            return list(csv.DictReader(fp))
+
+    def ids(self, records):
+        return [str(record.id) for record in records]
+
+    def test_export_in_chunks(self):
+        self.export()
+        exported = self.read_jsonl()
+        self.assertEqual([r['id'] for r in exported], self.ids(self.records))
+        self.assertEqual(exported[0]['username'], self.user.username)
+        self.assertEqual(exported[0]['content_type'], 'auth.user')
+        self.assertEqual(exported[0]['new_value'], 'new')
+
+    def test_resume_appends(self):
+        cursor = self.export()
+        more = self.create_records(
+            self.start + datetime.timedelta(seconds=10 + i) for i in range(3))
+        self.export('--after', cursor)
+        self.assertEqual([r['id'] for r in self.read_jsonl()], self.ids(self.records + more))
+
+    def test_resume_csv_does_not_repeat_header(self):
+        cursor = self.export('--format', 'csv')
+        more = self.create_records(
+            self.start + datetime.timedelta(seconds=10 + i) for i in range(3))
+        self.export('--format', 'csv', '--after', cursor)
+        rows = self.read_csv()
+        self.assertEqual([row['id'] for row in rows], self.ids(self.records + more))
+        self.assertEqual(json.loads(rows[0]['new_value']), 'new')
+
+    def test_interrupted_export_reports_cursor(self):
+        get_writer = exportauditlog.Command.get_writer
+
+        def get_failing_writer(command, *args, **kwargs):
+            write = get_writer(command, *args, **kwargs)
+            written = []
+
+            def failing_write(record):
+                if len(written) == 3:
+                    raise KeyboardInterrupt
+                write(record)
+                written.append(record)
+
+            return failing_write
+
+        stderr = StringIO()
+        with mock.patch.object(exportauditlog.Command, 'get_writer', get_failing_writer):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command(
+                    'exportauditlog', '--output', self.path, '--chunk-size', '2', stderr=stderr)
+        self.assertIn('interrupted after 3 records', stderr.getvalue())
+        cursor = re.search(r'--after (\S+)', stderr.getvalue()).group(1)
+        self.export('--after', cursor)
+        self.assertEqual([r['id'] for r in self.read_jsonl()], self.ids(self.records))
+
+    def test_resume_from_middle(self):
+        cursor = '{0},{1}'.format(self.records[2].timestamp.isoformat(), self.records[2].id)
+        self.export('--after', cursor)
+        self.assertEqual([r['id'] for r in self.read_jsonl()], self.ids(self.records[3:]))
+
+
+@requires_postgresql
+class TestPruneAuditLog(AuditLogMixin, TestCase):
+
+    def setUp(self):
+        self.user = self.create_user()
+        self.now = timezone.now()
+        self.expired = self.create_records(
+            self.now - datetime.timedelta(days=40 + i) for i in range(5))
+        self.current = self.create_records(
+            self.now - datetime.timedelta(days=i) for i in range(3))
+
+    def configure(self, **auditor_settings):
+        auditor_settings = PrefixedSettings(
+            'AUDITOR', AUDITOR_DEFAULTS, {'AUDITOR': auditor_settings})
+        patch = mock.patch.object(retention, 'settings', auditor_settings)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def remaining(self):
+        return set(AuditLog.objects.values_list('id', flat=True))
+
+    def test_prune_in_batches(self):
+        self.configure(retention_days=30)
+        with CaptureQueriesContext(connection) as queries:
+            num_deleted = retention.prune(batch_size=2, now=self.now)
+        self.assertEqual(num_deleted, 5)
+        deletes = [q for q in queries if q['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(self.remaining(), {r.id for r in self.current})
+
+    def test_dry_run(self):
+        self.configure(retention_days=30)
+        self.assertEqual(retention.prune(dry_run=True, now=self.now), 5)
+        self.assertEqual(len(self.remaining()), 8)
+
+    def test_per_model_retention(self):
+        group_records = self.create_records(
+            [self.now - datetime.timedelta(days=10)],
+            content_type=ContentType.objects.get_for_model(Group), field_name='name')
+        self.configure(retention_days=5, models=[
+            {'name': 'auth.Group', 'fields': ['name'], 'retention_days': None},
+            {'name': 'auth.User', 'fields': ['first_name'], 'retention_days': 30},
+        ])
+        self.assertEqual(retention.prune(now=self.now), 5)
+        self.assertEqual(self.remaining(), {r.id for r in self.current + group_records})
+
+    def test_archive(self):
+        self.configure(retention_days=30)
+        archive = StringIO()
+        self.assertEqual(retention.prune(archive=archive, now=self.now), 5)
+        archived = [json.loads(line) for line in archive.getvalue().splitlines()]
+        self.assertEqual({r['id'] for r in archived}, {str(r.id) for r in self.expired})
+
+    def test_dropped_partitions_are_counted(self):
+        self.configure(retention_days=30, partitioned=True)
+        partition = self.create_partition(2000, 1, num_records=3)
+        num_deleted = retention.prune(now=self.now)
+        self.assertEqual(num_deleted, 3 + 5)
+        self.assertNotIn(partition, connection.introspection.table_names())
+        self.assertEqual(self.remaining(), {r.id for r in self.current})
+
+    def test_partitions_are_kept_when_a_model_is_kept_forever(self):
+        self.configure(retention_days=30, partitioned=True, models=[
+            {'name': 'auth.Group', 'fields': ['name'], 'retention_days': None},
+        ])
+        partition = self.create_partition(2000, 1, num_records=3)
+        self.assertEqual(retention.prune(now=self.now), 5)
+        self.assertIn(partition, connection.introspection.table_names())
+
+    def create_partition(self, year, month, num_records):
+        """Simulate a monthly partition with a plain table.
+
+        The partition's records are moved out of the audit log table
+        (as they would be in a partitioned table), and the partition is
+        reported by :func:`retention.get_partitions`.
+
+        """
+        start, end = retention.get_month_bounds(year, month)
+        self.create_records(start + datetime.timedelta(days=i) for i in range(num_records))
+        name = retention.get_partition_name(year, month)
+        table = AuditLog._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE {name} AS SELECT * FROM {table} WHERE timestamp < %s'.format(
+                    name=name, table=table),
+                [end])
+            cursor.execute('DELETE FROM {table} WHERE timestamp < %s'.format(table=table), [end])
+        patch = mock.patch.object(
+            retention, 'get_partitions', lambda using=None: [(name, start, end)])
+        patch.start()
+        self.addCleanup(patch.stop)
+        return name
+
+    def test_get_month_bounds(self):
+        start, end = retention.get_month_bounds(2017, 12)
+        self.assertEqual(start, datetime.datetime(2017, 12, 1, tzinfo=timezone.utc))
+        self.assertEqual(end, datetime.datetime(2018, 1, 1, tzinfo=timezone.utc))
+
+
+class TestAuditingRules(UserMixin, TestCase):
+
+    def setUp(self):
+        controls.register(self.user_model, ('first_name', 'email'))
+        self.addCleanup(controls._audited_fields.pop, self.user_model, None)
+        self.addCleanup(controls._rules.pop, self.user_model, None)
+
+    def test_set_rules(self):
+        self.assertEqual(controls.get_rules(self.user_model), controls.DEFAULT_RULES)
+        rules = set_rules('auth.User', sample_rate=0.5)
+        self.assertEqual(rules.sample_rate, 0.5)
+        rules = set_rules(self.user_model, exclude_fields=['email'])
+        # Rules that aren't passed are kept.
+        self.assertEqual(rules, controls.Rules(0.5, frozenset(['email'])))
+        self.assertEqual(controls.get_rules(self.user_model), rules)
+        self.assertEqual(controls.get_audited_fields(self.user_model), ('first_name',))
+
+    def test_invalid_sample_rate(self):
+        self.assertRaises(ValueError, set_rules, self.user_model, sample_rate=1.5)
+
+    def test_unaudited_model(self):
+        self.assertIsNone(controls.get_audited_fields(Group))
+
+    def test_should_sample(self):
+        self.assertTrue(controls.should_sample(self.user_model))
+        set_rules(self.user_model, sample_rate=0)
+        self.assertFalse(controls.should_sample(self.user_model))
+        set_rules(self.user_model, sample_rate=0.25)
+        with mock.patch('random.random', return_value=0.2):
+            self.assertTrue(controls.should_sample(self.user_model))
+        with mock.patch('random.random', return_value=0.3):
+            self.assertFalse(controls.should_sample(self.user_model))
+
+    def test_sampling_is_per_object(self):
+        set_rules(self.user_model, sample_rate=0.25)
+        sampled = [pk for pk in range(1, 2001) if controls.should_sample(self.user_model, pk)]
+        self.assertTrue(400 < len(sampled) < 600)
+        with mock.patch('random.random', side_effect=AssertionError):
+            self.assertEqual(
+                [pk for pk in range(1, 2001) if controls.should_sample(self.user_model, pk)],
+                sampled)
+
+
+class TestSuspended(TestCase):
+
+    def test_suspended(self):
+        self.assertFalse(controls.is_suspended())
+        with suspended():
+            self.assertTrue(controls.is_suspended())
+            with suspended():
+                self.assertTrue(controls.is_suspended())
+            self.assertTrue(controls.is_suspended())
+        self.assertFalse(controls.is_suspended())
+
+    def test_bulk_changeset_counts(self):
+        with mock.patch.object(controls.BulkChangeset, 'save') as save:
+            with bulk_changeset() as changeset:
+                self.assertIs(controls.get_bulk_changeset(), changeset)
+                changeset.add(Group, 'created')
+                changeset.add(Group, 'updated', 3)
+                changeset.add(Group, 'created')
+            self.assertIsNone(controls.get_bulk_changeset())
+        self.assertEqual(changeset.counts[Group], {'created': 2, 'updated': 3})
+        # There's no request or user, so no summary is logged.
+        self.assertFalse(save.called)
+
+
+@requires_postgresql
+class TestAuditorControls(AuditedUserMixin, TestCase):
+
+    def setUp(self):
+        self.audit_users()
+        self.user = self.create_user(first_name='Old', email='old@example.com')
+        self.start_request(self.user)
+
+    def records(self):
+        return list(AuditLog.objects.order_by('sequence'))
+
+    def test_changes_are_logged(self):
+        user = self.user_model.objects.get()
+        user.first_name = 'New'
+        user.save()
+        record, = self.records()
+        self.assertEqual(record.field_name, 'first_name')
+        self.assertEqual((record.old_value, record.new_value), ('Old', 'New'))
+
+    def test_suspended(self):
+        with suspended():
+            user = self.user_model.objects.get()
+            user.first_name = 'New'
+            user.save()
+            user.delete()
+        self.assertEqual(self.records(), [])
+
+    def test_instance_loaded_while_suspended(self):
+        with suspended():
+            user = self.user_model.objects.get()
+        # No snapshot is taken while suspended
+        self.assertIsNone(user._auditor_data)
+        user.first_name = 'New'
+        user.save()
+        records = self.records()
+        self.assertEqual(
+            {(r.field_name, r.old_value, r.new_value) for r in records},
+            {('first_name', None, 'New'), ('email', None, 'old@example.com')})
+        for record in records:
+            self.assertEqual(
+                record.message, 'Automatically-detected update (previous value unknown)')
+
+    def test_sampled_out_instance_loaded_while_suspended(self):
+        set_rules(self.user_model, sample_rate=0)
+        with suspended():
+            user = self.user_model.objects.get()
+        user.first_name = 'New'
+        user.save()
+        user.delete()
+        self.assertEqual(self.records(), [])
+
+    def test_bulk_changeset(self):
+        set_rules(self.user_model, sample_rate=0)
+        # Sampled out before the bulk changeset was started
+        user = self.user_model.objects.get()
+        set_rules(self.user_model, sample_rate=1)
+        with bulk_changeset(message='Import'):
+            user.first_name = 'New'
+            user.save()
+            self.create_user('other')
+            self.user_model.objects.get(username='other').delete()
+        record, = self.records()
+        self.assertEqual(record.message, 'Import')
+        self.assertEqual(record.new_value, {'created': 1, 'updated': 1, 'deleted': 1})
+        self.assertEqual(record.content_type.model_class(), self.user_model)
+
+    def test_instance_loaded_in_bulk_changeset(self):
+        with bulk_changeset():
+            user = self.user_model.objects.get()
+        self.assertIsNone(user._auditor_data)
+        user.first_name = 'New'
+        user.save()
+        # Nothing was changed in the bulk changeset, so there's no
+        # summary.
+        records = self.records()
+        self.assertEqual(
+            {(r.field_name, r.old_value, r.new_value) for r in records},
+            {('first_name', None, 'New'), ('email', None, 'old@example.com')})
+
+    def test_sampled_out_instances_are_not_logged(self):
+        set_rules(self.user_model, sample_rate=0)
+        user = self.user_model.objects.get()
+        user.first_name = 'New'
+        user.save()
+        self.assertEqual(self.records(), [])
+
+    def test_excluded_fields_are_not_logged(self):
+        set_rules(self.user_model, exclude_fields=['first_name'])
+        user = self.user_model.objects.get()
+        user.first_name = 'New'
+        user.email = 'new@example.com'
+        user.save()
+        record, = self.records()
+        self.assertEqual(record.field_name, 'email')
+
+
+@requires_postgresql
+class TestAuditedQuerySet(AuditedUserMixin, TestCase):
+
+    def setUp(self):
+        self.audit_users()
+        self.user = self.create_user('user', first_name='Old', email='user@example.com')
+        self.other = self.create_user('other', first_name='Old', email='other@example.com')
+        self.start_request(self.user)
+
+    def queryset(self):
+        return AuditedQuerySet(self.user_model).order_by('pk')
+
+    def records(self, **filters):
+        return list(AuditLog.objects.filter(**filters).order_by('sequence'))
+
+    def test_update(self):
+        self.assertEqual(self.queryset().update(first_name='New', last_name='Ignored'), 2)
+        records = self.records()
+        self.assertEqual([r.object_id for r in records], [str(self.user.pk), str(self.other.pk)])
+        for record in records:
+            self.assertEqual(record.field_name, 'first_name')
+            self.assertEqual((record.old_value, record.new_value), ('Old', 'New'))
+
+    def test_update_with_expression(self):
+        self.queryset().filter(pk=self.user.pk).update(email=F('username'))
+        record, = self.records()
+        self.assertEqual((record.old_value, record.new_value), ('user@example.com', 'user'))
+
+    def test_update_locks_rows(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.queryset().update(first_name='New')
+        select = next(q['sql'] for q in queries if q['sql'].startswith('SELECT'))
+        self.assertIn('FOR UPDATE', select)
+
+    def test_update_is_sampled_per_object(self):
+        set_rules(self.user_model, sample_rate=0.5)
+        users = [self.create_user('user{0}'.format(i)) for i in range(20)]
+        self.queryset().filter(username__startswith='user').update(first_name='New')
+        expected = [
+            str(u.pk) for u in [self.user] + users
+            if controls.should_sample(self.user_model, u.pk)
+        ]
+        self.assertEqual([r.object_id for r in self.records(created=False)], expected)
+
+    def test_update_in_bulk_changeset(self):
+        with bulk_changeset():
+            self.queryset().update(first_name='New')
+        record, = self.records()
+        self.assertEqual(record.new_value, {'created': 0, 'updated': 2, 'deleted': 0})
+
+    def test_bulk_create(self):
+        self.queryset().bulk_create([
+            self.user_model(username='new', first_name='New', email='new@example.com'),
+        ])
+        records = self.records(created=True)
+        self.assertEqual(
+            {(r.field_name, r.new_value) for r in records},
+            {('first_name', 'New'), ('email', 'new@example.com')})
+
+    def test_delete(self):
+        self.queryset().filter(pk=self.other.pk).delete()
+        records = self.records(deleted=True)
+        self.assertEqual(
+            {(r.field_name, r.old_value) for r in records},
+            {('first_name', 'Old'), ('email', 'other@example.com')})
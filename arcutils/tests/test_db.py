@@ -1,10 +1,51 @@
+import time
+from collections import OrderedDict
+from doctest import DocTestSuite
+from unittest import mock, skipIf
+
+from django.contrib.auth.models import Group
+from django.core.exceptions import ValidationError
 from django.db import connection
-from django.test import TestCase
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from arcutils.db import dictfetchall, will_be_deleted_with, ChoiceEnum
+from arcutils.db import (
+    columnfetch,
+    delete_in_chunks,
+    dictfetchall,
+    dictfetchiter,
+    fetchiter,
+    namedtuplefetchiter,
+    will_be_deleted_with,
+    ChoiceEnum,
+)
+from arcutils.db import bulk, middleware, routers
+from arcutils.db.bulk import (
+    chunked_bulk_create,
+    chunked_bulk_update,
+    chunked_executemany,
+    insert_rows,
+)
+from arcutils.db.middleware import QueryCountMiddleware, SlowQueryLogger, TooManyQueriesError
+from arcutils.db.models import ChoiceEnumField
+from arcutils.db.routers import ReplicaMiddleware, ReplicaRouter, use_primary
+from arcutils.db.wrappers import execute_wrapper
 from arcutils.test.user import UserMixin
 
 
+def load_tests(loader, tests, ignore):
+    tests.addTests(DocTestSuite(bulk))
+    tests.addTests(DocTestSuite(middleware))
+    tests.addTests(DocTestSuite(routers))
+    return tests
+
+
 class TestDictFetchAll(UserMixin, TestCase):
 
     def test(self):
@@ -20,6 +61,86 @@ class TestDictFetchAll(UserMixin, TestCase):
         self.assertEqual(results[1]['username'], user2.username)
 
 
+class TestFetchIter(UserMixin, TestCase):
+
+    def setUp(self):
+        self.usernames = ['user{0}'.format(i) for i in range(5)]
+        for username in self.usernames:
+            self.create_user(username=username)
+        self.cursor = connection.cursor()
+        self.cursor.execute('SELECT id, username FROM auth_user ORDER BY username')
+
+    def test_fetchiter(self):
+        results = list(fetchiter(self.cursor, size=2))
+        self.assertEqual([r[1] for r in results], self.usernames)
+
+    def test_dictfetchiter(self):
+        results = list(dictfetchiter(self.cursor, size=2))
+        self.assertEqual([r['username'] for r in results], self.usernames)
+
+    def test_namedtuplefetchiter(self):
+        results = list(namedtuplefetchiter(self.cursor, size=2))
+        self.assertEqual([r.username for r in results], self.usernames)
+
+    def test_fetchiter_is_lazy(self):
+        results = fetchiter(self.cursor, size=2)
+        self.assertEqual(next(results)[1], self.usernames[0])
+        self.assertEqual(len(self.cursor.fetchall()), 3)
+
+    def test_fetchiter_closes_cursor(self):
+        results = fetchiter(self.cursor, size=2, close=True)
+        next(results)
+        results.close()
+        self.assertRaises(Exception, self.cursor.fetchall)
+
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class TestColumnFetch(UserMixin, TestCase):
+
+    def setUp(self):
+        for i in range(5):
+            self.create_user(username='user{0}'.format(i), is_staff=bool(i % 2))
+        self.cursor = connection.cursor()
+        self.cursor.execute('SELECT id, username, is_staff FROM auth_user ORDER BY username')
+
+    def test_columnfetch(self):
+        results = columnfetch(self.cursor, size=2)
+        self.assertEqual(list(results), ['id', 'username', 'is_staff'])
+        self.assertEqual(results['id'].dtype.kind, 'i')
+        self.assertEqual(results['username'].dtype, numpy.dtype(object))
+        self.assertEqual(results['username'].tolist(), ['user{0}'.format(i) for i in range(5)])
+        self.assertEqual(results['is_staff'].sum(), 2)
+
+    def test_columnfetch_with_dtypes(self):
+        results = columnfetch(self.cursor, dtypes={'id': 'f8', 'is_staff': '?'})
+        self.assertEqual(results['id'].dtype, numpy.dtype('f8'))
+        self.assertEqual(results['is_staff'].dtype, numpy.dtype('?'))
+
+    def test_columnfetch_structured(self):
+        results = columnfetch(self.cursor, size=2, structured=True)
+        self.assertEqual(results.shape, (5,))
+        self.assertEqual(results.dtype.names, ('id', 'username', 'is_staff'))
+        self.assertEqual(results[0]['username'], 'user0')
+
+    def test_columnfetch_widens_dtypes(self):
+        # In the last chunk, there's a NULL in one int column and
+        # a float in another.
+        sql = (
+            "SELECT "
+            "CASE WHEN username = 'user4' THEN NULL ELSE id END AS maybe_id, "
+            "CASE WHEN username = 'user4' THEN id + 0.5 ELSE id END AS value "
+            "FROM auth_user ORDER BY username"
+        )
+        ids = list(self.user_model.objects.order_by('username').values_list('id', flat=True))
+        for structured in (False, True):
+            self.cursor.execute(sql)
+            results = columnfetch(self.cursor, size=2, structured=structured)
+            self.assertEqual(results['maybe_id'].dtype, numpy.dtype(object))
+            self.assertEqual(results['maybe_id'].tolist(), ids[:4] + [None])
+            self.assertEqual(results['value'].dtype.kind, 'f')
+            self.assertEqual(results['value'].tolist(), ids[:4] + [ids[4] + 0.5])
+
+
 class TestWillBeDeletedWith(UserMixin, TestCase):
 
     def test_will_be_deleted_with(self):
@@ -41,6 +162,309 @@ class TestWillBeDeletedWith(UserMixin, TestCase):
         for r in records:
             self.assertEqual(r.user, user)
 
+    def test_will_be_deleted_with_summary(self):
+        user = self.create_user(username='user', groups=('group-a', 'group-b'))
+        self.create_user(username='xxx', groups=('group-a',))
+
+        results = list(will_be_deleted_with(user, using='default', summary=True))
+        self.assertEqual(len(results), 1)
+        record_type, count = results[0]
+        self.assertEqual(record_type._meta.db_table, 'auth_user_groups')
+        self.assertEqual(count, 2)
+
+
+class TestBulk(TestCase):
+
+    def groups(self, count):
+        for i in range(count):
+            yield Group(name='group{0}'.format(i))
+
+    def get_names(self):
+        return list(Group.objects.order_by('id').values_list('name', flat=True))
+
+    def test_chunked_bulk_create(self):
+        with self.assertLogs(bulk.log, 'INFO') as logs:
+            stats = chunked_bulk_create(Group, self.groups(5), chunk_size=2)
+        self.assertTrue(logs.records[-1].getMessage().startswith('Created auth.Group: 5 rows'))
+        self.assertEqual((stats.rows, stats.chunks), (5, 3))
+        self.assertGreater(stats.rows_per_second, 0)
+        self.assertEqual(self.get_names(), ['group{0}'.format(i) for i in range(5)])
+
+    def test_chunked_bulk_update(self):
+        chunked_bulk_create(Group, self.groups(5))
+        groups = Group.objects.order_by('id').iterator()
+        updated = (Group(id=g.id, name=g.name.upper()) for g in groups)
+        stats = chunked_bulk_update(Group, updated, ['name'], chunk_size=2)
+        self.assertEqual((stats.rows, stats.chunks), (5, 3))
+        self.assertEqual(self.get_names(), ['GROUP{0}'.format(i) for i in range(5)])
+
+    def test_chunked_bulk_update_respects_parameter_limit(self):
+        chunked_bulk_create(Group, self.groups(1200))
+        groups = list(Group.objects.order_by('id'))
+        for group in groups:
+            group.name = group.name.upper()
+        # One parameter for the pk and two for the name per group
+        batch_size = connection.ops.bulk_batch_size(['pk', 'name', 'name'], groups)
+        with CaptureQueriesContext(connection) as queries:
+            stats = chunked_bulk_update(Group, groups, ['name'])
+        self.assertEqual((stats.rows, stats.chunks), (1200, 2))
+        updates = [q for q in queries if q['sql'].startswith('UPDATE')]
+        expected = sum(-(-n // batch_size) for n in (1000, 200))
+        self.assertEqual(len(updates), expected)
+        if connection.vendor == 'sqlite':
+            # Under SQLite's historical limit of 999 variables per query
+            self.assertEqual(len(updates), 5)
+        self.assertEqual(self.get_names(), ['GROUP{0}'.format(i) for i in range(1200)])
+
+    def test_chunked_executemany(self):
+        rows = (('group{0}'.format(i),) for i in range(5))
+        with connection.cursor() as cursor:
+            sql = 'INSERT INTO auth_group (name) VALUES (%s)'
+            stats = chunked_executemany(cursor, sql, rows, chunk_size=2)
+        self.assertEqual((stats.rows, stats.chunks), (5, 3))
+        self.assertEqual(len(self.get_names()), 5)
+
+    def test_insert_rows(self):
+        rows = ((i, 'group{0}'.format(i)) for i in range(1, 6))
+        stats = insert_rows('auth_group', ['id', 'name'], rows, chunk_size=4)
+        self.assertEqual((stats.rows, stats.chunks), (5, 2))
+        self.assertEqual(self.get_names(), ['group{0}'.format(i) for i in range(1, 6)])
+
+
+class TestDeleteInChunks(UserMixin, TestCase):
+
+    def test_delete_instance(self):
+        user = self.create_user(username='user', groups=('group-a', 'group-b'))
+        other = self.create_user(username='xxx', groups=('group-a',))
+        counts = delete_in_chunks(user, chunk_size=1)
+        self.assertEqual([c._meta.db_table for c in counts], ['auth_user_groups', 'auth_user'])
+        self.assertEqual(list(counts.values()), [2, 1])
+        self.assertFalse(self.user_model.objects.filter(pk=user.pk).exists())
+        self.assertEqual(list(other.groups.all()), [Group.objects.get(name='group-a')])
+        self.assertEqual(Group.objects.count(), 2)
+
+    def test_delete_queryset(self):
+        for i in range(5):
+            self.create_user(username='user{0}'.format(i), groups=('group-a',))
+        queryset = self.user_model.objects.filter(username__lt='user3')
+        counts = delete_in_chunks(queryset, chunk_size=2)
+        self.assertEqual(list(counts.values()), [3, 3])
+        self.assertEqual(self.user_model.objects.count(), 2)
+        self.assertEqual(Group.objects.get(name='group-a').user_set.count(), 2)
+
+    def test_delete_queryset_filtered_through_cascaded_relation(self):
+        for i in range(3):
+            self.create_user(username='user{0}'.format(i), groups=('group-a', 'group-b'))
+        other = self.create_user(username='other', groups=('group-b',))
+        # Deleting the users' group memberships first must not change
+        # which users are deleted.
+        queryset = self.user_model.objects.filter(groups__name='group-a')
+        counts = delete_in_chunks(queryset, chunk_size=2)
+        self.assertEqual([c._meta.db_table for c in counts], ['auth_user_groups', 'auth_user'])
+        self.assertEqual(list(counts.values()), [6, 3])
+        self.assertEqual(list(self.user_model.objects.all()), [other])
+        self.assertEqual(list(other.groups.values_list('name', flat=True)), ['group-b'])
+
+
+class TestReplicaRouter(UserMixin, TestCase):
+
+    # The replicas are separate databases, so anything written to the
+    # primary (default) database won't be seen when reading from them.
+    multi_db = True
+
+    def setUp(self):
+        self.router = ReplicaRouter('default', ['replica1', 'replica2'])
+        routing = override_settings(DATABASE_ROUTERS=[self.router])
+        routing.enable()
+        self.addCleanup(routing.disable)
+
+    def get_response(self, view, cookies=None):
+        request = RequestFactory().get('/')
+        request.COOKIES.update(cookies or {})
+        return ReplicaMiddleware(view)(request)
+
+    def user_exists(self, username):
+        return self.user_model.objects.filter(username=username).exists()
+
+    def test_reads_go_to_replicas(self):
+        dbs = [self.router.db_for_read(self.user_model) for _ in range(4)]
+        self.assertEqual(dbs, ['replica1', 'replica2', 'replica1', 'replica2'])
+        self.assertEqual(self.user_model.objects.all().db, 'replica1')
+
+    def test_replicas_with_zero_weight_are_not_used(self):
+        router = ReplicaRouter('default', {'replica1': 0, 'replica2': 1})
+        dbs = {router.db_for_read(self.user_model) for _ in range(4)}
+        self.assertEqual(dbs, {'replica2'})
+
+    def test_invalid_replica_weights_are_rejected(self):
+        self.assertRaises(ValueError, ReplicaRouter, 'default', {'replica1': 0, 'replica2': 0})
+        self.assertRaises(ValueError, ReplicaRouter, 'default', {'replica1': -1, 'replica2': 2})
+
+    def test_writes_go_to_primary(self):
+        self.create_user(username='user')
+        self.assertFalse(self.user_exists('user'))
+        with use_primary():
+            self.assertTrue(self.user_exists('user'))
+
+    def test_request_is_pinned_after_write(self):
+        results = []
+
+        def view(request):
+            results.append(self.user_exists('user'))
+            self.create_user(username='user')
+            results.append(self.user_exists('user'))
+            return HttpResponse()
+
+        response = self.get_response(view)
+        self.assertEqual(results, [False, True])
+        self.assertIn(routers.settings.get('cookie_name'), response.cookies)
+        self.assertFalse(self.user_exists('user'))
+
+    def test_request_is_pinned_by_cookie(self):
+        self.create_user(username='user')
+        results = []
+
+        def view(request):
+            results.append(self.user_exists('user'))
+            return HttpResponse()
+
+        cookie_name = routers.settings.get('cookie_name')
+        response = self.get_response(view, {cookie_name: str(time.time() + 10)})
+        self.get_response(view, {cookie_name: str(time.time() - 10)})
+        self.get_response(view)
+        self.assertEqual(results, [True, False, False])
+        self.assertNotIn(cookie_name, response.cookies)
+
+
+class TestQueryCountMiddleware(UserMixin, TestCase):
+
+    def setUp(self):
+        for i in range(5):
+            self.create_user(username='user{0}'.format(i))
+
+    def get_response(self, view, **options):
+        middleware = QueryCountMiddleware(view)
+        for name, value in options.items():
+            setattr(middleware, name, value)
+        return middleware(RequestFactory().get('/'))
+
+    def view(self, request):
+        # N+1 queries
+        for user in self.user_model.objects.all():
+            self.user_model.objects.get(pk=user.pk)
+        return HttpResponse()
+
+    def test_within_limits(self):
+        with self.assertLogs(middleware.log, 'WARNING') as logs:
+            self.get_response(self.view, max_queries=6, max_repeats=5)
+            middleware.log.warning('(no warnings)')
+        self.assertEqual(logs.output, ['WARNING:arcutils.db.middleware:(no warnings)'])
+
+    def test_too_many_queries_are_logged(self):
+        with self.assertLogs(middleware.log, 'WARNING') as logs:
+            self.get_response(self.view, max_queries=5, max_repeats=None)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('6 queries were run (max: 5)', logs.output[0])
+
+    def test_repeated_queries_raise(self):
+        with self.assertRaises(TooManyQueriesError) as context:
+            self.get_response(self.view, max_repeats=4, action='raise')
+        self.assertIn('Query was run 5 times (max: 4)', str(context.exception))
+
+    def test_unsampled_requests_are_not_checked(self):
+        self.get_response(self.view, max_queries=0, action='raise', sample_rate=0)
+
+
+class TestExecuteWrapper(UserMixin, TestCase):
+
+    def test_execute_wrapper(self):
+        calls = []
+
+        def wrapper(name):
+            def wrapper(execute, sql, params, many, context):
+                calls.append((name, sql.split()[0], many))
+                return execute(sql, params, many, context)
+            return wrapper
+
+        with execute_wrapper(wrapper('outer')), execute_wrapper(wrapper('inner')):
+            self.assertFalse(self.user_model.objects.exists())
+            with connection.cursor() as cursor:
+                sql = 'UPDATE auth_user SET username = username WHERE id = %s'
+                cursor.executemany(sql, [(1,), (2,)])
+        self.user_model.objects.exists()
+
+        self.assertEqual(calls, [
+            ('outer', 'SELECT', False),
+            ('inner', 'SELECT', False),
+            ('outer', 'UPDATE', True),
+            ('inner', 'UPDATE', True),
+        ])
+
+
+class TestSlowQueryLogger(UserMixin, TestCase):
+
+    def test_slow_queries_are_logged_with_plan(self):
+        slow_query_logger = SlowQueryLogger(threshold=0, view='test view')
+        queryset = self.user_model.objects.filter(username='user')
+        with self.assertLogs(middleware.log, 'WARNING') as logs:
+            with execute_wrapper(slow_query_logger):
+                list(queryset.all())
+                list(queryset.all())
+        self.assertEqual(len(logs.records), 2)
+        first, second = logs.records
+        self.assertEqual(first.view, 'test view')
+        self.assertIn('auth_user', first.sql)
+        self.assertIn('auth_user', first.plan)
+        self.assertIn('test_db.py', first.getMessage())
+        self.assertNotIn('wrappers.py', first.getMessage())
+        # Plans are rate limited per statement.
+        self.assertIsNone(second.plan)
+
+    def test_only_dml_statements_are_explained(self):
+        slow_query_logger = SlowQueryLogger(threshold=0)
+        with self.assertLogs(middleware.log, 'WARNING') as logs:
+            with execute_wrapper(slow_query_logger):
+                with connection.cursor() as cursor:
+                    cursor.execute('CREATE TABLE slow_query_logger_test (id integer)')
+                    cursor.execute('DROP TABLE slow_query_logger_test')
+        self.assertEqual(len(logs.records), 2)
+        for record in logs.records:
+            self.assertIsNone(record.plan)
+
+    def test_plans_are_captured_in_a_savepoint(self):
+        statements = []
+
+        def recorder(execute, sql, params, many, context):
+            statements.append(sql.split()[0].upper())
+            return execute(sql, params, many, context)
+
+        slow_query_logger = SlowQueryLogger(threshold=0)
+        prefixes = {connection.vendor: 'EXPLAIN BOGUS '}
+        with mock.patch.dict(middleware.EXPLAIN_PREFIXES, prefixes):
+            with self.assertLogs(middleware.log, 'WARNING') as logs:
+                with execute_wrapper(recorder), execute_wrapper(slow_query_logger):
+                    self.user_model.objects.filter(username='savepoint').exists()
+        self.assertIsNone(logs.records[-1].plan)
+        self.assertEqual(statements, ['SELECT', 'SAVEPOINT', 'EXPLAIN', 'ROLLBACK', 'RELEASE'])
+        self.assertFalse(self.user_model.objects.filter(username='savepoint').exists())
+
+    def test_explained_at_is_bounded(self):
+        with mock.patch.object(middleware, 'EXPLAINED_AT_MAX_SIZE', 2), \
+                mock.patch.object(middleware, '_explained_at', OrderedDict()) as explained_at:
+            for table in ('a', 'b', 'c'):
+                self.assertTrue(middleware.should_explain('SELECT * FROM %s' % table, 300))
+            self.assertEqual(len(explained_at), 2)
+            self.assertTrue(middleware.should_explain('SELECT * FROM a', 300))
+            self.assertFalse(middleware.should_explain('SELECT * FROM c', 300))
+
+    def test_fast_queries_are_not_logged(self):
+        slow_query_logger = SlowQueryLogger(threshold=60)
+        with self.assertLogs(middleware.log, 'WARNING') as logs:
+            with execute_wrapper(slow_query_logger):
+                self.user_model.objects.exists()
+            middleware.log.warning('(no warnings)')
+        self.assertEqual(len(logs.records), 1)
+
 
 class TestChoiceEnum(TestCase):
 
@@ -59,3 +483,65 @@ class TestChoiceEnum(TestCase):
 
     def test_choices_with_text_values(self):
         self.assertEqual(self.Status.as_choices(), [('new', 'New'), ('open', 'Open')])
+
+    def test_choices_are_precomputed(self):
+        self.assertEqual(
+            self.Foo.as_choices(as_dict=True),
+            [{'value': 1, 'label': 'Alpha'}, {'value': 2, 'label': 'Beta'}])
+
+    def test_modifying_choices_does_not_affect_enum(self):
+        choices = self.Foo.as_choices()
+        choices.append((3, 'Gamma'))
+        choice_dicts = self.Foo.as_choices(as_dict=True)
+        choice_dicts[0]['label'] = 'Gamma'
+        choice_dicts.pop()
+        self.assertEqual(self.Foo.as_choices(), [(1, 'Alpha'), (2, 'Beta')])
+        self.assertEqual(
+            self.Foo.as_choices(as_dict=True),
+            [{'value': 1, 'label': 'Alpha'}, {'value': 2, 'label': 'Beta'}])
+
+    def test_from_value(self):
+        self.assertIs(self.Foo.from_value(2), self.Foo.beta)
+        self.assertIs(self.Foo.from_value(self.Foo.beta), self.Foo.beta)
+        self.assertRaises(ValueError, self.Foo.from_value, 3)
+        self.assertRaises(ValueError, self.Foo.from_value, [])
+
+    def test_get_label(self):
+        self.assertEqual(self.Status.get_label('open'), 'Open')
+        self.assertEqual(self.Status.get_label(self.Status.open), 'Open')
+        self.assertEqual(self.Status.open.label, 'Open')
+        self.assertRaises(ValueError, self.Status.get_label, 'closed')
+
+
+class TestChoiceEnumField(TestCase):
+
+    Foo = TestChoiceEnum.Foo
+    Status = TestChoiceEnum.Status
+
+    def test_integer_values(self):
+        field = ChoiceEnumField(self.Foo)
+        self.assertEqual(field.get_internal_type(), 'IntegerField')
+        self.assertEqual(field.choices, [(1, 'Alpha'), (2, 'Beta')])
+        self.assertIs(field.from_db_value(1, None, connection, {}), self.Foo.alpha)
+        self.assertIs(field.to_python('2'), self.Foo.beta)
+        self.assertEqual(field.get_prep_value(self.Foo.beta), 2)
+        self.assertEqual(field.get_prep_value(2), 2)
+        self.assertEqual(field.clean(self.Foo.beta, None), self.Foo.beta)
+        self.assertRaises(ValidationError, field.clean, 3, None)
+
+    def test_text_values(self):
+        field = ChoiceEnumField(self.Status, null=True)
+        self.assertEqual(field.get_internal_type(), 'CharField')
+        self.assertEqual(field.max_length, 4)
+        self.assertIsNone(field.from_db_value(None, None, connection, {}))
+        self.assertIs(field.from_db_value('new', None, connection, {}), self.Status.new)
+        self.assertEqual(field.get_prep_value(self.Status.open), 'open')
+
+    def test_deconstruct(self):
+        name, path, args, kwargs = ChoiceEnumField(self.Foo).deconstruct()
+        self.assertEqual(path, 'arcutils.db.models.fields.ChoiceEnumField')
+        self.assertEqual(kwargs, {'enum_type': self.Foo})
+
+    def test_formfield(self):
+        form_field = ChoiceEnumField(self.Foo).formfield()
+        self.assertIs(form_field.clean('1'), self.Foo.alpha)
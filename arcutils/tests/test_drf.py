@@ -1,6 +1,10 @@
 from unittest import TestCase
 
+from rest_framework.exceptions import ValidationError
+
+from arcutils.db import ChoiceEnum
 from arcutils.drf import TemplateHTMLContextDictRenderer
+from arcutils.drf.serializers import ChoiceEnumField
 
 
 class Base:
@@ -64,3 +68,37 @@ class TestDRF(TestCase):
         view = View(context_object_name='horse', context_object_list_name='horses')
         self.check_context({}, 'horse', view=view)
         self.check_context([], 'horses', view=view)
+
+
+class TestChoiceEnumField(TestCase):
+
+    class Foo(ChoiceEnum):
+
+        alpha_one = 1
+        beta = 2
+
+    def test_to_representation(self):
+        field = ChoiceEnumField(self.Foo)
+        self.assertEqual(field.to_representation(self.Foo.alpha_one), 1)
+        self.assertEqual(field.to_representation(1), 1)
+
+    def test_to_representation_as_label(self):
+        field = ChoiceEnumField(self.Foo, representation='label')
+        self.assertEqual(field.to_representation(self.Foo.alpha_one), 'Alpha one')
+        self.assertEqual(field.to_representation(2), 'Beta')
+
+    def test_to_representation_as_dict(self):
+        field = ChoiceEnumField(self.Foo, representation='dict')
+        self.assertEqual(field.to_representation(self.Foo.beta), {'value': 2, 'label': 'Beta'})
+
+    def test_modifying_dict_representation_does_not_affect_field(self):
+        field = ChoiceEnumField(self.Foo, representation='dict')
+        field.to_representation(self.Foo.beta)['label'] = 'Gamma'
+        self.assertEqual(field.to_representation(self.Foo.beta), {'value': 2, 'label': 'Beta'})
+        self.assertEqual(self.Foo.as_choices(as_dict=True)[1], {'value': 2, 'label': 'Beta'})
+
+    def test_to_internal_value(self):
+        field = ChoiceEnumField(self.Foo)
+        self.assertIs(field.to_internal_value(2), self.Foo.beta)
+        self.assertIs(field.to_internal_value('2'), self.Foo.beta)
+        self.assertRaises(ValidationError, field.to_internal_value, 3)
@@ -1,24 +1,93 @@
+import datetime
 from doctest import DocTestSuite
-from unittest import TestCase
+from functools import partial
+import json
+import os
+import sys
+import tempfile
+import threading
+from io import StringIO
+from unittest import TestCase, mock, skipUnless
 
 import ldap3
+from ldap3.core.exceptions import (
+    LDAPInvalidFilterError,
+    LDAPSocketOpenError,
+    LDAPSocketReceiveError,
+)
+
+from django.contrib.auth import get_user_model
+from django.core.management import CommandError, call_command
+from django.db import connection as db_connection
+from django.test import TestCase as DjangoTestCase
+from django.test.utils import CaptureQueriesContext
 
-from arcutils.ldap import connect
+from arcutils.ldap import connect, ldapsearch, ldapsearch_iter, ldapsearch_many
 from arcutils.ldap.profile import (
+    PROFILE_FIELDS,
+    LDAPProfile,
+    get_profile_attributes,
     parse_email,
+    parse_member_of,
     parse_name,
     parse_phone_number,
     parse_psu_extension,
     parse_profile,
 )
-from arcutils.ldap import utils
+from arcutils.ldap import (
+    breaker,
+    cache as ldap_cache,
+    connection as ldap_connection,
+    pool as ldap_pool,
+    search,
+    utils,
+)
+from arcutils.ldap.index import DirectoryIndex, IndexEntry
+from arcutils.ldap.cache import DEFAULT_CACHE_SETTINGS, invalidate, make_key, search_cache
+from arcutils.ldap.pool import ConnectionManager
+from arcutils.ldap.sync import format_timestamp, sync_users
+
+# arcutils.ldap.aio uses async/await syntax, which requires Python 3.5+
+ASYNC_AVAILABLE = sys.version_info >= (3, 5)
+
+if ASYNC_AVAILABLE:
+    import asyncio
+    from arcutils.ldap import aio
 
 
 def load_tests(loader, tests, ignore):
     tests.addTests(DocTestSuite(utils))
+    tests.addTests(DocTestSuite('arcutils.ldap.sync'))
     return tests
 
 
+PEOPLE = 'ou=people,dc=pdx,dc=edu'
+
+
+USERS = [
+    {'uid': 'bob', 'givenName': 'Bob', 'sn': 'Smith', 'mail': 'bob@pdx.edu'},
+    {'uid': 'alice', 'givenName': 'Alice', 'sn': 'Jones', 'mail': 'alice@pdx.edu'},
+]
+
+
+class MockConnectionFactory:
+
+    """Creates mock connections to a directory containing ``users``."""
+
+    def __init__(self, users=USERS):
+        self.users = users
+        self.connections = []
+
+    def __call__(self, using='default', strategy=None):
+        strategy = ldap3.MOCK_ASYNC if strategy == ldap3.ASYNC else ldap3.MOCK_SYNC
+        connection = ldap3.Connection(ldap3.Server('mock'), client_strategy=strategy)
+        for user in self.users:
+            dn = 'uid={uid},{base}'.format(uid=user['uid'], base=PEOPLE)
+            connection.strategy.add_entry(dn, dict(user, objectClass='person'))
+        self.connections.append(connection)
+        return connection
+
+
 class TestLDAP(TestCase):
 
     def test_connect(self):
@@ -26,6 +95,674 @@ class TestLDAP(TestCase):
         self.assertIsInstance(cxn, ldap3.Connection)
 
 
+class TestGetServer(TestCase):
+
+    settings = {
+        'hosts': ['dc1.example.com', 'dc2.example.com', 'dc3.example.com'],
+        'use_ssl': True,
+        'tls': {'ca_certs_file': 'certifi:cacert.pem'},
+        'pool_strategy': 'FASTEST',
+        'connect_timeout': 2,
+        'receive_timeout': 10,
+    }
+
+    def setUp(self):
+        patches = (
+            mock.patch.object(
+                ldap_connection.settings, 'get',
+                lambda key, default=None, using='default': self.settings.get(key, default)),
+            mock.patch.object(ldap_connection, 'Tls', wraps=ldap_connection.Tls),
+            mock.patch.object(ldap_connection, 'server_health', ldap_connection.ServerHealth()),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        ldap_connection.clear_server_cache()
+        self.addCleanup(ldap_connection.clear_server_cache)
+
+    def get_hosts(self):
+        return [server.host for server in ldap_connection.get_server('test')]
+
+    def test_servers_are_cached(self):
+        pool1 = ldap_connection.get_server('test')
+        pool2 = ldap_connection.get_server('test')
+        self.assertEqual(pool1.servers, pool2.servers)
+        self.assertEqual(pool1.strategy, ldap3.FIRST)
+        self.assertEqual(pool1.servers[0].connect_timeout, 2)
+        self.assertEqual(ldap_connection.Tls.call_count, 1)
+
+    def test_receive_timeout(self):
+        connection = ldap_connection.connect('test')
+        self.assertEqual(connection.receive_timeout, 10)
+
+    def test_fastest_healthy_server_is_preferred(self):
+        health = ldap_connection.server_health
+        servers = ldap_connection.get_server('test').servers
+        self.assertEqual(self.get_hosts(), self.settings['hosts'])
+        health.record_latency(servers[0], 0.5)
+        health.record_latency(servers[1], 0.1)
+        health.record_latency(servers[2], 0.2)
+        self.assertEqual(
+            self.get_hosts(), ['dc2.example.com', 'dc3.example.com', 'dc1.example.com'])
+        # Failing servers are moved to the end
+        health.record_error(servers[1])
+        self.assertEqual(
+            self.get_hosts(), ['dc3.example.com', 'dc1.example.com', 'dc2.example.com'])
+        # ...until their cooldown period is over
+        with mock.patch('time.monotonic', return_value=health._failed_at[servers[1].name] + 61):
+            self.assertEqual(self.get_hosts()[0], 'dc2.example.com')
+
+    def test_record_open(self):
+        health = ldap_connection.server_health
+        pool = ldap_connection.get_server('test')
+        connection = mock.Mock(server_pool=pool, server=pool.servers[1])
+        health.record_open(connection, 1.0)
+        self.assertEqual(set(health._failed_at), {pool.servers[0].name})
+        self.assertEqual(health._latencies, {})
+        connection.server = pool.servers[0]
+        health.record_open(connection, 1.0)
+        self.assertEqual(health._latencies, {pool.servers[0].name: 1.0})
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.breaker = breaker.CircuitBreaker('test', failure_threshold=2, reset_timeout=30)
+        self.now = 1000
+        patch = mock.patch('time.monotonic', lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def fail_once(self):
+        with self.assertRaises(LDAPSocketOpenError):
+            with self.breaker.guard():
+                raise LDAPSocketOpenError('connection refused')
+
+    def test_breaker(self):
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.fail_once()
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+        self.fail_once()
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+        func = mock.Mock()
+        self.assertRaises(breaker.CircuitOpenError, self.breaker.call, func)
+        self.assertFalse(func.called)
+
+        # A single probe is let through after reset_timeout
+        self.now += 30
+        self.assertEqual(self.breaker.state, breaker.HALF_OPEN)
+        self.breaker.before_call()
+        self.assertRaises(breaker.CircuitOpenError, self.breaker.before_call)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, breaker.OPEN)
+
+        self.now += 30
+        self.assertEqual(self.breaker.call(func), func.return_value)
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_other_errors_are_not_failures(self):
+        for _ in range(3):
+            with self.assertRaises(LDAPInvalidFilterError):
+                with self.breaker.guard():
+                    raise LDAPInvalidFilterError('malformed filter')
+        self.assertEqual(self.breaker.state, breaker.CLOSED)
+
+    def test_ldapsearch_fails_fast(self):
+        manager = ConnectionManager(connect=MockConnectionFactory())
+        patches = (
+            mock.patch.object(search, 'connection_manager', manager),
+            mock.patch.object(manager, 'run', side_effect=LDAPSocketOpenError('refused')),
+            mock.patch.object(breaker, '_circuit_breakers', {'default': self.breaker}),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        for _ in range(2):
+            self.assertRaises(LDAPSocketOpenError, ldapsearch, '(uid=bob)')
+        self.assertRaises(breaker.CircuitOpenError, ldapsearch, '(uid=bob)')
+        self.assertEqual(manager.run.call_count, 2)
+        self.assertEqual(breaker.get_circuit_breaker_states(), {'test': breaker.OPEN})
+
+
+class TestConnectionManager(TestCase):
+
+    def setUp(self):
+        self.factory = MockConnectionFactory()
+        self.manager = ConnectionManager(connect=self.factory)
+        self.addCleanup(self.manager.close_all)
+
+    def search(self, connection, uid='bob'):
+        connection.search(PEOPLE, '(uid={0})'.format(uid), attributes=['mail'])
+        return [entry['attributes']['mail'][0] for entry in connection.response]
+
+    def test_connections_are_reused(self):
+        self.assertEqual(self.manager.run('default', self.search), ['bob@pdx.edu'])
+        self.assertEqual(self.manager.run('default', self.search, 'alice'), ['alice@pdx.edu'])
+        self.assertEqual(len(self.factory.connections), 1)
+        self.assertTrue(self.factory.connections[0].bound)
+
+    def test_connections_are_not_shared(self):
+        with self.manager.connection() as connection1:
+            with self.manager.connection() as connection2:
+                self.assertIsNot(connection1, connection2)
+        with self.manager.connection() as connection3:
+            self.assertIn(connection3, (connection1, connection2))
+        self.assertEqual(len(self.factory.connections), 2)
+
+    def test_stale_connection_is_replaced(self):
+        self.manager.run('default', self.search)
+        stale = self.factory.connections[0]
+        stale.search = mock.Mock(side_effect=LDAPSocketReceiveError('connection reset'))
+        self.assertEqual(self.manager.run('default', self.search), ['bob@pdx.edu'])
+        self.assertEqual(len(self.factory.connections), 2)
+        self.assertFalse(stale.bound)
+        with self.manager.connection() as connection:
+            self.assertIs(connection, self.factory.connections[1])
+
+    def test_idle_connection_is_replaced(self):
+        self.manager.run('default', self.search)
+        idle = self.manager._pools['default']
+        connection, last_used = idle[0]
+        idle[0] = (connection, last_used - 3600)
+        self.manager.run('default', self.search)
+        self.assertEqual(len(self.factory.connections), 2)
+        self.assertFalse(connection.bound)
+
+    def test_latency_is_measured_by_binds_and_keepalive_checks(self):
+        health = ldap_connection.ServerHealth()
+        health.record_error(ldap3.Server('mock'))
+        with mock.patch.object(ldap_pool, 'server_health', health), \
+                mock.patch.object(health, 'record_latency', wraps=health.record_latency):
+            self.manager.run('default', self.search)
+            self.manager.run('default', self.search)
+            # Only the bind was timed; searches just clear errors
+            self.assertEqual(health.record_latency.call_count, 1)
+            self.assertEqual(health._failed_at, {})
+            idle = self.manager._pools['default']
+            connection, last_used = idle[0]
+            idle[0] = (connection, last_used - 120)
+            self.manager.run('default', self.search)
+            # The keepalive check was timed
+            self.assertEqual(health.record_latency.call_count, 2)
+        self.assertEqual(len(self.factory.connections), 1)
+
+    def test_ldapsearch_uses_connection_manager(self):
+        with mock.patch.object(search, 'connection_manager', self.manager):
+            results = ldapsearch('(uid=bob)')
+            self.assertEqual(results[0]['email_address'], 'bob@pdx.edu')
+            results = ldapsearch('(uid=alice)', parse=False)
+            self.assertEqual(results[0]['attributes']['uid'], ['alice'])
+        self.assertEqual(len(self.factory.connections), 1)
+
+
+class TestLDAPSearchMany(TestCase):
+
+    def setUp(self):
+        self.manager = ConnectionManager(connect=MockConnectionFactory())
+        patches = (
+            mock.patch.object(search, 'connection_manager', self.manager),
+            mock.patch.object(self.manager, 'run', wraps=self.manager.run),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.manager.close_all)
+
+    def test_ldapsearch_many(self):
+        results = ldapsearch_many(['bob', 'nobody', 'ALICE'], chunk_size=2)
+        self.assertEqual(list(results), ['bob', 'ALICE'])
+        self.assertEqual(results['bob']['email_address'], 'bob@pdx.edu')
+        self.assertEqual(results['ALICE']['username'], 'alice')
+        self.assertEqual(results.misses, ['nobody'])
+        self.assertEqual(self.manager.run.call_count, 2)
+
+    def test_ldapsearch_many_by_email(self):
+        results = ldapsearch_many(
+            ['alice@pdx.edu', 'bob@pdx.edu'], attribute='mail', attributes=['uid'], parse=False)
+        self.assertEqual(results['alice@pdx.edu']['attributes']['uid'], ['alice'])
+        self.assertEqual(results['bob@pdx.edu']['attributes']['uid'], ['bob'])
+        self.assertEqual(results.misses, [])
+        self.assertEqual(self.manager.run.call_count, 1)
+
+    def test_chunks_are_searched_concurrently(self):
+        executor_type = search.ThreadPoolExecutor
+        with mock.patch.object(search, 'ThreadPoolExecutor', wraps=executor_type) as executor:
+            ldapsearch_many(['bob', 'alice'], chunk_size=1)
+        executor.assert_called_once_with(max_workers=2)
+
+    def test_shared_connection_is_not_used_concurrently(self):
+        connection = MockConnectionFactory()()
+        with mock.patch.object(search, 'ThreadPoolExecutor') as executor:
+            results = ldapsearch_many(['bob', 'alice'], chunk_size=1, connection=connection)
+        executor.assert_not_called()
+        self.assertEqual(list(results), ['bob', 'alice'])
+        self.assertEqual(self.manager.run.call_count, 0)
+
+    def test_registered_connection_is_not_used_concurrently(self):
+        registry = mock.Mock()
+        registry.get_component.return_value = MockConnectionFactory()()
+        with mock.patch.object(search, 'get_registry', return_value=registry), \
+                mock.patch.object(search, 'ThreadPoolExecutor') as executor:
+            results = ldapsearch_many(['bob', 'alice'], chunk_size=1)
+        executor.assert_not_called()
+        self.assertEqual(list(results), ['bob', 'alice'])
+        self.assertEqual(self.manager.run.call_count, 0)
+
+
+class TestLDAPSearchIter(TestCase):
+
+    def setUp(self):
+        self.factory = MockConnectionFactory()
+        self.manager = ConnectionManager(connect=self.factory)
+        patch = mock.patch.object(search, 'connection_manager', self.manager)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.manager.close_all)
+
+    def get_connection(self):
+        with self.manager.connection() as connection:
+            connection.search = mock.Mock(wraps=connection.search)
+        return connection
+
+    def test_ldapsearch_iter(self):
+        connection = self.get_connection()
+        results = ldapsearch_iter('(objectClass=person)', page_size=1)
+        self.assertEqual(connection.search.call_count, 0)
+        usernames = [result['username'] for result in results]
+        self.assertEqual(sorted(usernames), ['alice', 'bob'])
+        # One search per page plus one that returns an empty last page
+        self.assertEqual(connection.search.call_count, 3)
+        self.assertEqual(len(self.manager._pools['default']), 1)
+
+    def test_ldapsearch_iter_early_termination(self):
+        connection = self.get_connection()
+        for result in ldapsearch_iter('(objectClass=person)', page_size=1, parse=False):
+            self.assertIn('attributes', result)
+            break
+        # The rest of the search was abandoned with an empty page
+        self.assertEqual(connection.search.call_count, 2)
+        self.assertEqual(connection.search.call_args[1]['paged_size'], 0)
+        self.assertEqual(len(self.manager._pools['default']), 1)
+        self.assertEqual(len(self.factory.connections), 1)
+
+
+@skipUnless(ASYNC_AVAILABLE, 'arcutils.ldap.aio requires Python 3.5+')
+class TestAsyncLDAPSearch(TestCase):
+
+    def setUp(self):
+        self.factory = MockConnectionFactory()
+        self.manager = aio.AsyncConnectionManager(connect=self.factory)
+        patch = mock.patch.object(aio, 'connection_manager', self.manager)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.manager.close_all)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+
+    def run_until_complete(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_ldapsearch(self):
+        results = self.run_until_complete(aio.ldapsearch('(uid=bob)'))
+        self.assertEqual(results[0]['email_address'], 'bob@pdx.edu')
+        self.assertEqual(self.factory.connections[0].strategy_type, ldap3.MOCK_ASYNC)
+
+    def test_ldapsearch_all(self):
+        queries = ['(uid=alice)', '(uid=nobody)', '(uid=bob)']
+        results = self.run_until_complete(aio.ldapsearch_all(queries, parse=False))
+        self.assertEqual(results[0][0]['attributes']['uid'], ['alice'])
+        self.assertEqual(results[1], [])
+        self.assertEqual(results[2][0]['attributes']['uid'], ['bob'])
+        # Searches are multiplexed over one connection
+        self.assertEqual(len(self.factory.connections), 1)
+
+    def test_ldapsearch_many(self):
+        results = self.run_until_complete(
+            aio.ldapsearch_many(['bob', 'nobody', 'ALICE'], chunk_size=1))
+        self.assertEqual(list(results), ['bob', 'ALICE'])
+        self.assertEqual(results['ALICE']['username'], 'alice')
+        self.assertEqual(results.misses, ['nobody'])
+
+    def test_late_failure_does_not_discard_new_connection(self):
+        self.run_until_complete(aio.ldapsearch('(uid=bob)'))
+        stale = self.factory.connections[0]
+        calls = []
+        fail_late = threading.Event()
+
+        def get_response(message_id):
+            calls.append(message_id)
+            if len(calls) > 1:
+                # The second search's response fails after the first
+                # search has replaced the stale connection.
+                fail_late.wait(5)
+            raise LDAPSocketReceiveError('connection reset')
+
+        stale.get_response = get_response
+        first = self.loop.create_task(aio.ldapsearch('(uid=bob)'))
+        second = self.loop.create_task(aio.ldapsearch('(uid=alice)'))
+        self.assertEqual(self.run_until_complete(first)[0]['username'], 'bob')
+        fresh = self.factory.connections[1]
+        fail_late.set()
+        self.assertEqual(self.run_until_complete(second)[0]['username'], 'alice')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(self.factory.connections), 2)
+        self.assertTrue(fresh.bound)
+
+    def test_concurrency_is_limited(self):
+        with mock.patch.object(aio.settings, 'get', return_value=1):
+            state = self.manager._get_state('default')
+        self.loop.run_until_complete(state.semaphore.acquire())
+        task = self.loop.create_task(aio.ldapsearch('(uid=bob)'))
+        self.run_until_complete(asyncio.sleep(0.01))
+        self.assertFalse(task.done())
+        state.semaphore.release()
+        self.assertEqual(self.run_until_complete(task)[0]['username'], 'bob')
+
+
+class TestDirectoryIndex(TestCase):
+
+    def setUp(self):
+        manager = ConnectionManager(connect=MockConnectionFactory())
+        patch = mock.patch.object(search, 'connection_manager', manager)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(manager.close_all)
+        self.index = DirectoryIndex(query='(objectClass=person)', page_size=1)
+
+    def usernames(self, results):
+        return [entry.username for entry in results]
+
+    def test_search(self):
+        self.index.refresh()
+        self.assertEqual(len(self.index), 2)
+        with mock.patch('arcutils.ldap.index.ldapsearch') as ldapsearch:
+            self.assertEqual(self.usernames(self.index.search('B')), ['bob'])
+            self.assertEqual(self.usernames(self.index.search('jones')), ['alice'])
+            self.assertEqual(self.usernames(self.index.search('alice@')), ['alice'])
+            self.assertEqual(self.usernames(self.index.search('s b')), ['bob'])
+            self.assertEqual(self.index.search('a', limit=1)[0].first_name, 'Alice')
+            self.assertFalse(ldapsearch.called)
+        self.assertEqual(self.index.search('   '), [])
+
+    def test_fallback(self):
+        alice = {
+            'username': 'alice',
+            'first_name': 'Alice',
+            'last_name': 'Jones',
+            'full_name': 'Alice Jones',
+            'email_address': 'alice@pdx.edu',
+        }
+        with mock.patch('arcutils.ldap.index.ldapsearch', return_value=[alice]) as ldapsearch:
+            # Not loaded yet
+            self.assertEqual(self.usernames(self.index.search('ali j')), ['alice'])
+            self.assertEqual(ldapsearch.call_args[0][0], (
+                '(&'
+                '(|(uid=ali*)(givenName=ali*)(sn=ali*)(cn=ali*)(mail=ali*))'
+                '(|(uid=j*)(givenName=j*)(sn=j*)(cn=j*)(mail=j*))'
+                ')'
+            ))
+            self.index.refresh()
+            self.assertTrue(self.index.loaded)
+            self.assertEqual(self.usernames(self.index.search('bob')), ['bob'])
+            self.assertEqual(ldapsearch.call_count, 1)
+            # Miss
+            self.assertEqual(self.usernames(self.index.search('zed')), ['alice'])
+            self.assertEqual(ldapsearch.call_count, 2)
+            self.index.fallback = False
+            self.assertEqual(self.index.search('zed'), [])
+            self.assertEqual(ldapsearch.call_count, 2)
+
+    def test_fallback_errors(self):
+        with mock.patch('arcutils.ldap.index.ldapsearch') as ldapsearch:
+            ldapsearch.side_effect = breaker.CircuitOpenError('open')
+            with self.assertLogs('arcutils.ldap.index', 'DEBUG') as logs:
+                self.assertEqual(self.index.search('ali'), [])
+            self.assertEqual([r.levelname for r in logs.records], ['DEBUG'])
+            self.assertIsNone(logs.records[0].exc_info)
+            ldapsearch.side_effect = LDAPSocketReceiveError('connection reset')
+            with self.assertLogs('arcutils.ldap.index', 'ERROR') as logs:
+                self.assertEqual(self.index.search('ali'), [])
+            self.assertIsNotNone(logs.records[0].exc_info)
+
+    def test_refresh_swaps_index(self):
+        self.index.refresh()
+        old_index = self.index._index
+        self.index.build = mock.Mock(return_value=DirectoryIndex().build([
+            {'username': 'carol', 'email_address': 'carol@pdx.edu'},
+        ]))
+        self.index.refresh()
+        self.assertIsNot(self.index._index, old_index)
+        self.assertEqual(
+            self.index.search('car'), [IndexEntry('carol', None, None, None, 'carol@pdx.edu')])
+
+
+class TestSyncUsers(DjangoTestCase):
+
+    users = [
+        dict(USERS[0], modifyTimestamp='20170901120000Z'),
+        dict(USERS[1], modifyTimestamp='20170905120000Z'),
+    ]
+
+    def setUp(self):
+        self.factory = MockConnectionFactory(self.users)
+        manager = ConnectionManager(connect=self.factory)
+        patch = mock.patch.object(search, 'connection_manager', manager)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(manager.close_all)
+        self.user_model = get_user_model()
+
+    def sync(self, since=None, **kwargs):
+        return sync_users(since, query='(objectClass=person)', page_size=1, **kwargs)
+
+    def test_sync(self):
+        self.user_model.objects.create(username='bob', first_name='Robert')
+        stats = self.sync()
+        self.assertEqual(stats.created, 1)
+        self.assertEqual(stats.updated, 1)
+        self.assertEqual(stats.unchanged, 0)
+        self.assertEqual(stats.high_water_mark, '20170905120000Z')
+        bob = self.user_model.objects.get(username='bob')
+        alice = self.user_model.objects.get(username='alice')
+        self.assertEqual(bob.first_name, 'Bob')
+        self.assertEqual(alice.email, 'alice@pdx.edu')
+        self.assertFalse(alice.has_usable_password())
+
+        stats = self.sync()
+        self.assertEqual((stats.created, stats.updated, stats.unchanged), (0, 0, 2))
+
+    def test_sync_since(self):
+        stats = self.sync('20170905120000Z')
+        self.assertEqual((stats.created, stats.updated), (1, 0))
+        self.assertEqual(list(self.user_model.objects.values_list('username', flat=True)), [
+            'alice'])
+        self.assertEqual(stats.high_water_mark, '20170905120000Z')
+
+        stats = self.sync('20170906000000Z')
+        self.assertEqual((stats.created, stats.updated, stats.unchanged), (0, 0, 0))
+        self.assertEqual(stats.high_water_mark, '20170906000000Z')
+
+    def test_invalid_since_is_rejected(self):
+        for since in ('*)(uid=*', '2017-09-01', '20170901120000', '20170901120000+0000'):
+            self.assertRaises(ValueError, self.sync, since)
+        self.assertFalse(self.user_model.objects.exists())
+
+    def test_high_water_mark_is_normalized(self):
+        self.factory.users = [
+            dict(USERS[0], modifyTimestamp='20170905120000.0Z'),
+            dict(USERS[1], modifyTimestamp='20170901120000Z'),
+        ]
+        stats = self.sync()
+        self.assertEqual(stats.high_water_mark, '20170905120000Z')
+        stats = self.sync('20170905120000.5Z')
+        self.assertEqual(stats.high_water_mark, '20170905120000Z')
+
+    def test_sync_more_users_than_parameter_limit(self):
+        users = [
+            {'uid': 'user{0}'.format(i), 'givenName': 'New', 'sn': 'User',
+             'mail': 'user{0}@pdx.edu'.format(i), 'modifyTimestamp': '20170901120000Z'}
+            for i in range(400)
+        ]
+        self.factory.users = users
+        self.user_model.objects.bulk_create(
+            self.user_model(username=user['uid'], first_name='Old') for user in users)
+        with CaptureQueriesContext(db_connection) as queries:
+            stats = sync_users(query='(objectClass=person)')
+        self.assertEqual(stats.updated, 400)
+        if db_connection.vendor == 'sqlite':
+            # Each update is split to fit SQLite's historical limit of
+            # 999 variables per query (7 per user)
+            updates = [q for q in queries if q['sql'].startswith('UPDATE')]
+            self.assertEqual(len(updates), 3)
+        self.assertFalse(self.user_model.objects.filter(first_name='Old').exists())
+
+    def test_dry_run(self):
+        stats = self.sync(dry_run=True)
+        self.assertEqual(stats.created, 2)
+        self.assertFalse(self.user_model.objects.exists())
+
+    def test_format_timestamp(self):
+        value = datetime.datetime(2017, 9, 1, 5, 0, tzinfo=datetime.timezone(
+            datetime.timedelta(hours=-7)))
+        self.assertEqual(format_timestamp(value), '20170901120000Z')
+        self.assertEqual(format_timestamp('20170901120000.123Z'), '20170901120000Z')
+        self.assertIsNone(format_timestamp(None))
+        self.assertRaises(ValueError, format_timestamp, '20170901120000')
+        self.assertRaises(ValueError, format_timestamp, 20170901120000)
+
+    def test_command(self):
+        fd, state_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        os.remove(state_file)
+        self.addCleanup(lambda: os.path.exists(state_file) and os.remove(state_file))
+
+        def run(*args):
+            stdout = StringIO()
+            call_command(
+                'syncldapusers', '--state-file', state_file, '--query', '(objectClass=person)',
+                *args, stdout=stdout)
+            return stdout.getvalue()
+
+        self.assertIn('Would create 2 users', run('--dry-run'))
+        self.assertFalse(os.path.exists(state_file))
+
+        self.assertIn('Created 2 users', run())
+        with open(state_file) as fp:
+            self.assertEqual(json.load(fp), {'high_water_mark': '20170905120000Z'})
+
+        # The next run starts from the high-water mark
+        with mock.patch('arcutils.management.commands.syncldapusers.sync_users',
+                        wraps=sync_users) as sync:
+            self.assertIn('(1 unchanged)', run())
+            self.assertEqual(sync.call_args[1]['since'], '20170905120000Z')
+            self.assertIn('(2 unchanged)', run('--full'))
+            self.assertIsNone(sync.call_args[1]['since'])
+            run('--since', '20170901120000.0Z')
+            self.assertEqual(sync.call_args[1]['since'], '20170901120000Z')
+
+    def test_command_rejects_invalid_timestamps(self):
+        fd, state_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, state_file)
+        with open(state_file, 'w') as fp:
+            json.dump({'high_water_mark': '*)(uid=*'}, fp)
+        with mock.patch('arcutils.management.commands.syncldapusers.sync_users') as sync:
+            with self.assertRaisesRegex(CommandError, '--since'):
+                call_command('syncldapusers', '--state-file', state_file, '--since', '*')
+            with self.assertRaisesRegex(CommandError, 'State file'):
+                call_command('syncldapusers', '--state-file', state_file)
+        sync.assert_not_called()
+
+
+def parse_uid(attributes):
+    return attributes['uid'][0]
+
+
+class TestSearchCache(TestCase):
+
+    def setUp(self):
+        self.manager = ConnectionManager(connect=MockConnectionFactory())
+        self.cache_settings = dict(DEFAULT_CACHE_SETTINGS, django_cache='default')
+        get_cache_settings = lambda using: self.cache_settings  # noqa: E731
+        patches = (
+            mock.patch.object(search, 'connection_manager', self.manager),
+            mock.patch.object(self.manager, 'run', wraps=self.manager.run),
+            mock.patch.object(search, 'get_cache_settings', get_cache_settings),
+            mock.patch('arcutils.ldap.cache.get_cache_settings', get_cache_settings),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(search_cache.clear)
+        self.addCleanup(self.manager.close_all)
+        search_cache.clear()
+        invalidate()
+
+    @property
+    def num_searches(self):
+        return self.manager.run.call_count
+
+    def test_results_are_cached(self):
+        self.assertEqual(ldapsearch('(uid=bob)')[0]['username'], 'bob')
+        self.assertEqual(ldapsearch('(uid=bob)')[0]['username'], 'bob')
+        self.assertEqual(self.num_searches, 1)
+        ldapsearch('(uid=bob)', parse=False)
+        ldapsearch('(uid=bob)', attributes=['uid'])
+        ldapsearch('(uid=bob)', cache=False)
+        self.assertEqual(self.num_searches, 4)
+
+    def test_results_with_named_parser_are_cached(self):
+        self.assertEqual(ldapsearch('(uid=bob)', parse=parse_uid), ['bob'])
+        self.assertEqual(ldapsearch('(uid=bob)', parse=parse_uid), ['bob'])
+        self.assertEqual(self.num_searches, 1)
+        # The parser is keyed on its name, not its (per-process) repr
+        self.assertEqual(
+            ldap_cache._get_parser_key(parse_uid), 'arcutils.tests.test_ldap.parse_uid')
+
+    def test_results_with_unnamed_parser_are_not_cached(self):
+        parsers = (
+            lambda attributes: attributes['uid'][0],
+            partial(parse_uid),
+            mock.Mock(side_effect=parse_uid),
+        )
+        for parser in parsers:
+            self.assertIsNone(make_key(
+                'default', PEOPLE, '(uid=bob)', ldap3.SUBTREE, ['uid'], parser, {}))
+            self.assertEqual(ldapsearch('(uid=bob)', parse=parser), ['bob'])
+            self.assertEqual(ldapsearch('(uid=bob)', parse=parser), ['bob'])
+        self.assertEqual(self.num_searches, 6)
+
+    def test_cached_results_are_copies(self):
+        ldapsearch('(uid=bob)')[0]['username'] = 'pants'
+        self.assertEqual(ldapsearch('(uid=bob)')[0]['username'], 'bob')
+
+    def test_empty_results_use_negative_ttl(self):
+        self.cache_settings['negative_ttl'] = 0
+        self.assertEqual(ldapsearch('(uid=nobody)'), [])
+        self.assertEqual(ldapsearch('(uid=nobody)'), [])
+        self.assertEqual(self.num_searches, 2)
+
+    def test_django_cache_tier(self):
+        ldapsearch('(uid=bob)')
+        search_cache.clear()
+        self.assertEqual(ldapsearch('(uid=bob)')[0]['username'], 'bob')
+        self.assertEqual(self.num_searches, 1)
+
+    def test_invalidate(self):
+        ldapsearch('(uid=bob)')
+        ldapsearch('(uid=alice)')
+        invalidate(query='(uid=bob)')
+        ldapsearch('(uid=alice)')
+        self.assertEqual(self.num_searches, 2)
+        ldapsearch('(uid=bob)')
+        self.assertEqual(self.num_searches, 3)
+        invalidate()
+        ldapsearch('(uid=alice)')
+        self.assertEqual(self.num_searches, 4)
+
+
 class TestLDAPProfileParsing(TestCase):
 
     def test_parse_profile(self):
@@ -55,6 +792,89 @@ class TestLDAPProfileParsing(TestCase):
         self.assertEqual(result['phone_number'], '503-725-1234')
         self.assertEqual(result['extension'], '5-1234')
 
+    def test_lazy_profile(self):
+        entry = {
+            'sn': ['Johnson '],
+            'givenName': ['Matt'],
+            'uid': ['mdj2'],
+            'telephoneNumber': ['x5-1234'],
+        }
+        profile = LDAPProfile(entry)
+        with mock.patch('arcutils.ldap.profile.parse_phone_number') as parse_phone_number:
+            self.assertEqual(profile['username'], 'mdj2')
+            self.assertEqual(profile.last_name, 'Johnson')
+            self.assertFalse(parse_phone_number.called)
+        self.assertEqual(profile['extension'], '5-1234')
+        self.assertEqual(profile, parse_profile(entry))
+        self.assertEqual(list(profile), list(parse_profile(entry)))
+        self.assertRaises(KeyError, lambda: profile['nope'])
+        self.assertRaises(AttributeError, lambda: profile.nope)
+        self.assertFalse(hasattr(profile, '__dict__'))
+
+    def test_ldapsearch_with_lazy_profile(self):
+        manager = ConnectionManager(connect=MockConnectionFactory())
+        self.addCleanup(manager.close_all)
+        with mock.patch.object(search, 'connection_manager', manager):
+            results = ldapsearch('(uid=bob)', parse=LDAPProfile)
+        self.assertIsInstance(results[0], LDAPProfile)
+        self.assertEqual(results[0]['email_address'], 'bob@pdx.edu')
+
+    def test_profile_attributes(self):
+        entry = {
+            'cn': ['Matt Johnson'],
+            'sn': ['Johnson'],
+            'givenName': ['Matt'],
+            'mail': ['mdj2@pdx.edu'],
+            'mailLocalAddress': ['matt.johnson@pdx.edu'],
+            'mailRoutingAddress': ['mdj2@pdx.edu'],
+            'uid': ['mdj2'],
+            'title': ['Developer'],
+            'ou': ['Web Development Team - Office of Information Technology'],
+            'psuPasswordExpireDate': ['20161031121314Z'],
+            'telephoneNumber': ['x5-1234'],
+            'roomNumber': ['FAB 123'],
+            'eduPersonAffiliation': ['staff'],
+            'memberOf': ['CN=AAA,OU=BBB,DC=PSU,DC=DS,DC=PDX,DC=EDU'],
+        }
+        profile = parse_profile(entry)
+        # Each field can be parsed from just the attributes it needs
+        for field in PROFILE_FIELDS:
+            attributes = get_profile_attributes([field])
+            projected_entry = {k: v for (k, v) in entry.items() if k in attributes}
+            self.assertEqual(parse_profile(projected_entry, [field]), {field: profile[field]})
+        self.assertRaises(ValueError, get_profile_attributes, ['nope'])
+
+    def test_ldapsearch_with_fields(self):
+        factory = MockConnectionFactory()
+        manager = ConnectionManager(connect=factory)
+        self.addCleanup(manager.close_all)
+        with manager.connection() as connection:
+            connection.search = mock.Mock(wraps=connection.search)
+        with mock.patch.object(search, 'connection_manager', manager):
+            results = ldapsearch('(uid=bob)', fields=['username', 'email_address'])
+        self.assertEqual(results, [{'username': 'bob', 'email_address': 'bob@pdx.edu'}])
+        self.assertEqual(connection.search.call_args[1]['attributes'], ['mail', 'name', 'uid'])
+
+    def test_parse_member_of(self):
+        group_dn = 'CN=AAA,OU=BBB,DC=PSU,DC=DS,DC=PDX,DC=EDU'
+        entries = [{'memberOf': [group_dn, 'CN={0},OU=BBB'.format(i)]} for i in range(3)]
+        utils._parse_dn.cache_clear()
+        parsed_dns = utils.parse_dns(dn for e in entries for dn in e['memberOf'])
+        self.assertEqual(len(parsed_dns), 4)
+        self.assertEqual(utils._parse_dn.cache_info().misses, 4)
+        for i, entry in enumerate(entries):
+            self.assertEqual(
+                parse_member_of(entry, parsed_dns), [{'name': 'AAA'}, {'name': str(i)}])
+            self.assertEqual(parse_member_of(entry), [{'name': 'AAA'}, {'name': str(i)}])
+        self.assertEqual(utils._parse_dn.cache_info().misses, 4)
+
+    def test_parse_dn_returns_copy(self):
+        result = utils.parse_dn('CN=AAA,OU=BBB')
+        result['cn'].append('XXX')
+        result['dc'].append('YYY')
+        self.assertEqual(utils.parse_dn('CN=AAA,OU=BBB')['cn'], ['AAA'])
+        self.assertNotIn('dc', utils.parse_dn_cached('CN=AAA,OU=BBB'))
+
     def test_parse_email(self):
         self.assertEqual('foo@bar.com', parse_email({'mail': ['foo@bar.com']}))
 
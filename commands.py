@@ -8,7 +8,8 @@ from arctasks.release import *  # noqa: F401,F403
 
 
 @command
-def test(config, tests=(), fail_fast=False, verbosity=1, with_coverage=False, with_lint=False):
+def test(config, tests=(), fail_fast=False, verbosity=1, with_coverage=False, with_lint=False,
+         database=None):
     from coverage import Coverage
 
     from django import setup
@@ -20,25 +21,47 @@ def test(config, tests=(), fail_fast=False, verbosity=1, with_coverage=False, wi
     with_coverage = with_coverage and not tests
     with_lint = with_lint and not tests
 
+    databases = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        },
+        # These are used to test arcutils.db.routers.
+        'replica1': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        },
+        'replica2': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': ':memory:',
+        },
+    }
+
+    installed_apps = [
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django.contrib.admin',
+        'arcutils',
+    ]
+
+    if database:
+        # The auditor uses PostgreSQL-specific fields, so its tests are
+        # only run when a PostgreSQL database is specified.
+        databases['default'] = {
+            'ENGINE': 'django.db.backends.postgresql_psycopg2',
+            'NAME': database,
+        }
+        installed_apps.append('arcutils.auditor')
+
     settings.configure(
         DEBUG=True,
         ALLOWED_HOSTS=['*'],
-        DATABASES={
-            'default': {
-                'ENGINE': 'django.db.backends.sqlite3',
-                'NAME': ':memory:',
-            }
-        },
+        DATABASES=databases,
         ROOT_URLCONF=(
             url(r'^test$', lambda request: HttpResponse('test'), name='test'),
         ),
-        INSTALLED_APPS=(
-            'django.contrib.auth',
-            'django.contrib.contenttypes',
-            'django.contrib.sessions',
-            'django.contrib.admin',
-            'arcutils',
-        ),
+        INSTALLED_APPS=installed_apps,
         MIDDLEWARE_CLASSES=[],
         LDAP={
             'default': {
@@ -80,3 +103,13 @@ def test(config, tests=(), fail_fast=False, verbosity=1, with_coverage=False, wi
 
     if with_lint:
         lint(config)
+
+
+@command
+def benchmark_auditor(config, iterations=1000, output=None):
+    """Benchmark the overhead of auditing and emit the results as JSON."""
+    from arcutils.auditor.benchmarks.suite import main
+    argv = ['--iterations', str(iterations)]
+    if output:
+        argv.extend(['--output', output])
+    main(argv)
@@ -26,6 +26,7 @@ deps = {
     'coverage': 'coverage>=4.4.1',
     'djangorestframework': 'djangorestframework>=3.6.3',
     'ldap3': 'ldap3>=2.3',
+    'numpy': 'numpy>=1.11',
 }
 
 setup(
@@ -43,12 +44,16 @@ setup(
         'ldap': [
             deps['ldap3'],
         ],
+        'numpy': [
+            deps['numpy'],
+        ],
         'dev': [
             deps['coverage'],
             'django>={django_version},<{django_version}.999'.format_map(locals()),
             deps['djangorestframework'],
             'flake8',
             deps['ldap3'],
+            deps['numpy'],
             'psu.oit.arc.tasks',
             'tox>=2.7.0',
         ],
@@ -57,6 +62,7 @@ setup(
             deps['djangorestframework'],
             'flake8',
             deps['ldap3'],
+            deps['numpy'],
             'psu.oit.arc.tasks',
         ]
     },